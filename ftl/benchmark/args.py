@@ -50,4 +50,12 @@ def base_parser():
         default=0,
         help=('Number of app files to generate for test'))
 
+    parser.add_argument(
+        '--compare-compression',
+        dest='compare_compression',
+        action='store_true',
+        default=False,
+        help=('Log the size and the compression and decompression times of '
+              'the app as a gzip and as a zstd layer'))
+
     return parser
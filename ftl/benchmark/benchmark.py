@@ -14,11 +14,16 @@
 
 import subprocess
 import datetime
+import tempfile
 import time
 import os
 import logging
+import zlib
 from google.cloud import bigquery
 
+from ftl.common import constants
+from ftl.common import ftl_util
+
 
 class Benchmark():
     def __init__(self, args, runtime):
@@ -32,6 +37,8 @@ class Benchmark():
         self._table = args.table
         self._runtime = runtime
         self._gen_files = args.gen_files
+        self._layer_compression = args.layer_compression
+        self._compare_compression = args.compare_compression
 
     def _record_build_times_to_bigquery(self, build_times):
         current_date = datetime.datetime.now()
@@ -51,6 +58,33 @@ class Benchmark():
         client.create_rows(table, rows)
         logging.info("Finished adding build times to {0}".format(full_name))
 
+    def _compare_layer_compression(self):
+        _, u_blob = ftl_util.zip_dir_to_layer_sha(self._directory, 'srv')
+        tar_path = tempfile.mktemp(suffix='.tar')
+        with open(tar_path, 'wb') as f:
+            f.write(u_blob)
+        for compression in constants.LAYER_COMPRESSIONS:
+            layer_opts = ftl_util.LayerOptions(compression=compression)
+            start_time = time.time()
+            if compression == constants.ZSTD:
+                blob = ftl_util.zstd_layer(tar_path, layer_opts)
+            else:
+                blob = ftl_util.gzip_layer(u_blob, layer_opts)
+            compress_time = time.time() - start_time
+            start_time = time.time()
+            if compression == constants.ZSTD:
+                ftl_util.zstd_decompress(blob)
+            else:
+                zlib.decompress(blob, 16 + zlib.MAX_WBITS)
+            decompress_time = time.time() - start_time
+            logging.info(
+                '{0} layer: {1} bytes ({2:.1%} of {3}), compressed in '
+                '{4:.2f}s, decompressed in {5:.2f}s'.format(
+                    compression, len(blob),
+                    float(len(blob)) / max(len(u_blob), 1), len(u_blob),
+                    compress_time, decompress_time))
+        os.remove(tar_path)
+
     def run_benchmarks(self):
         logging.getLogger().setLevel("NOTSET")
         logging.basicConfig(
@@ -61,6 +95,8 @@ class Benchmark():
             file_name = os.path.join(self._directory, 'app_file_%d' % i)
             with open(file_name, 'wb') as fout:
                 fout.write(os.urandom(1024))
+        if self._compare_compression:
+            self._compare_layer_compression()
         logging.info('Beginning building {0} images'.format(self._runtime))
         for _ in range(self._iterations):
             try:
@@ -78,7 +114,8 @@ class Benchmark():
                     [
                         builder_path, '--base', self._base, '--name',
                         self._name, '--directory', self._directory,
-                        '--no-cache'
+                        '--no-cache', '--layer-compression',
+                        self._layer_compression
                     ],
                     stderr=subprocess.PIPE)
                 _, output = cmd.communicate()
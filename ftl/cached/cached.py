@@ -83,9 +83,11 @@ class Cached():
 
             out = ""
             try:
+                # keep all of the output, it is searched for cache hits
                 out = ftl_util.run_command(
                     "cached-ftl-build-%s" % img_name,
-                    ftl_args)
+                    ftl_args,
+                    tail_lines=None)
                 lyr_shas.append(self._fetch_lyr_shas(img_name))
             except ftl_util.FTLException as e:
                 logging.error(e)
@@ -27,6 +27,32 @@ def version_parser():
     return parser
 
 
+def daemon_parser():
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument(
+        '--daemon',
+        dest='daemon_socket',
+        action='store',
+        default=None,
+        help='Serve builds requested over the unix socket at this path \
+        instead of running a single build. Python builds using the same \
+        --virtualenv-dir run one at a time')
+    return parser
+
+
+def batch_parser():
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument(
+        '--batch',
+        dest='batch_path',
+        action='store',
+        default=None,
+        help='A json file listing the apps to build, as \
+        [{"directory": <path>, "name": <image>}, ...]. All other flags are \
+        shared by the apps and --directory and --name are taken from it')
+    return parser
+
+
 def base_parser():
     parser = argparse.ArgumentParser()
     group = parser.add_mutually_exclusive_group(required=True)
@@ -81,6 +107,17 @@ def base_parser():
         default=True,
         action='store_true',
         help='Check cache during build (default).')
+    parser.add_argument(
+        '--no-build-cache',
+        dest='build_cache',
+        action='store_false',
+        help='Do not reuse a previous image built from identical inputs.')
+    parser.add_argument(
+        '--build-cache',
+        dest='build_cache',
+        default=True,
+        action='store_true',
+        help='Reuse a previous image built from identical inputs (default).')
     parser.add_argument(
         '--global-cache',
         dest='global_cache',
@@ -104,6 +141,74 @@ def base_parser():
         action='store',
         help='Store final image as local tarball at output path \
             instead of pushing to registry')
+    parser.add_argument(
+        '--oci-layout-path',
+        dest='oci_layout_path',
+        action='store',
+        help='Store final image in the OCI image-layout directory at this \
+            path instead of pushing to registry. Blobs already in the \
+            directory are reused')
+    parser.add_argument(
+        '--layer-compression',
+        dest='layer_compression',
+        action='store',
+        choices=constants.LAYER_COMPRESSIONS,
+        default=constants.GZIP,
+        help='How the layers FTL produces are compressed. zstd layers are \
+        pushed in OCI manifests, base image layers stay gzip. estargz \
+        layers are gzip layers that runtimes can pull lazily')
+    parser.add_argument(
+        '--estargz-prioritized-files',
+        dest='estargz_prioritized_files',
+        action='store',
+        type=lambda paths: [p for p in paths.split(',') if p],
+        default=[],
+        help='Comma separated paths in the image (ex: srv/server.js) that \
+        are placed first in estargz layers, in the order a container reads \
+        them on startup')
+    parser.add_argument(
+        '--compression-level',
+        dest='compression_level',
+        action='store',
+        type=int,
+        choices=range(1, 10),
+        default=constants.DEFAULT_COMPRESSION_LEVEL,
+        help='The gzip level used to compress the layers FTL produces')
+    parser.add_argument(
+        '--compression-threads',
+        dest='compression_threads',
+        action='store',
+        type=int,
+        default=None,
+        help='The number of threads compressing a layer (default: one \
+        per cpu)')
+    parser.add_argument(
+        '--dedupe-files',
+        dest='dedupe_files',
+        default=False,
+        action='store_true',
+        help='Store files repeated within a layer, like the copies of a \
+        package nested in node_modules, once and hardlink the other copies')
+    parser.add_argument(
+        '--max-layers',
+        dest='max_layers',
+        action='store',
+        type=int,
+        default=constants.DEFAULT_MAX_LAYERS,
+        help='The most package layers an image gets, past it they are \
+        merged into groups. 0 keeps one layer per package')
+    parser.add_argument(
+        '--layer-grouping',
+        dest='layer_grouping',
+        action='store',
+        choices=constants.LAYER_GROUPINGS,
+        default=constants.CHURN_GROUPING,
+        help='How package layers are merged past --max-layers: churn keeps \
+        layers whose cache keys change as often together, size only \
+        evens out the size of the groups. Both go by the layer history of \
+        the host, so builders on other hosts may group the same layers \
+        differently and not share the cached groups. key splits the \
+        layers by their cache keys alone, the same on every host')
     parser.add_argument(
         "-v",
         "--verbosity",
@@ -149,6 +254,20 @@ def base_parser():
         default=(os.environ.get(constants.BUILDER_OUTPUT)
                  if os.environ.get(constants.BUILDER_OUTPUT) else None),
         help='The path to store FTL logs')
+    parser.add_argument(
+        '--plan',
+        dest='plan',
+        action='store_true',
+        default=False,
+        help='Print which layers would be cache hits and the expected cost \
+        of the misses as json, without building anything. Without a \
+        lockfile, which the build would generate, hits are unknown')
+    parser.add_argument(
+        '--history-path',
+        dest='history_path',
+        action='store',
+        default=constants.LAYER_HISTORY_PATH,
+        help='The json file used to track layer build times and sizes')
     parser.add_argument(
         '--ttl',
         dest='ttl',
@@ -159,10 +278,10 @@ def base_parser():
     return parser
 
 
-node_flgs = []
+node_flgs = ['package_store_dir', 'package_store_max_mb']
 php_flgs = []
 python_flgs = ['python_cmd', 'pip_cmd', 'virtualenv_cmd', 'virtualenv_dir',
-               'venv_cmd']
+               'venv_cmd', 'virtualenv_template_dir', 'compile_bytecode']
 
 
 def extra_args(parser, opt_list):
@@ -207,6 +326,48 @@ def extra_args(parser, opt_list):
                 "help": 'The virtualenv command to be run (ex: virtualenv)'
             }
         ],
+        'virtualenv_template_dir': [
+            '--virtualenv-template-dir', {
+                "dest": 'virtualenv_template_dir',
+                "action": 'store',
+                "type": os.path.expanduser,
+                "default": constants.VIRTUALENV_TEMPLATE_DIR,
+                "help": 'The directory virtualenvs are cloned from instead '
+                'of being created, per interpreter and virtualenv tool. '
+                'An empty value creates every virtualenv'
+            }
+        ],
+        'package_store_dir': [
+            '--package-store-dir', {
+                "dest": 'package_store_dir',
+                "action": 'store',
+                "type": os.path.expanduser,
+                "default": constants.NODE_PACKAGE_STORE_DIR,
+                "help": 'The directory npm and yarn keep downloaded '
+                'packages in across builds. An empty value downloads '
+                'every package'
+            }
+        ],
+        'package_store_max_mb': [
+            '--package-store-max-mb', {
+                "dest": 'package_store_max_mb',
+                "action": 'store',
+                "type": int,
+                "default": constants.NODE_PACKAGE_STORE_MAX_MB,
+                "help": 'The size past which the least recently used '
+                'packages are evicted from --package-store-dir'
+            }
+        ],
+        'compile_bytecode': [
+            '--compile-bytecode', {
+                "dest": 'compile_bytecode',
+                "action": 'store_true',
+                "default": False,
+                "help": 'Compile the installed packages and the app to '
+                'bytecode with hash-based invalidation, in parallel. '
+                'Requires python 3.7 or newer'
+            }
+        ],
     }
     for opt in opt_list:
         arg_vars = opt_dict[opt]
@@ -0,0 +1,83 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""This package defines building several apps in one process."""
+
+import collections
+import json
+
+from containerregistry.client import docker_name
+
+from ftl.common import builder
+from ftl.common import constants
+from ftl.common import context
+from ftl.common import ftl_util
+from ftl.common import logger
+
+
+class Batch(object):
+    """Batch builds a list of apps of one runtime one after the other.
+
+    The apps share the base image, the registry transport and credentials,
+    and the dependency layers by cache key, so a layer used by several apps
+    is looked up or built once. Built layers hold their blobs in memory, so
+    only the max_shared_layers most recently used are kept between apps.
+    Each image is pushed mounting blobs from the images pushed before it.
+    """
+
+    def __init__(self, runtime, parser, builder_cls,
+                 max_shared_layers=constants.BATCH_SHARED_LAYERS):
+        self._runtime = runtime
+        self._parser = parser
+        self._builder_cls = builder_cls
+        self._max_shared_layers = max_shared_layers
+
+    def ReadApps(self, batch_path, shared_args):
+        """Returns the parsed args of every app in the batch file."""
+        try:
+            with open(batch_path, 'r') as f:
+                apps = json.load(f)
+            if not isinstance(apps, list) or not apps:
+                raise ValueError('expected a non empty list of apps')
+            return [
+                self._parser.parse_args(shared_args + [
+                    '--directory', app['directory'], '--name', app['name']
+                ]) for app in apps
+            ]
+        except (IOError, ValueError, KeyError, TypeError) as e:
+            self._parser.error('invalid batch file %s: %s' % (batch_path, e))
+
+    def Build(self, apps):
+        builder.KeepWarm()
+        layers = collections.OrderedDict()
+        pushed = []
+        for app_args in apps:
+            logger.preamble(self._runtime, app_args)
+            with ftl_util.Timing('build of %s' % app_args.name):
+                ftl = self._builder_cls(
+                    context.Workspace(app_args.directory), app_args)
+                ftl.ShareLayers(layers)
+                ftl.MountFrom(pushed)
+                try:
+                    if app_args.plan:
+                        ftl.Plan()
+                        continue
+                    ftl.Build()
+                finally:
+                    self._evict(layers)
+            pushed.append(docker_name.Tag(app_args.name, strict=False))
+
+    def _evict(self, layers):
+        # the evicted layers are still found in the cache the apps use
+        while len(layers) > self._max_shared_layers:
+            layers.popitem(last=False)
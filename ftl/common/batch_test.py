@@ -0,0 +1,108 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Unit tests for batch.py"""
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import batch
+
+
+class _FakeBuilder(object):
+    built = []
+
+    def __init__(self, ctx, args):
+        self.args = args
+        self.layers = None
+        self.mounts = []
+
+    def ShareLayers(self, layers):
+        self.layers = layers
+
+    def MountFrom(self, names):
+        self.mounts.extend(str(name) for name in names)
+
+    def Build(self):
+        self.layers.setdefault('interpreter', self.args.name)
+        self.layers[self.args.name] = self.args.name
+        _FakeBuilder.built.append(self)
+
+
+class BatchTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.batch_path = os.path.join(self.tmp_dir, 'batch.json')
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--name', required=True)
+        parser.add_argument('--directory', required=True)
+        parser.add_argument('--base', required=True)
+        parser.add_argument('--verbosity', default='NOTSET')
+        parser.add_argument('--plan', action='store_true', default=False)
+        self.batch = batch.Batch('fake', parser, _FakeBuilder)
+        _FakeBuilder.built = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _write(self, apps):
+        with open(self.batch_path, 'w') as f:
+            json.dump(apps, f)
+
+    def test_build_shares_layers_and_mounts(self):
+        self._write([{
+            'directory': self.tmp_dir,
+            'name': 'gcr.io/test/one:latest'
+        }, {
+            'directory': self.tmp_dir,
+            'name': 'gcr.io/test/two:latest'
+        }])
+        apps = self.batch.ReadApps(self.batch_path,
+                                   ['--base', 'gcr.io/test/base'])
+        self.assertEqual([app.base for app in apps], ['gcr.io/test/base'] * 2)
+
+        self.batch.Build(apps)
+        one, two = _FakeBuilder.built
+        self.assertIs(one.layers, two.layers)
+        self.assertEqual(two.layers['interpreter'], 'gcr.io/test/one:latest')
+        self.assertEqual(one.mounts, [])
+        self.assertEqual(len(two.mounts), 1)
+        self.assertIn('one', two.mounts[0])
+
+    def test_build_keeps_recent_layers(self):
+        self.batch._max_shared_layers = 2
+        self._write([{
+            'directory': self.tmp_dir,
+            'name': name
+        } for name in ['gcr.io/test/one', 'gcr.io/test/two']])
+        self.batch.Build(
+            self.batch.ReadApps(self.batch_path, ['--base', 'b']))
+        self.assertEqual(
+            list(_FakeBuilder.built[-1].layers),
+            ['gcr.io/test/one', 'gcr.io/test/two'])
+
+    def test_invalid_batch_file(self):
+        self._write({'directory': self.tmp_dir})
+        with self.assertRaises(SystemExit):
+            self.batch.ReadApps(self.batch_path, ['--base', 'b'])
+        self._write([{'directory': self.tmp_dir}])
+        with self.assertRaises(SystemExit):
+            self.batch.ReadApps(self.batch_path, ['--base', 'b'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -13,21 +13,34 @@
 # limitations under the License.
 
 import abc
+import collections
 import datetime
+import hashlib
+import json
+import os
+import sys
 import tarfile
+import threading
+import time
 import logging
 import httplib2
 
 from containerregistry.client import docker_creds
 from containerregistry.client import docker_name
+from containerregistry.client.v2_2 import docker_digest
 from containerregistry.client.v2_2 import docker_image
 from containerregistry.client.v2_2 import docker_session
 from containerregistry.client.v2_2 import save
 from containerregistry.transport import transport_pool
 
 from ftl.common import cache
+from ftl.common import concurrency
 from ftl.common import constants
 from ftl.common import ftl_util
+from ftl.common import history
+from ftl.common import image_descriptor
+from ftl.common import mapped_tarball
+from ftl.common import oci_layout
 
 # Do not Remove. Fix for strptime not being thread safe.
 # Initialize datetime in the base class RuntimeBase. The Build calls
@@ -35,6 +48,68 @@ from ftl.common import ftl_util
 # See http://bugs.python.org/issue7980
 datetime.datetime.strptime('', '')
 
+# State that outlives a single build. A one-shot build only fills it once,
+# the daemon keeps it warm across builds.
+_warm_lock = threading.Lock()
+_transport = None
+_creds = {}
+# Base images by name, only memoized once KeepWarm has been called.
+_base_images = None
+
+
+def KeepWarm():
+    """Memoizes base images across builds for
+    constants.BASE_IMAGE_MEMO_SECONDS, for use in long-running processes."""
+    global _base_images
+    with _warm_lock:
+        if _base_images is None:
+            _base_images = {}
+
+
+def _shared_transport():
+    global _transport
+    with _warm_lock:
+        if _transport is None:
+            _transport = transport_pool.Http(
+                httplib2.Http, size=concurrency.network().capacity)
+        return _transport
+
+
+def _resolve_creds(name):
+    with _warm_lock:
+        if name.registry not in _creds:
+            _creds[name.registry] = docker_creds.DefaultKeychain.Resolve(name)
+        return _creds[name.registry]
+
+
+def _open_base_image(args, name, creds, transport):
+    if args.tar_base_image_path:
+        key = (args.tar_base_image_path,
+               os.path.getmtime(args.tar_base_image_path))
+    else:
+        key = str(name)
+    with _warm_lock:
+        if _base_images is not None and key in _base_images:
+            opened, img = _base_images[key]
+            if time.time() - opened < constants.BASE_IMAGE_MEMO_SECONDS:
+                return img
+    if args.tar_base_image_path:
+        img = mapped_tarball.FromMappedTarball(args.tar_base_image_path)
+    else:
+        img = docker_image.FromRegistry(name, creds, transport)
+    img.__enter__()
+    with _warm_lock:
+        if _base_images is not None:
+            _base_images[key] = (time.time(), img)
+    return img
+
+
+def _run_step(name, step, dependencies):
+    for dependency in dependencies:
+        dependency.result()
+    logging.info('Starting build step %s', name)
+    step()
+
 
 class Base(object):
     """Base is an abstract base class representing a container builder.
@@ -85,22 +160,23 @@ class RuntimeBase(JustApp):
             args.exposed_ports = args.exposed_ports.split(",")
         args.cache_key_version = "%s %s" % (args.cache_key_version,
                                             args.cache_salt)
+        layer_compression = args.layer_compression
+        if layer_compression == constants.ZSTD and args.output_path:
+            logging.info('docker tarballs only hold gzip layers, '
+                         'ignoring --layer-compression=zstd')
+            layer_compression = constants.GZIP
+        if layer_compression != constants.GZIP:
+            # these layers must not be mixed up with gzip ones in the cache
+            args.cache_key_version = "%s %s" % (args.cache_key_version,
+                                                layer_compression)
         self._args = args
         self._base_name = docker_name.Tag(self._args.base, strict=False)
-        self._base_creds = docker_creds.DefaultKeychain.Resolve(
-            self._base_name)
+        self._base_creds = _resolve_creds(self._base_name)
         self._target_image = docker_name.Tag(self._args.name, strict=False)
-        self._target_creds = docker_creds.DefaultKeychain.Resolve(
-            self._target_image)
-        self._transport = transport_pool.Http(
-            httplib2.Http, size=constants.THREADS)
-        if args.tar_base_image_path:
-            self._base_image = docker_image.FromTarball(
-                args.tar_base_image_path)
-        else:
-            self._base_image = docker_image.FromRegistry(
-                self._base_name, self._base_creds, self._transport)
-        self._base_image.__enter__()
+        self._target_creds = _resolve_creds(self._target_image)
+        self._transport = _shared_transport()
+        self._base_image = _open_base_image(args, self._base_name,
+                                            self._base_creds, self._transport)
         cache_repo = args.cache_repository
         if not cache_repo:
             cache_repo = self._target_image.as_repository()
@@ -114,18 +190,217 @@ class RuntimeBase(JustApp):
             creds=self._target_creds,
             transport=self._transport,
             ttl=ttl,
-            threads=constants.THREADS,
+            threads=concurrency.network().capacity,
             mount=[self._base_name],
             use_global=args.global_cache,
             should_cache=args.cache,
             should_upload=args.upload)
+        self._ttl = ttl
+        # the created time of a reproducible image is SOURCE_DATE_EPOCH, so
+        # memos expire through their key instead, see _build_memo_key
+        self._build_cache = cache.Registry(
+            repo=cache_repo,
+            namespace=constants.BUILD_CACHE_NAMESPACE.format(
+                namespace=self._cache_namespace),
+            creds=self._target_creds,
+            transport=self._transport,
+            ttl=None,
+            threads=concurrency.network().capacity,
+            mount=[self._base_name, self._target_image],
+            should_cache=args.cache and args.build_cache,
+            should_upload=args.upload and args.build_cache)
         self._descriptor_files = descriptor_files
+        self._history = None
+        self._image_digest = None
+        self._layer_opts = ftl_util.LayerOptions(
+            compression=layer_compression,
+            compression_level=args.compression_level,
+            compression_threads=args.compression_threads,
+            prioritized_files=args.estargz_prioritized_files,
+            dedupe_files=args.dedupe_files)
+        self._mounts = []
 
     def Build(self):
         return
 
-    def StoreImage(self, result_image):
+    def _layer_builders(self):
+        """Returns the cacheable layer builders the build consists of."""
+        return []
+
+    def _layer_history(self):
+        if self._history is None:
+            self._history = history.LayerHistory(
+                os.path.expanduser(self._args.history_path))
+        return self._history
+
+    def _build_layer(self, layer_builder):
+        """Builds a layer, tracking its build time and size on cache miss."""
+        start = time.time()
+        layer_builder.BuildLayer()
+        if layer_builder.CacheHit() is False:
+            img = layer_builder.GetImage()
+            size = 0
+            if img:
+                descriptor = image_descriptor.describe(img)
+                size = sum(descriptor.size(digest)
+                           for digest in descriptor.fs_layers)
+            self._layer_history().Record(layer_builder.GetLayerName(),
+                                         layer_builder.GetCacheKey(),
+                                         time.time() - start, size)
+
+    def _build_steps(self, steps):
+        """Runs build steps, each as soon as the steps it depends on are
+        done, and returns once all are.
+
+        Args:
+          steps: (name, step, dependencies) tuples, step being called with
+            no arguments once the steps named in dependencies, which come
+            before it in the list, are done.
+        """
+        with ftl_util.ThreadPoolExecutor(max_workers=len(steps)) as executor:
+            futures = collections.OrderedDict()
+            for name, step, dependencies in steps:
+                futures[name] = executor.submit(
+                    _run_step, name, step,
+                    [futures[dep] for dep in dependencies])
+            for future in futures.values():
+                future.result()
+
+    def Plan(self):
+        """Writes the plan of the build to stdout as json."""
+        plan = self.GetPlan()
+        sys.stdout.write(json.dumps(
+            plan, indent=2, separators=(',', ': '), sort_keys=True) + '\n')
+        return plan
+
+    def GetPlan(self):
+        """Predicts which layers of the build will come from the cache and
+        what the misses cost, based on the layer history, without building
+        anything.
+
+        When the build would generate a lockfile its keys are not known, as
+        a plan does not run the package manager. Its hits are then reported
+        as None, unknown, and estimated as misses."""
+        layer_builders = self._layer_builders()
+        layer_history = self._layer_history()
+        keys_known = not self._generates_lock()
+
+        def probe(lyr):
+            if not keys_known:
+                return None, None
+            key = lyr.GetCacheKey()
+            return key, self._cache.Get(key) is not None
+
+        with ftl_util.Timing('probing_cache_for_plan'):
+            with ftl_util.ThreadPoolExecutor(
+                    max_workers=concurrency.network().capacity
+            ) as executor:
+                memo = None
+                if keys_known:
+                    memo = executor.submit(
+                        lambda: self._build_cache.Get(
+                            self._build_memo_key(layer_builders)))
+                probes = list(executor.map(probe, layer_builders))
+                build_cache_hit = None
+                if memo:
+                    build_cache_hit = memo.result() is not None
+
+        layers = []
+        for lyr, (key, hit) in zip(layer_builders, probes):
+            layer = {'name': lyr.GetLayerName(), 'key': key, 'hit': hit}
+            if not hit:
+                entry = layer_history.Get(layer['name']) or {}
+                layer['seconds'] = entry.get('seconds')
+                layer['size'] = entry.get('size')
+            layers.append(layer)
+        misses = [lyr for lyr in layers if lyr['hit'] is False]
+        unknown = [lyr for lyr in layers if lyr['hit'] is None]
+        plan = {
+            'build_cache_hit': build_cache_hit,
+            'layers': layers,
+            'hits': len(layers) - len(misses) - len(unknown),
+            'misses': len(misses),
+            'unknown': len(unknown),
+            'estimated_seconds':
+            0 if build_cache_hit else
+            sum(lyr['seconds'] or 0 for lyr in misses + unknown),
+        }
+        return plan
+
+    def _generates_lock(self):
+        """Whether the build generates the lockfile its layers are keyed
+        on, which a plan does not."""
+        return False
+
+    def _build_memo_key(self, layer_builders):
+        """Returns a key covering every input of the final image: the base
+        image, the cache key of every dependency layer and the contents of
+        the app (and additional) directory.
+
+        The key also holds the TTL period the build runs in, so a memo is
+        not reused past the TTL whatever created time its image has."""
+        with ftl_util.Timing('computing_build_memo_key'):
+            parts = [
+                docker_digest.SHA256(self._base_image.config_file()),
+                ftl_util.dir_hash(self._args.directory),
+                str(self._args.destination_path),
+                str(self._args.entrypoint),
+                str(self._args.exposed_ports),
+                str(ftl_util.source_date_epoch()),
+                str(self._args.max_layers),
+                str(self._args.layer_grouping),
+                self._args.cache_key_version,
+                str(int(time.time() // (self._ttl * 3600))),
+            ]
+            parts.extend(lyr.GetCacheKey() for lyr in layer_builders)
+            if self._args.additional_directory:
+                parts.append(self._args.additional_directory)
+                parts.append(
+                    ftl_util.dir_hash(self._args.additional_directory))
+            return hashlib.sha256(' '.join(parts)).hexdigest()
+
+    def _restore_build_memo(self, memo_key):
+        """Stores the image of a previous build with the same memo key as the
+        result of this build. Returns whether such an image existed."""
+        with ftl_util.Timing('checking_build_memo'):
+            memo_img = self._build_cache.Get(memo_key)
+        if not memo_img:
+            return False
+        logging.info('Found image built from identical inputs: %s',
+                     self._build_cache._tag(memo_key))
+        self.StoreImage(memo_img,
+                        mount=[self._build_cache._tag(memo_key)])
+        return True
+
+    def _store_build_memo(self, memo_key, result_image):
+        with ftl_util.Timing('uploading_build_memo'):
+            self._build_cache.Set(memo_key, result_image)
+
+    def ShareLayers(self, layers):
+        """Shares the dependency layers seen by this build with other builds
+        run by the same process through the layers dict."""
+        self._cache = cache.InMemory(self._cache, layers)
+
+    def MountFrom(self, names):
+        """Adds repositories the final image may mount blobs from."""
+        self._mounts.extend(names)
+
+    def GetImageDigest(self):
+        """Returns the digest of the image stored by the build, or None."""
+        return self._image_digest
+
+    def StoreImage(self, result_image, mount=None):
+        self._image_digest = result_image.digest()
         with ftl_util.Timing('Uploading final image'):
+            if self._args.oci_layout_path:
+                with ftl_util.Timing('Writing OCI image layout'):
+                    oci_layout.Write(self._args.oci_layout_path,
+                                     result_image,
+                                     str(self._target_image))
+                    logging.info('{0} written to OCI image layout {1}'.format(
+                        str(self._target_image),
+                        self._args.oci_layout_path))
+                return
             if self._args.output_path:
                 with ftl_util.Timing('Saving tarball image'):
                     with tarfile.open(
@@ -135,13 +410,14 @@ class RuntimeBase(JustApp):
                         str(self._target_image), self._args.output_path))
                 return
             if self._args.upload:
+                mount = [self._base_name] + self._mounts + (mount or [])
                 with ftl_util.Timing('Pushing image to Docker registry'):
                     with docker_session.Push(
                             self._target_image,
                             self._target_creds,
                             self._transport,
-                            threads=constants.THREADS,
-                            mount=[self._base_name]) as session:
+                            threads=concurrency.network().capacity,
+                            mount=mount) as session:
                         logging.info('Pushing final image...')
                         session.upload(result_image)
                     return
@@ -61,6 +61,28 @@ class JustAppTest(unittest.TestCase):
                 tar_path = os.path.join('srv/.', p)
                 self.assertEquals(tf.extractfile(tar_path).read(), f)
 
+    def test_build_app_layer_excludes_top_level_paths(self):
+        tmp_dir = gen_tmp_dir("excludetest")
+        for name in ['app.js', 'node_modules/dep/index.js',
+                     'lib/node_modules/keep.js']:
+            path = os.path.join(tmp_dir, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, "w") as f:
+                f.write(name)
+
+        app_builder = layer_builder.AppLayerBuilder(
+            tmp_dir, exclude=['node_modules'])
+        app_builder.BuildLayer()
+        app_layer = app_builder.GetImage().GetFirstBlob()
+        with tarfile.open(
+                fileobj=cStringIO.StringIO(app_layer), mode='r:gz') as tf:
+            names = tf.getnames()
+        self.assertIn('srv/./app.js', names)
+        self.assertIn('srv/./lib/node_modules/keep.js', names)
+        self.assertFalse([n for n in names
+                          if n.startswith('srv/./node_modules')])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -60,11 +60,47 @@ class Base(object):
         """
 
 
+class InMemory(Base):
+    """InMemory is a cache that remembers the images it sees in front of
+    another cache.
+
+    Builds run by one process share the entries dict, so each layer is only
+    looked up or built once across them. Entries are kept in the order they
+    were last used, for an ordered dict to drop the least recently used.
+    """
+
+    def __init__(self, cache, entries):
+        super(InMemory, self).__init__()
+        self._cache = cache
+        self._entries = entries
+
+    def __enter__(self):
+        return self
+
+    def Get(self, cache_key):
+        if cache_key in self._entries:
+            logging.info('Found layer built in this process for %s' %
+                         cache_key)
+            hit = self._entries.pop(cache_key)
+            self._entries[cache_key] = hit
+            return hit
+        hit = self._cache.Get(cache_key)
+        if hit:
+            self._entries[cache_key] = hit
+        return hit
+
+    def Set(self, cache_key, value):
+        self._cache.Set(cache_key, value)
+        self._entries[cache_key] = value
+
+
 class Registry(Base):
     """Registry is a cache implementation that stores layers in a registry.
 
     It stores layers under a 'namespace', with a tag derived from the layer
     cache_key. For example: gcr.io/$repo/$namespace:$cache_key
+
+    Entries created more than ttl hours ago are misses, unless ttl is None.
     """
 
     def __init__(
@@ -114,7 +150,7 @@ class Registry(Base):
         if hit:
             logging.info('Found cached dependency layer for %s' % cache_key)
             try:
-                if Registry.checkTTL(hit, self._ttl):
+                if self._ttl is None or Registry.checkTTL(hit, self._ttl):
                     return hit
                 else:
                     logging.info(
@@ -158,6 +194,9 @@ class Registry(Base):
         if not self._should_upload:
             logging.info("--no-upload flag set, images won't be pushed")
             return
+        # a push cannot be stopped halfway, so do not start one for a build
+        # that already failed
+        ftl_util.check_cancelled()
         entry = self._tag(cache_key)
         with docker_session.Push(
                 entry,
@@ -13,10 +13,14 @@
 # limitations under the License.
 """Unit tests for cache.py"""
 
+import collections
+import json
+import os
 import unittest
 import cache
 import mock
 import constants
+import ftl_util
 
 
 class RegistryTest(unittest.TestCase):
@@ -52,6 +56,78 @@ class RegistryTest(unittest.TestCase):
             ttl=constants.DEFAULT_TTL_HOURS)
         self.assertIsNone(c._getEntry('abc123'))
 
+    @mock.patch('containerregistry.client.v2_2.docker_session.Push')
+    @mock.patch('containerregistry.client.v2_2.docker_image.FromRegistry')
+    def test_build_memo_with_source_date_epoch(self, mock_from, mock_push):
+        pushed = {}
+
+        def push(entry, *args, **kwargs):
+            session = mock.MagicMock()
+            session.__enter__.return_value.upload.side_effect = (
+                lambda img: pushed.update({str(entry): img}))
+            return session
+
+        def pull(entry, *args):
+            img = mock.MagicMock()
+            img.__enter__.return_value = pushed.get(str(entry))
+            return img
+
+        mock_push.side_effect = push
+        mock_from.side_effect = pull
+        memo_img = mock.Mock()
+        memo_img.exists.return_value = True
+
+        def memo_cache(ttl):
+            return cache.Registry(
+                repo='fake.gcr.io/google-appengine',
+                namespace='namespace-builds',
+                creds=None,
+                transport=None,
+                ttl=ttl)
+
+        with mock.patch.dict(os.environ, {constants.SOURCE_DATE_EPOCH: '1'}):
+            memo_img.config_file.return_value = json.dumps({
+                'created':
+                ftl_util.epoch_to_timestamp(ftl_util.source_date_epoch())
+            })
+            memo_cache(None).Set('memo', memo_img)
+            self.assertEquals(memo_cache(None).Get('memo'), memo_img)
+            # the created time is all a ttl could go by
+            self.assertIsNone(
+                memo_cache(constants.DEFAULT_TTL_HOURS).Get('memo'))
+
+
+class InMemoryTest(unittest.TestCase):
+    def test_shared_entries(self):
+        entries = {}
+        registry = mock.Mock()
+        registry.Get.return_value = None
+        first = cache.InMemory(registry, entries)
+        second = cache.InMemory(registry, entries)
+
+        self.assertIsNone(first.Get('abc123'))
+        img = mock.Mock()
+        first.Set('abc123', img)
+        registry.Set.assert_called_once_with('abc123', img)
+
+        # the second build finds the layer without asking the registry
+        registry.Get.reset_mock()
+        self.assertEquals(second.Get('abc123'), img)
+        registry.Get.assert_not_called()
+
+        registry.Get.return_value = img
+        self.assertEquals(second.Get('def456'), img)
+        self.assertEquals(entries['def456'], img)
+
+    def test_entries_in_use_order(self):
+        entries = collections.OrderedDict()
+        registry = mock.Mock()
+        in_memory = cache.InMemory(registry, entries)
+        in_memory.Set('abc123', 'first')
+        in_memory.Set('def456', 'second')
+        self.assertEqual(in_memory.Get('abc123'), 'first')
+        self.assertEqual(list(entries), ['def456', 'abc123'])
+
 
 if __name__ == '__main__':
     unittest.main()
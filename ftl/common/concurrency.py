@@ -0,0 +1,222 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""This package defines how much work of each kind FTL runs at once.
+
+There are three budgets, sized from the cgroup limits of the build:
+  cpu: subprocesses such as pip, npm, composer and tar, one per cpu.
+  memory: layers assembled in memory, one per LAYER_ASSEMBLY_BYTES.
+  network: registry requests, NETWORK_THREADS.
+The cpu and memory budgets shrink while the cgroup is close to its memory
+limit and grow back once it is not.
+"""
+
+import contextlib
+import logging
+import math
+import os
+import threading
+import time
+
+from ftl.common import constants
+
+# cgroup v1 reports no limit as a huge number
+_NO_LIMIT = 1 << 60
+
+
+def _read(root, *paths):
+    """Returns the stripped contents of the first readable file, or None."""
+    for path in paths:
+        try:
+            with open(os.path.join(root, path), 'r') as f:
+                return f.read().strip()
+        except (IOError, OSError):
+            continue
+    return None
+
+
+def cpu_limit(root=constants.CGROUP_ROOT):
+    """Returns the number of cpus the build may use."""
+    cpus = os.sysconf('SC_NPROCESSORS_ONLN')
+    quota = period = None
+    cpu_max = _read(root, 'cpu.max')
+    if cpu_max:
+        # cgroup v2: "<quota> <period>", quota being "max" without limit
+        fields = cpu_max.split()
+        if fields[0] != 'max':
+            quota, period = int(fields[0]), int(fields[1])
+    else:
+        cfs_quota = _read(root, 'cpu/cpu.cfs_quota_us',
+                          'cpu,cpuacct/cpu.cfs_quota_us')
+        cfs_period = _read(root, 'cpu/cpu.cfs_period_us',
+                           'cpu,cpuacct/cpu.cfs_period_us')
+        if cfs_quota and cfs_period and int(cfs_quota) > 0:
+            quota, period = int(cfs_quota), int(cfs_period)
+    if quota:
+        cpus = min(cpus, int(math.ceil(float(quota) / period)))
+    return max(1, cpus)
+
+
+def memory_limit(root=constants.CGROUP_ROOT):
+    """Returns the bytes of memory the build may use."""
+    limit = _read(root, 'memory.max', 'memory/memory.limit_in_bytes')
+    if limit and limit != 'max' and int(limit) < _NO_LIMIT:
+        return int(limit)
+    return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
+def memory_usage(root=constants.CGROUP_ROOT):
+    """Returns the bytes of memory the build uses, or None if unknown.
+
+    The cgroup counts the page cache of the files the build reads and
+    writes too. Its inactive part is reclaimed before the build runs out
+    of memory, so like the kernel's working set it is not counted."""
+    usage = _read(root, 'memory.current', 'memory/memory.usage_in_bytes')
+    if usage:
+        stat = _read(root, 'memory.stat', 'memory/memory.stat') or ''
+        fields = dict(
+            line.split()[:2] for line in stat.splitlines()
+            if len(line.split()) >= 2)
+        # cgroup v1 names the counter of the whole hierarchy total_*
+        inactive_file = fields.get('total_inactive_file',
+                                   fields.get('inactive_file', 0))
+        return max(0, int(usage) - int(inactive_file))
+    meminfo = _read('/proc', 'meminfo')
+    if not meminfo:
+        return None
+    fields = dict(
+        (line.split(':')[0], int(line.split()[1]) * 1024)
+        for line in meminfo.splitlines() if line.endswith('kB'))
+    if 'MemTotal' not in fields or 'MemAvailable' not in fields:
+        return None
+    return fields['MemTotal'] - fields['MemAvailable']
+
+
+class MemoryPressure(object):
+    """MemoryPressure samples how close the build is to its memory limit,
+    at most every MEMORY_PRESSURE_INTERVAL_SECONDS."""
+
+    def __init__(self, root=constants.CGROUP_ROOT):
+        self._root = root
+        self._limit = memory_limit(root)
+        self._lock = threading.Lock()
+        self._sampled = None
+        self._ratio = 0.0
+
+    def Ratio(self):
+        """Returns the memory used over the memory limit."""
+        with self._lock:
+            now = time.time()
+            interval = constants.MEMORY_PRESSURE_INTERVAL_SECONDS
+            if self._sampled is None or now - self._sampled >= interval:
+                self._sampled = now
+                usage = memory_usage(self._root)
+                if usage is not None:
+                    self._ratio = float(usage) / self._limit
+            return self._ratio
+
+
+class Budget(object):
+    """Budget bounds how many operations of one kind run at once.
+
+    With a memory pressure, the number of slots is halved whenever the
+    pressure is above MEMORY_PRESSURE_HIGH and grows by one whenever it is
+    below MEMORY_PRESSURE_LOW, never going under one nor over the capacity.
+    Operations already running are not interrupted.
+    """
+
+    def __init__(self, name, capacity, pressure=None):
+        self._name = name
+        self._capacity = max(1, capacity)
+        self._limit = self._capacity
+        self._pressure = pressure
+        self._running = 0
+        self._cond = threading.Condition()
+
+    @property
+    def capacity(self):
+        """The most slots the budget can have, to size thread pools."""
+        return self._capacity
+
+    @property
+    def limit(self):
+        """The slots the budget has now."""
+        with self._cond:
+            return self._limit
+
+    def _adapt(self):
+        if self._pressure is None:
+            return
+        ratio = self._pressure.Ratio()
+        limit = self._limit
+        if ratio >= constants.MEMORY_PRESSURE_HIGH:
+            limit = max(1, limit // 2)
+        elif ratio < constants.MEMORY_PRESSURE_LOW:
+            limit = min(self._capacity, limit + 1)
+        if limit != self._limit:
+            logging.info('%s budget: %d slots at %d%% memory use', self._name,
+                         limit, ratio * 100)
+            self._limit = limit
+            self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def Slot(self):
+        """Holds a slot of the budget, waiting for one if needed."""
+        with self._cond:
+            self._adapt()
+            while self._running >= self._limit:
+                # wake up now and then to notice the pressure going down
+                self._cond.wait(constants.MEMORY_PRESSURE_INTERVAL_SECONDS)
+                self._adapt()
+            self._running += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._running -= 1
+                self._cond.notify()
+
+
+_budgets_lock = threading.RLock()
+_budgets = {}
+
+
+def _budget(name, new):
+    with _budgets_lock:
+        if name not in _budgets:
+            _budgets[name] = new()
+        return _budgets[name]
+
+
+def _pressure():
+    return _budget('pressure', MemoryPressure)
+
+
+def cpu():
+    """The budget of cpu bound subprocesses."""
+    return _budget('cpu', lambda: Budget('cpu', cpu_limit(), _pressure()))
+
+
+def memory():
+    """The budget of layers assembled in memory."""
+    return _budget(
+        'memory', lambda: Budget(
+            'memory',
+            min(memory_limit() // constants.LAYER_ASSEMBLY_BYTES,
+                constants.NETWORK_THREADS), _pressure()))
+
+
+def network():
+    """The budget of registry requests."""
+    return _budget('network',
+                   lambda: Budget('network', constants.NETWORK_THREADS))
@@ -0,0 +1,132 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Unit tests for concurrency.py"""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import concurrency
+
+
+class FakePressure(object):
+    def __init__(self, ratio):
+        self.ratio = ratio
+
+    def Ratio(self):
+        return self.ratio
+
+
+class ConcurrencyTest(unittest.TestCase):
+    def setUp(self):
+        self._root = tempfile.mkdtemp()
+        self._cpus = os.sysconf('SC_NPROCESSORS_ONLN')
+
+    def tearDown(self):
+        shutil.rmtree(self._root)
+
+    def _write(self, path, content):
+        path = os.path.join(self._root, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def test_cgroup_v2_limits(self):
+        self._write('cpu.max', '50000 100000\n')
+        self._write('memory.max', '1073741824\n')
+        self._write('memory.current', '536870912\n')
+        self.assertEqual(1, concurrency.cpu_limit(self._root))
+        self.assertEqual(1 << 30, concurrency.memory_limit(self._root))
+        self.assertEqual(1 << 29, concurrency.memory_usage(self._root))
+
+        # most of it is page cache the kernel can reclaim
+        self._write('memory.stat', 'anon 134217728\n'
+                    'file 402653184\n'
+                    'active_file 0\n'
+                    'inactive_file 402653184\n')
+        self.assertEqual(1 << 27, concurrency.memory_usage(self._root))
+
+    def test_cgroup_v1_limits(self):
+        self._write('cpu/cpu.cfs_quota_us', '150000\n')
+        self._write('cpu/cpu.cfs_period_us', '100000\n')
+        self._write('memory/memory.limit_in_bytes', '2147483648\n')
+        self.assertEqual(
+            min(2, self._cpus), concurrency.cpu_limit(self._root))
+        self.assertEqual(1 << 31, concurrency.memory_limit(self._root))
+
+        self._write('memory/memory.usage_in_bytes', '1073741824\n')
+        self._write('memory/memory.stat', 'cache 805306368\n'
+                    'rss 268435456\n'
+                    'inactive_file 0\n'
+                    'total_cache 805306368\n'
+                    'total_rss 268435456\n'
+                    'total_inactive_file 805306368\n')
+        self.assertEqual(1 << 28, concurrency.memory_usage(self._root))
+
+    def test_no_cgroup_limits(self):
+        self._write('cpu.max', 'max 100000\n')
+        self._write('memory.max', 'max\n')
+        self.assertEqual(self._cpus, concurrency.cpu_limit(self._root))
+        self.assertEqual(
+            os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE'),
+            concurrency.memory_limit(self._root))
+
+    def test_budget_limits_slots(self):
+        budget = concurrency.Budget('test', 2)
+        lock = threading.Lock()
+        running = [0, 0]
+
+        def work():
+            with budget.Slot():
+                with lock:
+                    running[0] += 1
+                    running[1] = max(running)
+                time.sleep(0.05)
+                with lock:
+                    running[0] -= 1
+
+        threads = [threading.Thread(target=work) for _ in range(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(2, running[1])
+
+    def test_budget_adapts_to_pressure(self):
+        pressure = FakePressure(0.9)
+        budget = concurrency.Budget('test', 8, pressure)
+        with budget.Slot():
+            pass
+        self.assertEqual(4, budget.limit)
+        with budget.Slot():
+            pass
+        self.assertEqual(2, budget.limit)
+        pressure.ratio = 0.7
+        with budget.Slot():
+            pass
+        self.assertEqual(2, budget.limit)
+        pressure.ratio = 0.1
+        for _ in range(10):
+            with budget.Slot():
+                pass
+        self.assertEqual(8, budget.limit)
+        self.assertEqual(8, budget.capacity)
+
+
+if __name__ == '__main__':
+    unittest.main()
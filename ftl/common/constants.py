@@ -17,8 +17,68 @@ DEFAULT_LOG_LEVEL = 'NOTSET'
 DEFAULT_DESTINATION_PATH = 'srv'
 DEFAULT_ENTRYPOINT = None
 
-# docker transport thread config
-THREADS = 32
+# concurrency config
+# registry requests in flight at once: pulls, pushes and cache lookups
+NETWORK_THREADS = 32
+# memory set aside for each layer assembled at once
+LAYER_ASSEMBLY_BYTES = 512 * 1024 * 1024
+# where the cgroup limits of the build are read from
+CGROUP_ROOT = '/sys/fs/cgroup'
+# memory use over the memory limit past which cpu and memory budgets shrink
+MEMORY_PRESSURE_HIGH = 0.85
+# memory use over the memory limit under which they grow back
+MEMORY_PRESSURE_LOW = 0.6
+# memory use is sampled at most this often
+MEMORY_PRESSURE_INTERVAL_SECONDS = 1
+
+# layer compression config
+GZIP = 'gzip'
+ZSTD = 'zstd'
+ESTARGZ = 'estargz'
+LAYER_COMPRESSIONS = [GZIP, ZSTD, ESTARGZ]
+ZSTD_MAGIC = '\x28\xb5\x2f\xfd'
+# gzip level of the layers FTL produces, 1 matches `gzip -1`
+DEFAULT_COMPRESSION_LEVEL = 1
+# layers are deflated in blocks of this size in parallel
+COMPRESSION_BLOCK_SIZE = 1024 * 1024
+# files in estargz layers are split into gzip members of this size
+ESTARGZ_CHUNK_SIZE = 4 * 1024 * 1024
+
+# layer grouping config, package layers past the cap are merged into groups
+DEFAULT_MAX_LAYERS = 100
+# groups layers whose cache keys changed as often, sized evenly
+CHURN_GROUPING = 'churn'
+# groups layers in their build order, sized evenly
+SIZE_GROUPING = 'size'
+# groups layers in their build order, split where the cache keys say
+KEY_GROUPING = 'key'
+LAYER_GROUPINGS = [CHURN_GROUPING, SIZE_GROUPING, KEY_GROUPING]
+
+# OCI media types, used once an image has zstd layers
+OCI_CONFIG_MIME = 'application/vnd.oci.image.config.v1+json'
+OCI_LAYER_GZIP_MIME = 'application/vnd.oci.image.layer.v1.tar+gzip'
+OCI_LAYER_ZSTD_MIME = 'application/vnd.oci.image.layer.v1.tar+zstd'
+OCI_NONDISTRIBUTABLE_LAYER_MIME = \
+    'application/vnd.oci.image.layer.nondistributable.v1.tar+gzip'
+DOCKER_FOREIGN_LAYER_MIME = \
+    'application/vnd.docker.image.rootfs.foreign.diff.tar.gzip'
+
+# daemon config
+# how long the daemon reuses a base image's manifest and config
+BASE_IMAGE_MEMO_SECONDS = 300
+# builds the daemon runs at once, further requests wait for a slot
+DAEMON_MAX_BUILDS = 4
+# dependency layers a batch keeps for the apps after the one that used them,
+# the least recently used are dropped past it
+BATCH_SHARED_LAYERS = 64
+
+# run_command config
+# lines of stdout and stderr kept to report a failed command
+COMMAND_TAIL_LINES = 200
+# longer output lines are split
+COMMAND_MAX_LINE_BYTES = 64 * 1024
+# how often a running command logs its progress
+COMMAND_PROGRESS_SECONDS = 10
 
 # ftl version
 FTL_VERSION = "v0.12.0"
@@ -27,6 +87,9 @@ FTL_VERSION = "v0.12.0"
 BUILDER_OUTPUT = 'BUILDER_OUTPUT'
 BUILDER_OUTPUT_FILE = 'output'
 
+# reproducible builds env option, see https://reproducible-builds.org/specs/
+SOURCE_DATE_EPOCH = 'SOURCE_DATE_EPOCH'
+
 # Google Cloud Builder Args
 GLOBAL_CACHE_REGISTRY = 'gcr.io/ftl-global-cache'
 
@@ -42,6 +105,9 @@ YARN_LOCK = 'yarn.lock'
 PACKAGE_JSON = 'package.json'
 NODE_DEFAULT_ENTRYPOINT = 'node server.js'
 NPMRC = '.npmrc'
+# npm and yarn keep the packages they download here
+NODE_PACKAGE_STORE_DIR = '~/.ftl/node-packages'
+NODE_PACKAGE_STORE_MAX_MB = 4096
 
 # python constants
 PIPFILE_LOCK = 'Pipfile.lock'
@@ -54,9 +120,15 @@ PIP_DEFAULT_CMD = 'pip'
 PYTHON_DEFAULT_CMD = 'python2.7'
 VIRTUALENV_DEFAULT_CMD = 'virtualenv'
 VENV_DEFAULT_CMD = None
+# virtualenvs are copied from templates kept here
+VIRTUALENV_TEMPLATE_DIR = '~/.ftl/virtualenvs'
 PIP_OPTIONS = ['--disable-pip-version-check']
 
+# layer history constants
+LAYER_HISTORY_PATH = '~/.ftl/layer_history.json'
+
 # cache constants
+BUILD_CACHE_NAMESPACE = '{namespace}-builds'
 DEFAULT_TTL_HOURS = 168  # hrs in a week
 MINIMUM_TTL_HOURS = 6    # 6 hrs in terms of weeks
 
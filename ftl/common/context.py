@@ -99,3 +99,31 @@ class Memory(Base):
 
     def GetFile(self, filename):
         return self._files[filename]
+
+
+class Overlay(Base):
+    """Overlay is a context implementation showing files kept in memory over
+    those of another context, which is left as it is."""
+
+    def __init__(self, ctx):
+        self._ctx = ctx
+        self._files = {}
+
+    def AddFile(self, filename, contents):
+        self._files[filename] = contents
+
+    def Contains(self, relative_path):
+        return (relative_path in self._files
+                or self._ctx.Contains(relative_path))
+
+    def ListFiles(self):
+        for path in self._files:
+            yield path
+        for path in self._ctx.ListFiles():
+            if path not in self._files:
+                yield path
+
+    def GetFile(self, filename):
+        if filename in self._files:
+            return self._files[filename]
+        return self._ctx.GetFile(filename)
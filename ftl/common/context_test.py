@@ -53,5 +53,22 @@ class WorkspaceTest(unittest.TestCase):
         self.assertTrue(self.workspace.Contains(p))
 
 
+class OverlayTest(unittest.TestCase):
+    def test_overlay(self):
+        ctx = context.Memory()
+        ctx.AddFile('package.json', '{}')
+        overlay = context.Overlay(ctx)
+        overlay.AddFile('package-lock.json', 'lock')
+        overlay.AddFile('package.json', '{"name": "app"}')
+
+        self.assertTrue(overlay.Contains('package-lock.json'))
+        self.assertEqual(overlay.GetFile('package.json'), '{"name": "app"}')
+        self.assertEqual(
+            sorted(overlay.ListFiles()), ['package-lock.json', 'package.json'])
+        # the context underneath is left as it is
+        self.assertFalse(ctx.Contains('package-lock.json'))
+        self.assertEqual(ctx.GetFile('package.json'), '{}')
+
+
 if __name__ == '__main__':
     unittest.main()
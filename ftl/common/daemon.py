@@ -0,0 +1,266 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""This package defines a daemon that serves builds over a unix socket.
+
+A request is a single json line {"args": [<cli args>], "env": {...}}, env
+optionally setting (or with null unsetting) the environment variables of
+the build, such as SOURCE_DATE_EPOCH. The daemon answers with json lines
+{"log": <line>} while the build runs, followed by a last line holding
+either {"digest": <digest>} or {"error": {...}}, along with the build time
+and the time spent in each command the build ran.
+"""
+
+import contextlib
+import json
+import logging
+import os
+import shutil
+import socket
+import SocketServer
+import tempfile
+import threading
+import time
+
+from ftl.common import builder
+from ftl.common import constants
+from ftl.common import context
+from ftl.common import ftl_error
+from ftl.common import ftl_util
+from ftl.common import logger
+
+
+class _Stream(object):
+    """_Stream writes json lines to a client, from any thread."""
+
+    def __init__(self, wfile):
+        self._wfile = wfile
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def Send(self, **msg):
+        with self._lock:
+            if self._closed:
+                return
+            try:
+                self._wfile.write(json.dumps(msg) + '\n')
+                self._wfile.flush()
+            except (IOError, socket.error):
+                # the client went away, the build still finishes
+                self._closed = True
+
+
+class _BuildLogHandler(logging.Handler):
+    """_BuildLogHandler sends log records to the client of the build that
+    emitted them, based on the log context of the emitting thread."""
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.setFormatter(logging.Formatter(logger.FORMAT))
+        self._builds_lock = threading.Lock()
+        self._builds = {}
+
+    def Register(self, build_id, stream, level):
+        with self._builds_lock:
+            self._builds[build_id] = (stream, level)
+
+    def Unregister(self, build_id):
+        with self._builds_lock:
+            self._builds.pop(build_id, None)
+
+    def emit(self, record):
+        build_id = ftl_util.log_context()
+        if build_id is None:
+            return
+        with self._builds_lock:
+            build = self._builds.get(build_id)
+        if build is None:
+            return
+        stream, level = build
+        if record.levelno >= level:
+            stream.Send(log=self.format(record))
+
+
+class _RequestHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        self.server.ftl_daemon.Handle(self.rfile, self.wfile)
+
+
+class _Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class Daemon(object):
+    """Daemon runs the builds of one runtime for as long as it lives, so
+    imports, the registry transport, credentials, base images and the
+    python version stay warm between builds.
+
+    Every build runs on a private copy of its directory, in the
+    environment of its request. Builds sharing a virtualenv directory run
+    one at a time, each on a new virtualenv as they all install into it.
+    The virtualenv is shipped at the path it was created at, so the python
+    builds of a daemon using the default /env do not run concurrently;
+    node and php builds do.
+    """
+
+    def __init__(self, runtime, parser, builder_cls,
+                 max_builds=constants.DAEMON_MAX_BUILDS):
+        self._runtime = runtime
+        self._parser = parser
+        self._builder_cls = builder_cls
+        self._slots = threading.BoundedSemaphore(max_builds)
+        self._log_handler = _BuildLogHandler()
+        self._lock = threading.Lock()
+        self._dir_locks = {}
+        self._build_count = 0
+
+    def Serve(self, socket_path):
+        builder.KeepWarm()
+        # every build picks its own verbosity, filtered by the log handler,
+        # the daemon's own log leaves out the debug records of the builds,
+        # such as every line the commands they run write
+        stderr = logging.StreamHandler()
+        stderr.setFormatter(logging.Formatter(logger.FORMAT))
+        stderr.setLevel(logging.INFO)
+        logging.getLogger().addHandler(stderr)
+        logging.getLogger().setLevel(logging.NOTSET)
+        logging.getLogger().addHandler(self._log_handler)
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = _Server(socket_path, _RequestHandler)
+        server.ftl_daemon = self
+        logging.info('FTL %s daemon listening on %s', self._runtime,
+                     socket_path)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.remove(socket_path)
+
+    def Handle(self, rfile, wfile):
+        stream = _Stream(wfile)
+        try:
+            request = json.loads(rfile.readline())
+            cli_args = request['args']
+            env = _build_env(request.get('env'))
+            build_args = self._parser.parse_args(cli_args)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            stream.Send(error=_error(ftl_error.FTLErrors.USER(),
+                                     'invalid build request: %s' % e))
+            return
+        except SystemExit:
+            # argparse exits on invalid arguments
+            stream.Send(error=_error(ftl_error.FTLErrors.USER(),
+                                     'invalid build arguments: %s' %
+                                     ' '.join(cli_args)))
+            return
+
+        with self._lock:
+            self._build_count += 1
+            build_id = self._build_count
+        self._log_handler.Register(build_id, stream,
+                                   logger.LEVEL_MAP[build_args.verbosity])
+        ftl_util.set_log_context(build_id)
+        ftl_util.set_build_env(env)
+        work_dir = tempfile.mkdtemp()
+        try:
+            with self._slots:
+                result = self._build(build_args, work_dir)
+        finally:
+            ftl_util.set_log_context(None)
+            ftl_util.set_build_env(None)
+            self._log_handler.Unregister(build_id)
+            shutil.rmtree(work_dir, ignore_errors=True)
+        stream.Send(**result)
+
+    def _build(self, build_args, work_dir):
+        start = time.time()
+        try:
+            logger.preamble(self._runtime, build_args)
+            if not os.path.isdir(build_args.directory):
+                raise ftl_error.UserError('directory %s does not exist' %
+                                          build_args.directory)
+            directory = os.path.join(work_dir, 'app')
+            shutil.copytree(build_args.directory, directory, symlinks=True)
+            build_args.directory = directory
+            virtualenv_dir = getattr(build_args, 'virtualenv_dir', None)
+            with self._exclusive(virtualenv_dir):
+                if virtualenv_dir and os.path.isdir(virtualenv_dir):
+                    # what an earlier build installed must not leak into
+                    # this one, the virtualenv is created (or cloned from
+                    # its template) again
+                    with ftl_util.Timing('removing_virtualenv'):
+                        shutil.rmtree(virtualenv_dir)
+                with ftl_util.Timing('full build'):
+                    ftl = self._builder_cls(
+                        context.Workspace(directory), build_args)
+                    if build_args.plan:
+                        result = {'plan': ftl.GetPlan()}
+                    else:
+                        ftl.Build()
+                        result = {'digest': ftl.GetImageDigest()}
+        except ftl_error.UserError as e:
+            logging.error(e)
+            result = {'error': _error(ftl_error.FTLErrors.USER(), str(e))}
+        except Exception as e:
+            logging.exception(e)
+            result = {'error': _error(ftl_error.FTLErrors.INTERNAL(), str(e))}
+        result['seconds'] = round(time.time() - start, 2)
+        result['commands'] = ftl_util.pop_command_metrics(
+            ftl_util.log_context())
+        return result
+
+    @contextlib.contextmanager
+    def _exclusive(self, path):
+        if not path:
+            yield
+            return
+        with self._lock:
+            lock = self._dir_locks.setdefault(path, threading.Lock())
+        with lock:
+            yield
+
+
+def _error(err_type, message):
+    return {
+        'errorType': err_type,
+        'errorId': ftl_error.genErrorId(message),
+        'errorMessage': message,
+    }
+
+
+def _build_env(request_env):
+    env = dict(os.environ)
+    for name, value in (request_env or {}).items():
+        if value is None:
+            env.pop(name, None)
+        else:
+            env[str(name)] = str(value)
+    return env
+
+
+def Request(socket_path, cli_args, env=None):
+    """Sends a build request to the daemon at socket_path and yields the
+    messages it answers with, the last one holding the result.
+
+    env holds the environment variables to set, or with None to unset, for
+    the build."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(socket_path)
+    try:
+        rfile = sock.makefile('r')
+        sock.sendall(json.dumps({'args': cli_args, 'env': env or {}}) + '\n')
+        for line in rfile:
+            yield json.loads(line)
+    finally:
+        sock.close()
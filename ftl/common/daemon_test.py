@@ -0,0 +1,152 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Unit tests for daemon.py"""
+
+import argparse
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import daemon
+
+
+class _FakeBuilder(object):
+    """Logs from its own and a worker thread and writes into its
+    directory, standing in for a runtime builder."""
+
+    def __init__(self, ctx, args):
+        self._args = args
+
+    def Build(self):
+        logging.info('building %s', self._args.name)
+        with daemon.ftl_util.ThreadPoolExecutor(max_workers=2) as executor:
+            executor.submit(logging.info, 'worker of %s',
+                            self._args.name).result()
+            self.epoch = executor.submit(
+                daemon.ftl_util.source_date_epoch).result()
+        if self._args.virtualenv_dir:
+            # left behind by an earlier build
+            self.leftovers = os.path.isdir(self._args.virtualenv_dir)
+            if not self.leftovers:
+                os.mkdir(self._args.virtualenv_dir)
+        with open(os.path.join(self._args.directory, 'output'), 'w') as f:
+            f.write(self._args.name)
+        time.sleep(0.1)
+
+    def GetImageDigest(self):
+        if self._args.virtualenv_dir:
+            return 'sha256:%s %s' % (self.epoch, self.leftovers)
+        return 'sha256:' + self._args.name
+
+
+class DaemonTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.app_dir = os.path.join(self.tmp_dir, 'app')
+        os.mkdir(self.app_dir)
+        self.socket_path = os.path.join(self.tmp_dir, 'ftl.sock')
+
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--name', required=True)
+        parser.add_argument('--directory', required=True)
+        parser.add_argument('--verbosity', default='NOTSET')
+        parser.add_argument('--plan', action='store_true', default=False)
+        parser.add_argument('--virtualenv-dir', default=None)
+        self.daemon = daemon.Daemon('fake', parser, _FakeBuilder)
+        server = threading.Thread(
+            target=self.daemon.Serve, args=(self.socket_path, ))
+        server.daemon = True
+        server.start()
+        for _ in range(100):
+            if os.path.exists(self.socket_path):
+                break
+            time.sleep(0.01)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _build(self, name, results):
+        results[name] = list(
+            daemon.Request(self.socket_path,
+                           ['--name', name, '--directory', self.app_dir]))
+
+    def test_concurrent_builds(self):
+        results = {}
+        builds = [
+            threading.Thread(target=self._build, args=(name, results))
+            for name in ['one', 'two']
+        ]
+        for build in builds:
+            build.start()
+        for build in builds:
+            build.join()
+
+        for name, other in [('one', 'two'), ('two', 'one')]:
+            msgs = results[name]
+            self.assertEqual(msgs[-1]['digest'], 'sha256:' + name)
+            logs = '\n'.join(msg['log'] for msg in msgs if 'log' in msg)
+            self.assertIn('building %s' % name, logs)
+            self.assertIn('worker of %s' % name, logs)
+            self.assertNotIn('building %s' % other, logs)
+        # builds run on a copy of the directory
+        self.assertEqual(os.listdir(self.app_dir), [])
+
+    def test_build_env_and_virtualenv(self):
+        cli_args = [
+            '--name', 'env', '--directory', self.app_dir, '--virtualenv-dir',
+            os.path.join(self.tmp_dir, 'env')
+        ]
+        epoch = os.environ.get('SOURCE_DATE_EPOCH')
+        digests = [
+            list(daemon.Request(self.socket_path, cli_args, env))[-1]['digest']
+            for env in [{
+                'SOURCE_DATE_EPOCH': '1'
+            }, {
+                'SOURCE_DATE_EPOCH': None
+            }]
+        ]
+        self.assertEqual(digests, ['sha256:1 False', 'sha256:None False'])
+        # the process environment is left alone
+        self.assertEqual(os.environ.get('SOURCE_DATE_EPOCH'), epoch)
+
+    def test_daemon_log_leaves_out_debug(self):
+        handlers = [
+            h for h in logging.getLogger().handlers
+            if isinstance(h, logging.StreamHandler)
+            and not isinstance(h, daemon._BuildLogHandler)
+        ]
+        self.assertTrue(handlers)
+        for handler in handlers:
+            self.assertEqual(handler.level, logging.INFO)
+
+    def test_invalid_request(self):
+        msgs = list(daemon.Request(self.socket_path, ['--name', 'one']))
+        self.assertEqual(len(msgs), 1)
+        self.assertEqual(msgs[0]['error']['errorType'], 'USER')
+
+    def test_missing_directory(self):
+        msgs = list(
+            daemon.Request(self.socket_path, [
+                '--name', 'one', '--directory',
+                os.path.join(self.tmp_dir, 'missing')
+            ]))
+        self.assertEqual(msgs[-1]['error']['errorType'], 'USER')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,245 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""This package writes eStargz layers.
+
+An eStargz layer is a gzip compressed tarball in which every chunk of a
+regular file starts a new gzip member. It ends with a table of contents
+(stargz.index.json) listing the offset of every chunk and a footer pointing
+at the table of contents, so runtimes that pull lazily can fetch single
+files with range requests. Any gzip reader still sees a plain tarball.
+"""
+
+import cStringIO
+import datetime
+import hashlib
+import json
+import posixpath
+import re
+import struct
+import tarfile
+import zlib
+
+from ftl.common import constants
+
+TOC_NAME = 'stargz.index.json'
+PREFETCH_LANDMARK = '.prefetch.landmark'
+NO_PREFETCH_LANDMARK = '.no.prefetch.landmark'
+TOC_DIGEST_ANNOTATION = 'containerd.io/snapshot/stargz/toc.digest'
+UNCOMPRESSED_SIZE_ANNOTATION = 'io.containers.estargz.uncompressed-size'
+FOOTER_SIZE = 51
+
+_FOOTER_SUBFIELD_RE = re.compile(r'^([0-9a-f]{16})STARGZ$')
+_LANDMARK_CONTENTS = '\x0f'
+
+_TYPES = {
+    tarfile.REGTYPE: 'reg',
+    tarfile.AREGTYPE: 'reg',
+    tarfile.CONTTYPE: 'reg',
+    tarfile.DIRTYPE: 'dir',
+    tarfile.SYMTYPE: 'symlink',
+    tarfile.LNKTYPE: 'hardlink',
+    tarfile.CHRTYPE: 'char',
+    tarfile.BLKTYPE: 'block',
+    tarfile.FIFOTYPE: 'fifo',
+}
+
+
+class _Writer(object):
+    """_Writer appends data to a chain of gzip members, keeping the
+    uncompressed data alongside."""
+
+    def __init__(self, level):
+        self._level = level
+        self._gz = None
+        self._blob = []
+        self._size = 0
+        self._u_blob = []
+
+    def NewMember(self):
+        """Ends the current gzip member. Returns the offset of the next."""
+        self._end_member()
+        return self._size
+
+    def Write(self, data):
+        if self._gz is None:
+            self._gz = zlib.compressobj(self._level, zlib.DEFLATED,
+                                        16 + zlib.MAX_WBITS)
+        self._u_blob.append(data)
+        self._append(self._gz.compress(data))
+
+    def Close(self, footer):
+        self._end_member()
+        self._append(footer)
+        return ''.join(self._blob), ''.join(self._u_blob)
+
+    def _end_member(self):
+        if self._gz is not None:
+            self._append(self._gz.flush())
+            self._gz = None
+
+    def _append(self, data):
+        self._blob.append(data)
+        self._size += len(data)
+
+
+def _clean(path):
+    return posixpath.normpath('/' + path).lstrip('/')
+
+
+def _name(member):
+    return _clean(member.name)
+
+
+def _padding(size):
+    return '\0' * (-size % tarfile.BLOCKSIZE)
+
+
+def _reg_info(name, size):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mode = 0o644
+    return info
+
+
+def _toc_entry(member):
+    name = _name(member)
+    entry = {
+        'name': name + '/' if member.isdir() else name,
+        'type': _TYPES[member.type],
+        'mode': member.mode,
+        'uid': member.uid,
+        'gid': member.gid,
+        'modtime': datetime.datetime.utcfromtimestamp(
+            member.mtime).strftime('%Y-%m-%dT%H:%M:%SZ'),
+    }
+    if member.uname:
+        entry['userName'] = member.uname
+    if member.gname:
+        entry['groupName'] = member.gname
+    if member.isreg():
+        entry['size'] = member.size
+    if member.issym():
+        entry['linkName'] = member.linkname
+    elif member.islnk():
+        entry['linkName'] = _clean(member.linkname)
+    if member.ischr() or member.isblk():
+        entry['devMajor'] = member.devmajor
+        entry['devMinor'] = member.devminor
+    return entry
+
+
+def _sha256(data):
+    return 'sha256:' + hashlib.sha256(data).hexdigest()
+
+
+def _footer(toc_offset):
+    # an empty gzip member whose extra field holds the toc offset
+    subfield = '%016xSTARGZ' % toc_offset
+    extra = 'SG' + struct.pack('<H', len(subfield)) + subfield
+    header = '\x1f\x8b\x08\x04' + struct.pack('<I', 0) + '\x00\xff'
+    # an empty stored deflate block, then the crc and size of no data
+    trailer = '\x01\x00\x00\xff\xff' + struct.pack('<II', 0, 0)
+    return header + struct.pack('<H', len(extra)) + extra + trailer
+
+
+def _ordered(members, prioritized_files):
+    """Orders the members so the prioritized files (and their directories)
+    come first, followed by the prefetch landmark."""
+    by_name = dict((_name(m), m) for m in members)
+    front = []
+    for path in prioritized_files:
+        path = _clean(path)
+        if path not in by_name or not by_name[path].isreg():
+            continue
+        parts = path.split('/')
+        for i in range(1, len(parts) + 1):
+            member = by_name.get('/'.join(parts[:i]))
+            if member is not None and member not in front:
+                front.append(member)
+    rest = [m for m in members if m not in front]
+    if front:
+        return front + [PREFETCH_LANDMARK] + rest
+    return [NO_PREFETCH_LANDMARK] + rest
+
+
+def build(tar_blob, level=constants.DEFAULT_COMPRESSION_LEVEL,
+          prioritized_files=(), chunk_size=constants.ESTARGZ_CHUNK_SIZE):
+    """Rewrites a tarball as an eStargz layer.
+
+    Args:
+      tar_blob: the uncompressed layer tarball.
+      level: the gzip level.
+      prioritized_files: paths in the layer that are fetched first when a
+        container starts, in the order they are accessed.
+      chunk_size: regular files are split into gzip members of this size.
+
+    Returns:
+      the eStargz layer and the tarball it decompresses to, which holds the
+      landmark file and the table of contents on top of tar_blob's entries.
+    """
+    src = tarfile.open(fileobj=cStringIO.StringIO(tar_blob), mode='r:')
+    writer = _Writer(level)
+    entries = []
+    for member in _ordered(src.getmembers(), prioritized_files):
+        if member in (PREFETCH_LANDMARK, NO_PREFETCH_LANDMARK):
+            data = _LANDMARK_CONTENTS
+            member = _reg_info(member, len(data))
+        elif member.isreg():
+            data = src.extractfile(member).read()
+        else:
+            data = ''
+        entry = _toc_entry(member)
+        if entry['name']:
+            entries.append(entry)
+        writer.Write(member.tobuf(tarfile.GNU_FORMAT))
+        if data:
+            entry['digest'] = _sha256(data)
+            for offset in range(0, len(data), chunk_size):
+                chunk = data[offset:offset + chunk_size]
+                if offset:
+                    entry = {'name': entry['name'], 'type': 'chunk'}
+                    entries.append(entry)
+                entry['offset'] = writer.NewMember()
+                entry['chunkOffset'] = offset
+                entry['chunkSize'] = len(chunk)
+                entry['chunkDigest'] = _sha256(chunk)
+                writer.Write(chunk)
+            writer.Write(_padding(len(data)))
+
+    toc = json.dumps({'version': 1, 'entries': entries}, sort_keys=True)
+    toc_offset = writer.NewMember()
+    writer.Write(_reg_info(TOC_NAME, len(toc)).tobuf(tarfile.GNU_FORMAT))
+    writer.Write(toc)
+    writer.Write(_padding(len(toc)))
+    # end of archive
+    writer.Write('\0' * 2 * tarfile.BLOCKSIZE)
+    return writer.Close(_footer(toc_offset))
+
+
+def toc_digest(blob):
+    """Returns the digest of the table of contents of an eStargz layer, or
+    None for any other layer."""
+    if len(blob) < FOOTER_SIZE:
+        return None
+    footer = blob[-FOOTER_SIZE:]
+    if footer[:4] != '\x1f\x8b\x08\x04' or footer[12:14] != 'SG':
+        return None
+    match = _FOOTER_SUBFIELD_RE.match(footer[16:38])
+    if not match:
+        return None
+    toc_offset = int(match.group(1), 16)
+    tar_blob = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(
+        blob[toc_offset:-FOOTER_SIZE])
+    toc_tar = tarfile.open(fileobj=cStringIO.StringIO(tar_blob), mode='r:')
+    return _sha256(toc_tar.extractfile(TOC_NAME).read())
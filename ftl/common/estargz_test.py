@@ -0,0 +1,110 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Unit tests for estargz.py"""
+
+import cStringIO
+import gzip
+import hashlib
+import json
+import tarfile
+import unittest
+import zlib
+
+import estargz
+
+
+def _tar(files):
+    buf = cStringIO.StringIO()
+    with tarfile.open(fileobj=buf, mode='w:') as tar:
+        for name, data in files:
+            info = tarfile.TarInfo(name)
+            if data is None:
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o755
+                tar.addfile(info)
+                continue
+            info.size = len(data)
+            tar.addfile(info, cStringIO.StringIO(data))
+    return buf.getvalue()
+
+
+_FILES = [
+    ('srv', None),
+    ('srv/package.json', '{}'),
+    ('srv/lib', None),
+    ('srv/lib/big.js', 'x' * 2500 + 'y' * 2500),
+    ('srv/server.js', 'require("./lib/big")'),
+]
+
+
+class EstargzTest(unittest.TestCase):
+    def _toc(self, u_blob):
+        tar = tarfile.open(fileobj=cStringIO.StringIO(u_blob), mode='r:')
+        return json.loads(tar.extractfile(estargz.TOC_NAME).read())
+
+    def test_build_is_a_gzip_tarball(self):
+        blob, u_blob = estargz.build(_tar(_FILES), chunk_size=1024)
+        self.assertEqual(
+            gzip.GzipFile(fileobj=cStringIO.StringIO(blob)).read(), u_blob)
+        tar = tarfile.open(fileobj=cStringIO.StringIO(u_blob), mode='r:')
+        self.assertEqual(tar.getnames(), [
+            estargz.NO_PREFETCH_LANDMARK, 'srv', 'srv/package.json',
+            'srv/lib', 'srv/lib/big.js', 'srv/server.js', estargz.TOC_NAME
+        ])
+        self.assertEqual(tar.extractfile('srv/lib/big.js').read(),
+                         dict(_FILES)['srv/lib/big.js'])
+
+    def test_toc_digest(self):
+        blob, u_blob = estargz.build(_tar(_FILES))
+        self.assertEqual(blob[-estargz.FOOTER_SIZE:][:2], '\x1f\x8b')
+        tar = tarfile.open(fileobj=cStringIO.StringIO(u_blob), mode='r:')
+        toc = tar.extractfile(estargz.TOC_NAME).read()
+        self.assertEqual(
+            estargz.toc_digest(blob),
+            'sha256:' + hashlib.sha256(toc).hexdigest())
+        plain = cStringIO.StringIO()
+        with gzip.GzipFile(fileobj=plain, mode='w') as f:
+            f.write(_tar(_FILES))
+        self.assertIsNone(estargz.toc_digest(plain.getvalue()))
+
+    def test_chunks_can_be_fetched_alone(self):
+        blob, u_blob = estargz.build(_tar(_FILES), chunk_size=1024)
+        chunks = [
+            e for e in self._toc(u_blob)['entries']
+            if e['name'] == 'srv/lib/big.js' and 'offset' in e
+        ]
+        self.assertEqual([c['chunkOffset'] for c in chunks],
+                         [0, 1024, 2048, 3072, 4096])
+        data = dict(_FILES)['srv/lib/big.js']
+        for chunk in chunks:
+            member = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(
+                blob[chunk['offset']:])
+            start = chunk['chunkOffset']
+            self.assertEqual(member[:chunk['chunkSize']],
+                             data[start:start + chunk['chunkSize']])
+
+    def test_prioritized_files_come_first(self):
+        _, u_blob = estargz.build(
+            _tar(_FILES),
+            prioritized_files=['srv/server.js', '/srv/lib/big.js', 'nope'])
+        names = [e['name'] for e in self._toc(u_blob)['entries']
+                 if e['type'] != 'chunk']
+        self.assertEqual(names, [
+            'srv/', 'srv/server.js', 'srv/lib/', 'srv/lib/big.js',
+            estargz.PREFETCH_LANDMARK, 'srv/package.json'
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
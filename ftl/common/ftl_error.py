@@ -40,6 +40,14 @@ class InternalError(Exception):
         super(InternalError, self).__init__(message)
 
 
+class CancelledError(Exception):
+    """CancelledError is raised by work stopped early because work it ran
+    alongside failed. It never reaches users: the first error does."""
+
+    def __init__(self, message):
+        super(CancelledError, self).__init__(message)
+
+
 def genErrorId(s):
     return hashlib.sha256(s).hexdigest().upper()[:8]
 
@@ -12,7 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 """This package defines helpful utilities for FTL ."""
+import collections
+import copy
+import errno
 import os
+import fnmatch
+import hashlib
+import posixpath
+import stat
 import time
 import logging
 import subprocess
@@ -20,12 +27,18 @@ import tempfile
 import datetime
 import json
 import re
+import struct
+import tarfile
+import threading
+import zlib
 
+from ftl.common import concurrency
 from ftl.common import constants
+from ftl.common import estargz
 from ftl.common import ftl_error
 
-from containerregistry.client.v2_2 import append
-from containerregistry.transform.v2_2 import metadata
+# containerregistry and concurrent.futures are imported where they are used,
+# so that argument parsing and --version do not pay for loading them.
 
 
 class FTLException(Exception):
@@ -36,17 +49,36 @@ def AppendLayersIntoImage(imgs):
     if len(imgs) <= 0:
         logging.info("requirements.txt file with no deps used")
         return None
+    from containerregistry.client.v2_2 import append
+
+    from ftl.common import image_descriptor
+    from ftl.common import tar_to_dockerimage
+
+    epoch = source_date_epoch()
+    descriptors = {}
     with Timing('Stitching layers into final image'):
         for i, img in enumerate(imgs):
+            descriptors.update(tar_to_dockerimage.oci_layer_descriptors(img))
             if i == 0:
                 result_image = img
                 continue
-            diff_ids = img.diff_ids()
-            for diff_id in diff_ids:
-                lyr = img.blob(img._diff_id_to_digest(diff_id))
-                overrides = CfgDctToOverrides(json.loads(img.config_file()))
+            descriptor = image_descriptor.describe(img)
+            config_dct = descriptor.config()
+            if epoch is not None:
+                # cached layers keep their own creation time for the
+                # TTL check, normalize it so the final config (and its
+                # history) does not depend on when a layer was cached
+                config_dct['created'] = epoch_to_timestamp(epoch)
+            overrides = CfgDctToOverrides(config_dct)
+            for diff_id in descriptor.diff_ids:
+                lyr = img.blob(descriptor.digest(diff_id))
                 result_image = append.Layer(
                     result_image, lyr, diff_id=diff_id, overrides=overrides)
+        if descriptors:
+            # append advertises every layer it adds as docker gzip, without
+            # annotations
+            result_image = tar_to_dockerimage.OCIImage(
+                result_image, descriptors)
         return result_image
 
 
@@ -81,6 +113,8 @@ def CfgDctToOverrides(config_dct):
             # 'ports' in an Overrides object
             # but 'ExposedPorts' in the config_file
             overrides_dct['ports'] = v
+    from containerregistry.transform.v2_2 import metadata
+
     return metadata.Overrides(**overrides_dct)
 
 
@@ -93,14 +127,217 @@ class Timing(object):
         self.start = time.time()
         return self
 
-    def __exit__(self, unused_type, unused_value, unused_traceback):
+    def __exit__(self, unused_type, value, unused_traceback):
         end = time.time()
-        logging.info('%s took %d seconds', self.descriptor, end - self.start)
+        if isinstance(value, ftl_error.CancelledError):
+            logging.info('%s was cancelled after %d seconds', self.descriptor,
+                         end - self.start)
+        elif value is not None:
+            logging.info('%s failed after %d seconds', self.descriptor,
+                         end - self.start)
+        else:
+            logging.info('%s took %d seconds', self.descriptor,
+                         end - self.start)
+
+
+_log_context = threading.local()
+
+
+def log_context():
+    """Returns the log context of the current thread, or None. The daemon
+    uses it to route log records to the build that emitted them."""
+    return getattr(_log_context, 'value', None)
+
+
+def set_log_context(value):
+    _log_context.value = value
+
+
+_build_env = threading.local()
+
 
+def build_env():
+    """Returns the environment of the build the current thread works for:
+    the one the daemon received along with the build request, otherwise
+    the environment of the process."""
+    env = getattr(_build_env, 'value', None)
+    return os.environ if env is None else env
 
-def zip_dir_to_layer_sha(app_dir, destination_path, alter_symlinks=True):
 
-    tar_dir = tempfile.mkdtemp()
+def set_build_env(env):
+    _build_env.value = env
+
+
+class _Cancellation(object):
+    """_Cancellation is the cancelled state shared by the work of an
+    executor, and the commands that work runs.
+
+    Cancelling it kills those commands, and cancels the executors the work
+    started in turn.
+    """
+
+    def __init__(self, parent=None):
+        self._parent = parent
+        self._lock = threading.Lock()
+        self._cancelled = False
+        self._procs = set()
+        self._children = set()
+        if parent:
+            parent._adopt(self)
+
+    def cancelled(self):
+        return self._cancelled or bool(self._parent
+                                       and self._parent.cancelled())
+
+    def _adopt(self, child):
+        with self._lock:
+            self._children.add(child)
+            cancelled = self._cancelled
+        if cancelled:
+            child.cancel()
+
+    def close(self):
+        if self._parent:
+            with self._parent._lock:
+                self._parent._children.discard(self)
+
+    def track(self, proc):
+        """Kills proc once cancelled, at once if already."""
+        with self._lock:
+            self._procs.add(proc)
+            cancelled = self._cancelled
+        if cancelled or self.cancelled():
+            _kill(proc)
+
+    def untrack(self, proc):
+        with self._lock:
+            self._procs.discard(proc)
+
+    def cancel(self):
+        """Returns the number of commands killed."""
+        with self._lock:
+            if self._cancelled:
+                return 0
+            self._cancelled = True
+            procs = list(self._procs)
+            children = list(self._children)
+        for proc in procs:
+            _kill(proc)
+        return len(procs) + sum(child.cancel() for child in children)
+
+
+def _kill(proc):
+    try:
+        proc.kill()
+    except OSError:
+        # it already exited
+        pass
+
+
+_cancellation = threading.local()
+
+
+def _current_cancellation():
+    return getattr(_cancellation, 'value', None)
+
+
+def check_cancelled():
+    """Raises CancelledError if the work of the current thread was
+    cancelled, for long steps such as uploads to stop before they start."""
+    cancellation = _current_cancellation()
+    if cancellation and cancellation.cancelled():
+        raise ftl_error.CancelledError('cancelled after an earlier error')
+
+
+class ThreadPoolExecutor(object):
+    """ThreadPoolExecutor wraps a concurrent.futures.ThreadPoolExecutor to
+    run submitted work under the log context of the submitting thread.
+
+    It fails fast: once submitted work raises, or the `with` block exits on
+    an exception, the commands run_command runs for other work are killed,
+    work not started yet does not start and check_cancelled() raises in
+    work in progress. All of it raises that first error, so whichever
+    future the caller looks at first reports it, without waiting for the
+    rest of the work to finish.
+    """
+
+    def __init__(self, max_workers):
+        import concurrent.futures
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers)
+        self._cancellation = _Cancellation(_current_cancellation())
+        self._lock = threading.Lock()
+        self._error = None
+        self._start = time.time()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, unused_type, value, unused_traceback):
+        if value is not None:
+            self.cancel(value)
+        self.shutdown(wait=True)
+        return False
+
+    def submit(self, fn, *args, **kwargs):
+        value = log_context()
+        env = getattr(_build_env, 'value', None)
+
+        def run():
+            previous = log_context()
+            previous_env = getattr(_build_env, 'value', None)
+            previous_cancellation = _current_cancellation()
+            set_log_context(value)
+            set_build_env(env)
+            _cancellation.value = self._cancellation
+            try:
+                check_cancelled()
+                return fn(*args, **kwargs)
+            except ftl_error.CancelledError as e:
+                raise self._error or e
+            except Exception as e:
+                self.cancel(e)
+                raise
+            finally:
+                set_log_context(previous)
+                set_build_env(previous_env)
+                _cancellation.value = previous_cancellation
+
+        return self._executor.submit(run)
+
+    def map(self, fn, *iterables):
+        futures = [self.submit(fn, *args) for args in zip(*iterables)]
+        return (future.result() for future in futures)
+
+    def cancel(self, error):
+        """Cancels the work of the executor because of error, unless it
+        was cancelled already."""
+        with self._lock:
+            if self._error is not None:
+                return
+            self._error = error
+        killed = self._cancellation.cancel()
+        logging.error(
+            'Cancelling the remaining work after %.2fs, killing %d '
+            'commands, because of: %s', time.time() - self._start, killed,
+            error)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+        self._cancellation.close()
+
+
+def zip_dir_to_layer_sha(app_dir,
+                         destination_path,
+                         alter_symlinks=True,
+                         layer_opts=None,
+                         exclude=(),
+                         keep_bytecode=False):
+    """Tars and compresses a directory into a layer under destination_path,
+    leaving out the paths, relative to app_dir, in exclude and, unless
+    keep_bytecode, *.pyc files and __pycache__ directories.
+    """
 
     tar_path = tempfile.mktemp(suffix='.tar')
     txfrm_regex = 's,^,%s/,' % destination_path
@@ -110,17 +347,250 @@ def zip_dir_to_layer_sha(app_dir, destination_path, alter_symlinks=True):
         'tar',
         '-pcf', tar_path,
         '--transform', txfrm_regex,
-        '--exclude', '*.pyc',
-        '.'
+        '--sort=name',
     ]
+    if not keep_bytecode:
+        tar_cmd.extend(['--exclude', '*.pyc', '--exclude', '__pycache__'])
+    if exclude:
+        # match the excluded paths from the top of app_dir only
+        tar_cmd.append('--anchored')
+        for path in exclude:
+            tar_cmd.extend(['--exclude', os.path.join('.', path)])
+    epoch = source_date_epoch()
+    if epoch is not None:
+        # normalize everything tar records about the build host so that
+        # identical inputs always produce byte-identical layers; mtimes
+        # past the epoch are clamped to it, older ones are kept
+        tar_cmd.extend([
+            '--mtime', '@%d' % epoch,
+            '--clamp-mtime',
+            '--owner=0',
+            '--group=0',
+            '--numeric-owner',
+        ])
+    tar_cmd.append('.')
 
     run_command('tar_runtime_package', tar_cmd, cmd_cwd=app_dir)
+    return compress_layer(tar_path, layer_opts)
+
+
+def compress_layer(tar_path, layer_opts=None):
+    """Compresses a layer tarball, removing it.
 
-    u_blob = open(tar_path, 'r').read()
-    # We use gzip for performance instead of python's zip.
-    gzip_cmd = ['gzip', tar_path, '-1']
-    run_command('gzip_tar_runtime_package', gzip_cmd)
-    return open(os.path.join(tar_dir, tar_path + '.gz'), 'rb').read(), u_blob
+    Returns:
+      the compressed layer and the tarball it decompresses to.
+    """
+    layer_opts = layer_opts or LayerOptions()
+    # the tarball and its compressed copy are both held in memory
+    with concurrency.memory().Slot():
+        if layer_opts.dedupe_files:
+            link_duplicate_files(tar_path, layer_opts.prioritized_files)
+        with open(tar_path, 'rb') as f:
+            u_blob = f.read()
+        if layer_opts.compression == constants.ZSTD:
+            blob = zstd_layer(tar_path, layer_opts)
+        elif layer_opts.compression == constants.ESTARGZ:
+            with Timing('estargz_tar_runtime_package'):
+                blob, u_blob = estargz.build(
+                    u_blob, layer_opts.compression_level,
+                    layer_opts.prioritized_files)
+        else:
+            with Timing('gzip_tar_runtime_package'):
+                blob = gzip_layer(u_blob, layer_opts)
+    os.remove(tar_path)
+    return blob, u_blob
+
+
+def _clean_tar_name(name):
+    return posixpath.normpath('/' + name).lstrip('/')
+
+
+def link_duplicate_files(tar_path, keep=()):
+    """Rewrites the regular files of a layer tarball that repeat an earlier
+    one as hardlinks to it, in place.
+
+    Files are duplicates when their size, then their sha256, and everything
+    tar records about them match, so extracting the layer gives the same
+    files. The paths in keep, the files an eStargz layer prefetches, stay
+    full copies. A tarball without duplicates is left as it is.
+
+    Returns:
+      the number of files replaced by hardlinks.
+    """
+    keep = set(_clean_tar_name(path) for path in keep)
+    with Timing('linking_duplicate_layer_files'):
+        with tarfile.open(tar_path, mode='r:') as src:
+            members = src.getmembers()
+
+            def attrs(member):
+                return (member.size, member.mode, member.uid, member.gid,
+                        member.uname, member.gname, member.mtime)
+
+            by_attrs = collections.defaultdict(list)
+            for member in members:
+                if member.isreg() and member.size:
+                    by_attrs[attrs(member)].append(member)
+
+            # the first file with some contents is the one the others,
+            # later in the tarball, link to
+            links = {}
+            for same in by_attrs.values():
+                if len(same) < 2:
+                    continue
+                first = {}
+                for member in same:
+                    digest = _sha256_file(src.extractfile(member))
+                    if digest not in first:
+                        first[digest] = member
+                    elif _clean_tar_name(member.name) not in keep:
+                        links[member.name] = first[digest].name
+            if not links:
+                return 0
+
+            tmp_path = tar_path + '.links'
+            with tarfile.open(tmp_path, mode='w:',
+                              format=tarfile.GNU_FORMAT) as out:
+                for member in members:
+                    if member.name not in links:
+                        out.addfile(
+                            member,
+                            src.extractfile(member)
+                            if member.isreg() else None)
+                        continue
+                    link = copy.copy(member)
+                    link.type = tarfile.LNKTYPE
+                    link.linkname = links[member.name]
+                    link.size = 0
+                    out.addfile(link)
+        os.rename(tmp_path, tar_path)
+    logging.info('Replaced %d duplicate files of %s by hardlinks',
+                 len(links), tar_path)
+    return len(links)
+
+
+def _sha256_file(f):
+    sha = hashlib.sha256()
+    for chunk in iter(lambda: f.read(1024 * 1024), b''):
+        sha.update(chunk)
+    return sha.hexdigest()
+
+
+class LayerOptions(object):
+    """LayerOptions holds how the layers FTL produces are compressed."""
+
+    def __init__(self,
+                 compression=constants.GZIP,
+                 compression_level=constants.DEFAULT_COMPRESSION_LEVEL,
+                 compression_threads=None,
+                 prioritized_files=(),
+                 dedupe_files=False):
+        self.compression = compression
+        self.compression_level = compression_level
+        self.compression_threads = (compression_threads
+                                    or concurrency.cpu_limit())
+        self.prioritized_files = prioritized_files
+        self.dedupe_files = dedupe_files
+
+
+def gzip_layer(u_blob, layer_opts=None,
+               block_size=constants.COMPRESSION_BLOCK_SIZE):
+    """Compresses a layer into a single gzip member, deflating blocks of it
+    in parallel the way pigz does.
+
+    Every block is deflated on its own and ends on a sync flush (the last
+    one on a finish), so the deflate outputs concatenate into one valid
+    stream. The output only depends on the data, the level and the block
+    size, not on the number of threads.
+    """
+    layer_opts = layer_opts or LayerOptions()
+    level = layer_opts.compression_level
+    last = max(len(u_blob) - 1, 0) // block_size
+
+    def deflate(i):
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        block = u_blob[i * block_size:(i + 1) * block_size]
+        flush = zlib.Z_FINISH if i == last else zlib.Z_SYNC_FLUSH
+        return compressor.compress(block) + compressor.flush(flush)
+
+    blocks = range(last + 1)
+    if last and layer_opts.compression_threads > 1:
+        with ThreadPoolExecutor(
+                max_workers=layer_opts.compression_threads) as executor:
+            deflated = executor.map(deflate, blocks)
+            crc = zlib.crc32(u_blob)
+            deflated = list(deflated)
+    else:
+        deflated = [deflate(i) for i in blocks]
+        crc = zlib.crc32(u_blob)
+
+    # no name and a zero mtime, the same header `gzip -n` writes
+    xfl = {1: 4, 9: 2}.get(level, 0)
+    header = struct.pack('<BBBBIBB', 0x1f, 0x8b, 8, 0, 0, xfl, 3)
+    trailer = struct.pack('<II', crc & 0xffffffff, len(u_blob) & 0xffffffff)
+    return header + ''.join(deflated) + trailer
+
+
+def zstd_layer(tar_path, layer_opts):
+    """Compresses a layer tarball with the zstd cli."""
+    zst_path = tar_path + '.zst'
+    zstd_cmd = [
+        'zstd', '-q', '-f',
+        '-%d' % layer_opts.compression_level,
+        '-T%d' % layer_opts.compression_threads,
+        tar_path, '-o', zst_path,
+    ]
+    run_command('zstd_tar_runtime_package', zstd_cmd)
+    with open(zst_path, 'rb') as f:
+        blob = f.read()
+    os.remove(zst_path)
+    return blob
+
+
+def zstd_decompress(blob):
+    proc_pipe = subprocess.Popen(
+        ['zstd', '-q', '-d', '-c'],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE)
+    stdout, stderr = proc_pipe.communicate(input=blob)
+    if proc_pipe.returncode:
+        raise ftl_error.InternalError(
+            "error: `zstd -d` returned code: %d\n%s" %
+            (proc_pipe.returncode, stderr))
+    return stdout
+
+
+def is_zstd(blob):
+    return blob[:len(constants.ZSTD_MAGIC)] == constants.ZSTD_MAGIC
+
+
+def dir_hash(directory, exclude=('*.pyc', '__pycache__')):
+    """Hashes the paths, modes, link targets and file contents under
+    directory, i.e. what zip_dir_to_layer_sha puts in a layer minus
+    the mtimes."""
+    sha = hashlib.sha256()
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(dirs + files):
+            if any(fnmatch.fnmatch(name, pattern) for pattern in exclude):
+                continue
+            path = os.path.join(root, name)
+            rel_path = os.path.relpath(path, directory)
+            st = os.lstat(path)
+            if stat.S_ISLNK(st.st_mode):
+                sha.update('l %s %s\0' % (rel_path, os.readlink(path)))
+            elif stat.S_ISDIR(st.st_mode):
+                sha.update('d %s %o\0' % (rel_path, st.st_mode))
+            else:
+                sha.update('f %s %o ' % (rel_path, st.st_mode))
+                with open(path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                        sha.update(chunk)
+                sha.update('\0')
+        # excluded directories are not walked into either
+        dirs[:] = [d for d in dirs
+                   if not any(fnmatch.fnmatch(d, p) for p in exclude)]
+    return sha.hexdigest()
 
 
 def has_pkg_descriptor(descriptor_files, ctx):
@@ -199,6 +669,21 @@ def gen_tmp_dir(dirr):
     return dir_name
 
 
+def copy_app_dir(directory, exclude=()):
+    """Returns a temporary copy of the app directory but for the excluded
+    top level entries, for package managers to run in without changing
+    the app directory."""
+    copy_dir = tempfile.mkdtemp()
+    paths = [
+        os.path.join(directory, name)
+        for name in sorted(os.listdir(directory)) if name not in exclude
+    ]
+    if paths:
+        copy_cmd = ['cp', '-a', '--reflink=auto'] + paths + [copy_dir]
+        run_command('copy_app_dir', copy_cmd)
+    return copy_dir
+
+
 def creation_time(image):
     logging.info(image.config_file())
     cfg = json.loads(image.config_file())
@@ -210,6 +695,24 @@ def timestamp_to_time(dt_str):
     return datetime.datetime.strptime(dt, "%Y-%m-%dT%H:%M:%S")
 
 
+def source_date_epoch():
+    """Returns the SOURCE_DATE_EPOCH from the environment as an int, or
+    None if a reproducible build was not requested."""
+    epoch = build_env().get(constants.SOURCE_DATE_EPOCH)
+    if not epoch:
+        return None
+    try:
+        return int(epoch)
+    except ValueError:
+        raise ftl_error.UserError('%s must be an integer, got: %s' %
+                                  (constants.SOURCE_DATE_EPOCH, epoch))
+
+
+def epoch_to_timestamp(epoch):
+    dt = datetime.datetime.utcfromtimestamp(epoch)
+    return dt.strftime('%Y-%m-%dT%H:%M:%S') + 'Z'
+
+
 def generate_overrides(set_env, virtualenv_dir=constants.VIRTUALENV_DIR):
     created_time = datetime.datetime.now().strftime('%Y-%m-%dT%H:') + '00:00Z'
     overrides_dct = {
@@ -282,31 +785,86 @@ def run_command(cmd_name,
                 cmd_cwd=None,
                 cmd_env=None,
                 cmd_input=None,
-                err_type=ftl_error.FTLErrors.INTERNAL()):
+                err_type=ftl_error.FTLErrors.INTERNAL(),
+                tail_lines=constants.COMMAND_TAIL_LINES):
+    """Runs a command, streaming its output to the log line by line.
+
+    Only the last tail_lines lines of stdout and stderr are kept, for the
+    error raised on failure and for the return value; None keeps them all.
+    The wall and cpu time of the command are logged and added to the
+    command metrics of the current log context. When the work running the
+    command is cancelled, see ThreadPoolExecutor, the command is killed and
+    CancelledError raised.
+    """
     with Timing(cmd_name):
         cmd = "%s %s" % (cmd_name, " ".join(cmd_args))
         logging.info(cmd)
         proc_pipe = None
-        try:
-            proc_pipe = subprocess.Popen(
-                cmd_args,
-                stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                cwd=cmd_cwd,
-                env=cmd_env,
-            )
-        except OSError as e:
-            raise ftl_error.InternalError(
-                "%s\nexited with error %s\n%s is likely not on the path" %
-                (cmd, e, cmd_name))
-        stdout, stderr = proc_pipe.communicate(input=cmd_input)
-        logging.info("`%s` stdout:\n%s", cmd_name, stdout)
+        # commands such as pip, npm and tar keep about a cpu busy each
+        with concurrency.cpu().Slot():
+            check_cancelled()
+            start = time.time()
+            try:
+                proc_pipe = subprocess.Popen(
+                    cmd_args,
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    cwd=cmd_cwd,
+                    env=build_env() if cmd_env is None else cmd_env,
+                )
+            except OSError as e:
+                raise ftl_error.InternalError(
+                    "%s\nexited with error %s\n%s is likely not on the path" %
+                    (cmd, e, cmd_name))
+            progress = _Progress(cmd_name, start)
+            stdout = _OutputTail(tail_lines)
+            stderr = _OutputTail(tail_lines)
+            readers = [
+                _start_reader(cmd_name, proc_pipe.stdout, stdout, progress),
+                _start_reader(cmd_name, proc_pipe.stderr, stderr, progress),
+            ]
+            cancellation = _current_cancellation()
+            if cancellation:
+                cancellation.track(proc_pipe)
+            try:
+                try:
+                    if cmd_input:
+                        proc_pipe.stdin.write(cmd_input)
+                    proc_pipe.stdin.close()
+                except IOError as e:
+                    # the command exited without reading all of its input
+                    if e.errno != errno.EPIPE:
+                        raise
+                for reader in readers:
+                    reader.join()
+                _, status, rusage = os.wait4(proc_pipe.pid, 0)
+                if os.WIFSIGNALED(status):
+                    proc_pipe.returncode = -os.WTERMSIG(status)
+                else:
+                    proc_pipe.returncode = os.WEXITSTATUS(status)
+            finally:
+                if cancellation:
+                    cancellation.untrack(proc_pipe)
+        wall = time.time() - start
+        _record_command_metrics(cmd_name, wall, rusage)
+        logging.info(
+            '`%s` ran for %.2fs wall, %.2fs user and %.2fs system cpu, '
+            'wrote %d lines', cmd_name, wall, rusage.ru_utime,
+            rusage.ru_stime, progress.lines)
+
+        if (proc_pipe.returncode and cancellation
+                and cancellation.cancelled()):
+            raise ftl_error.CancelledError(
+                '`%s` was killed after an earlier error' % cmd_name)
         err_txt = ""
-        if stderr:
+        if stderr.lines:
             err_txt = "`%s` had stderr output:\n%s" % (cmd_name, stderr)
-            logging.info(err_txt)
         if proc_pipe.returncode:
+            # npm and pip print some of their errors on stdout
+            if stdout.lines:
+                err_txt = "`%s` had stdout output:\n%s\n%s" % (
+                    cmd_name, stdout, err_txt)
             ret_txt = "error: `%s` returned code: %d" % (cmd_name,
                                                          proc_pipe.returncode)
             logging.error(ret_txt)
@@ -317,3 +875,96 @@ def run_command(cmd_name,
             else:
                 raise Exception("Unknown error type passed to run_command")
         return "stdout: %s, stderr: %s" % (stdout, stderr)
+
+
+class _OutputTail(object):
+    """_OutputTail keeps the last lines of a command output."""
+
+    def __init__(self, max_lines):
+        self.lines = 0
+        self._tail = collections.deque(maxlen=max_lines)
+
+    def append(self, line):
+        self.lines += 1
+        self._tail.append(line)
+
+    def __str__(self):
+        text = ''.join(self._tail)
+        if self.lines > len(self._tail):
+            text = '[%d earlier lines omitted]\n%s' % (
+                self.lines - len(self._tail), text)
+        return text
+
+
+class _Progress(object):
+    """_Progress logs that a command is still running at most every
+    constants.COMMAND_PROGRESS_SECONDS."""
+
+    def __init__(self, cmd_name, start):
+        self._cmd_name = cmd_name
+        self._start = start
+        self._last = start
+        self._lock = threading.Lock()
+        self.lines = 0
+
+    def line(self, line):
+        now = time.time()
+        with self._lock:
+            self.lines += 1
+            if now - self._last < constants.COMMAND_PROGRESS_SECONDS:
+                return
+            self._last = now
+            lines = self.lines
+        logging.info('`%s` still running after %ds, %d lines so far: %s',
+                     self._cmd_name, now - self._start, lines, line.rstrip())
+
+
+def _start_reader(cmd_name, pipe, tail, progress):
+    value = log_context()
+
+    def read():
+        set_log_context(value)
+        for line in iter(
+                lambda: pipe.readline(constants.COMMAND_MAX_LINE_BYTES), ''):
+            tail.append(line)
+            progress.line(line)
+            logging.debug('`%s` %s', cmd_name, line.rstrip())
+        pipe.close()
+
+    reader = threading.Thread(target=read)
+    reader.daemon = True
+    reader.start()
+    return reader
+
+
+_command_metrics_lock = threading.Lock()
+_command_metrics = {}
+
+
+def _record_command_metrics(cmd_name, wall, rusage):
+    with _command_metrics_lock:
+        metrics = _command_metrics.setdefault(log_context(), {}).setdefault(
+            cmd_name, {
+                'runs': 0,
+                'wall_seconds': 0.0,
+                'user_seconds': 0.0,
+                'system_seconds': 0.0,
+                'max_rss_kb': 0,
+            })
+        metrics['runs'] += 1
+        metrics['wall_seconds'] += wall
+        metrics['user_seconds'] += rusage.ru_utime
+        metrics['system_seconds'] += rusage.ru_stime
+        metrics['max_rss_kb'] = max(metrics['max_rss_kb'], rusage.ru_maxrss)
+
+
+def pop_command_metrics(context=None):
+    """Returns, by command name, the runs, wall and cpu seconds and peak
+    memory of the commands run_command ran under a log context, and forgets
+    them."""
+    with _command_metrics_lock:
+        metrics = _command_metrics.pop(context, {})
+    for cmd_metrics in metrics.values():
+        for key in ('wall_seconds', 'user_seconds', 'system_seconds'):
+            cmd_metrics[key] = round(cmd_metrics[key], 2)
+    return metrics
@@ -0,0 +1,75 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""This package defines a record of past layer builds."""
+
+import json
+import logging
+import os
+import tempfile
+import threading
+
+
+class LayerHistory(object):
+    """LayerHistory keeps, per layer name, how long the layer took to build
+    on its last cache miss, how big it was and how often its cache key
+    changed. It is stored as a json file so it outlives a single build.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        self._entries = {}
+        if path and os.path.isfile(path):
+            try:
+                with open(path, 'r') as f:
+                    self._entries = json.load(f)
+            except (IOError, ValueError) as e:
+                logging.warning('Ignoring unreadable layer history %s: %s',
+                                path, e)
+
+    def Get(self, name):
+        """Returns the recorded entry for a layer name, or None."""
+        with self._lock:
+            entry = self._entries.get(name)
+            return dict(entry) if entry else None
+
+    def Record(self, name, key, seconds, size):
+        """Records a cache miss build of a layer."""
+        with self._lock:
+            entry = self._entries.setdefault(name, {
+                'builds': 0,
+                'changes': 0,
+            })
+            if entry.get('key') != key:
+                entry['changes'] += 1
+            entry['builds'] += 1
+            entry['key'] = key
+            entry['seconds'] = round(seconds, 2)
+            entry['size'] = size
+
+    def Save(self):
+        if not self._path:
+            return
+        with self._lock:
+            try:
+                dirname = os.path.dirname(self._path) or '.'
+                if not os.path.isdir(dirname):
+                    os.makedirs(dirname)
+                fd, tmp_path = tempfile.mkstemp(dir=dirname)
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(self._entries, f, sort_keys=True)
+                os.rename(tmp_path, self._path)
+            except (IOError, OSError) as e:
+                logging.warning('Could not save layer history %s: %s',
+                                self._path, e)
@@ -0,0 +1,54 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Unit tests for history.py"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import history
+
+
+class LayerHistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'ftl', 'history.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_record_and_reload(self):
+        h = history.LayerHistory(self.path)
+        self.assertIsNone(h.Get('python interpreter'))
+        h.Record('python interpreter', 'key1', 2.5, 100)
+        h.Record('python interpreter', 'key1', 3.5, 100)
+        h.Record('python interpreter', 'key2', 4.0, 200)
+        h.Save()
+
+        entry = history.LayerHistory(self.path).Get('python interpreter')
+        self.assertEqual(entry['seconds'], 4.0)
+        self.assertEqual(entry['size'], 200)
+        self.assertEqual(entry['builds'], 3)
+        self.assertEqual(entry['changes'], 2)
+
+    def test_unreadable_history(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'w') as f:
+            f.write('not json')
+        self.assertIsNone(history.LayerHistory(self.path).Get('php'))
+
+
+if __name__ == '__main__':
+    unittest.main()
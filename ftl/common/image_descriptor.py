@@ -0,0 +1,111 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""This package defines the parsed manifest and config of an image."""
+
+import json
+
+# the media type of a manifest that does not name one
+_DEFAULT_MEDIA_TYPE = 'application/vnd.oci.image.manifest.v1+json'
+
+
+class Descriptor(object):
+    """Descriptor is the manifest and config of an image, parsed once.
+
+    It maps layer digests to diff_ids and back, and digests to blob sizes,
+    in constant time. Images never change once built, so neither does their
+    descriptor: everything it returns must be treated as read-only.
+    """
+
+    def __init__(self, manifest, config_file):
+        manifest_dct = json.loads(manifest)
+        config_dct = json.loads(config_file)
+        self._manifest = manifest
+        self._config_file = config_file
+        self._media_type = manifest_dct.get('mediaType', _DEFAULT_MEDIA_TYPE)
+        self._config_blob = manifest_dct['config']['digest']
+        self._layers = tuple(manifest_dct.get('layers', []))
+        # fs_layers and diff_ids list the top layer first
+        self._fs_layers = tuple(
+            reversed([layer['digest'] for layer in self._layers]))
+        self._diff_ids = tuple(
+            reversed(config_dct.get('rootfs', {}).get('diff_ids', [])))
+        self._sizes = dict(
+            (layer['digest'], layer['size']) for layer in self._layers)
+        self._sizes[self._config_blob] = manifest_dct['config']['size']
+        self._digest_to_diff_id = dict(zip(self._fs_layers, self._diff_ids))
+        self._diff_id_to_digest = dict(zip(self._diff_ids, self._fs_layers))
+
+    @property
+    def manifest(self):
+        return self._manifest
+
+    @property
+    def config_file(self):
+        return self._config_file
+
+    @property
+    def media_type(self):
+        return self._media_type
+
+    @property
+    def config_blob(self):
+        return self._config_blob
+
+    @property
+    def layers(self):
+        """The layer descriptors of the manifest, base layer first."""
+        return self._layers
+
+    @property
+    def fs_layers(self):
+        return self._fs_layers
+
+    @property
+    def diff_ids(self):
+        return self._diff_ids
+
+    def config(self):
+        """Returns a fresh dict of the config, for callers to modify."""
+        return json.loads(self._config_file)
+
+    def size(self, digest):
+        try:
+            return self._sizes[digest]
+        except KeyError:
+            raise ValueError('Unknown blob "%s"' % digest)
+
+    def digest(self, diff_id):
+        try:
+            return self._diff_id_to_digest[diff_id]
+        except KeyError:
+            raise ValueError('Unmatched "diff_id": "%s"' % diff_id)
+
+    def diff_id(self, digest):
+        try:
+            return self._digest_to_diff_id[digest]
+        except KeyError:
+            raise ValueError('Unmatched "digest": "%s"' % digest)
+
+
+def describe(image):
+    """Returns the descriptor of any image, parsing it on first use.
+
+    The descriptor is kept on the image, be it one of ours or one from
+    containerregistry, so code handling the same image object shares it.
+    """
+    descriptor = getattr(image, '_ftl_descriptor', None)
+    if descriptor is None:
+        descriptor = Descriptor(image.manifest(), image.config_file())
+        image._ftl_descriptor = descriptor
+    return descriptor
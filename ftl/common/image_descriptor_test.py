@@ -0,0 +1,62 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Unit tests for image_descriptor.py"""
+
+import json
+import unittest
+
+import ftl_util
+import image_descriptor
+import tar_to_dockerimage
+
+
+class DescriptorTest(unittest.TestCase):
+    def setUp(self):
+        self.u_blobs = ['base' * 512, 'deps' * 512]
+        self.blobs = [ftl_util.gzip_layer(u) for u in self.u_blobs]
+        self.img = tar_to_dockerimage.FromFSImage(self.blobs, self.u_blobs)
+
+    def test_maps(self):
+        descriptor = image_descriptor.describe(self.img)
+        manifest = json.loads(self.img.manifest())
+        self.assertEqual(descriptor.media_type, manifest['mediaType'])
+        self.assertEqual(descriptor.config_blob,
+                         manifest['config']['digest'])
+        self.assertEqual(
+            list(descriptor.fs_layers),
+            [lyr['digest'] for lyr in reversed(manifest['layers'])])
+        self.assertEqual(len(descriptor.diff_ids), 2)
+        for digest, diff_id in zip(descriptor.fs_layers,
+                                   descriptor.diff_ids):
+            self.assertEqual(descriptor.digest(diff_id), digest)
+            self.assertEqual(descriptor.diff_id(digest), diff_id)
+            self.assertEqual(descriptor.size(digest),
+                             len(self.img.blob(digest)))
+            self.assertEqual(self.img.uncompressed_layer(diff_id),
+                             self.img.uncompressed_blob(digest))
+        with self.assertRaises(ValueError):
+            descriptor.digest('sha256:unknown')
+
+    def test_describe_parses_once(self):
+        descriptor = image_descriptor.describe(self.img)
+        self.assertIs(image_descriptor.describe(self.img), descriptor)
+        self.assertEqual(self.img.fs_layers(), list(descriptor.fs_layers))
+        # callers get their own copy of the config to modify
+        config = descriptor.config()
+        config['created'] = 'now'
+        self.assertNotEqual(descriptor.config(), config)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -26,11 +26,17 @@ class AppLayerBuilder(single_layer_image.BaseLayerBuilder):
                  directory,
                  destination_path=constants.DEFAULT_DESTINATION_PATH,
                  entrypoint=constants.DEFAULT_ENTRYPOINT,
-                 exposed_ports=None):
+                 exposed_ports=None,
+                 layer_opts=None,
+                 exclude=(),
+                 keep_bytecode=False):
         self._directory = directory
         self._destination_path = destination_path
         self._entrypoint = entrypoint
         self._exposed_ports = exposed_ports
+        self._layer_opts = layer_opts
+        self._exclude = exclude
+        self._keep_bytecode = keep_bytecode
 
     def GetCacheKeyRaw(self):
         return None
@@ -38,12 +44,19 @@ class AppLayerBuilder(single_layer_image.BaseLayerBuilder):
     def BuildLayer(self):
         """Override."""
         with ftl_util.Timing('Building app layer'):
-            gz, tar = ftl_util.zip_dir_to_layer_sha(self._directory,
-                                                    self._destination_path)
+            gz, tar = ftl_util.zip_dir_to_layer_sha(
+                self._directory,
+                self._destination_path,
+                layer_opts=self._layer_opts,
+                exclude=self._exclude,
+                keep_bytecode=self._keep_bytecode)
 
-            overrides_dct = {
-                'created': str(datetime.date.today()) + 'T00:00:00Z'
-            }
+            epoch = ftl_util.source_date_epoch()
+            if epoch is not None:
+                created = ftl_util.epoch_to_timestamp(epoch)
+            else:
+                created = str(datetime.date.today()) + 'T00:00:00Z'
+            overrides_dct = {'created': created}
             if self._entrypoint:
                 overrides_dct['Entrypoint'] = self._entrypoint
             if self._exposed_ports:
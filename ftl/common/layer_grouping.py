@@ -0,0 +1,223 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""This package defines merging dependency layers into a bounded number of
+layer groups."""
+
+import cStringIO
+import collections
+import gzip
+import hashlib
+import tarfile
+import tempfile
+
+from ftl.common import concurrency
+from ftl.common import constants
+from ftl.common import estargz
+from ftl.common import ftl_util
+from ftl.common import single_layer_image
+from ftl.common import tar_to_dockerimage
+
+# entries estargz adds to a layer, they are written again for the group
+_ESTARGZ_NAMES = [
+    estargz.TOC_NAME, estargz.PREFETCH_LANDMARK, estargz.NO_PREFETCH_LANDMARK
+]
+
+
+def Group(layer_builders, max_layers, policy, layer_history):
+    """Splits layer builders into at most max_layers groups.
+
+    Groups are contiguous runs of about the same total size, using the sizes
+    recorded in the layer history, so a large layer ends up alone. With the
+    churn policy the layers are first ordered by how often their cache key
+    changed, so layers that rarely change share groups that are rarely
+    rebuilt.
+
+    Sizes and changes come from the layer history of this host, so another
+    host may group the same layers differently and miss the groups cached
+    here, though it still shares the cached layers. The key policy ignores
+    the history and splits the layers in image order where the hashes of
+    their cache keys are lowest, so the groups only depend on the keys and
+    a changed key moves at most one split.
+
+    Args:
+      layer_builders: the cacheable layer builders, in image order.
+      max_layers: the most groups to return, 0 or less for no limit.
+      policy: one of constants.LAYER_GROUPINGS.
+      layer_history: the history.LayerHistory of past builds.
+
+    Returns:
+      a list of lists of layer builders, each in image order.
+    """
+    if max_layers <= 0 or len(layer_builders) <= max_layers:
+        return [[lyr] for lyr in layer_builders]
+    if policy == constants.KEY_GROUPING:
+        return _group_by_keys(layer_builders, max_layers)
+
+    entries = [
+        layer_history.Get(lyr.GetLayerName()) or {} for lyr in layer_builders
+    ]
+    known_sizes = [e['size'] for e in entries if e.get('size')]
+    # layers never built before count as an average one
+    default_size = (float(sum(known_sizes)) / len(known_sizes)
+                    if known_sizes else 1)
+    sizes = [e.get('size') or default_size for e in entries]
+
+    order = range(len(layer_builders))
+    if policy == constants.CHURN_GROUPING:
+        # sorted is stable, layers changing as often keep their image order
+        order = sorted(order, key=lambda i: -entries[i].get('changes', 0))
+
+    target = float(sum(sizes)) / max_layers
+    groups = [[]]
+    group_size = 0
+    for i in order:
+        if (groups[-1] and group_size + sizes[i] > target
+                and len(groups) < max_layers):
+            groups.append([])
+            group_size = 0
+        groups[-1].append(i)
+        group_size += sizes[i]
+    groups.sort(key=min)
+    return [[layer_builders[i] for i in sorted(group)] for group in groups]
+
+
+def _group_by_keys(layer_builders, max_layers):
+    # a split after a layer is ranked by the hash of the layer's key
+    splits = set(
+        sorted(
+            range(len(layer_builders) - 1),
+            key=lambda i: hashlib.sha256(
+                layer_builders[i].GetCacheKey()).hexdigest())[:max_layers - 1])
+    groups = [[]]
+    for i, lyr in enumerate(layer_builders):
+        groups[-1].append(lyr)
+        if i in splits:
+            groups.append([])
+    return groups
+
+
+class GroupLayerBuilder(single_layer_image.CacheableLayerBuilder):
+    """GroupLayerBuilder merges the layers of several cacheable layer
+    builders into one layer.
+
+    The members stay cached one by one, the merged layer is cached under a
+    key derived from theirs, so a hit skips building the members altogether
+    and a miss only rebuilds the members that changed. A group of one is
+    just its member.
+    """
+
+    def __init__(self,
+                 members,
+                 build_member=None,
+                 cache=None,
+                 layer_opts=None):
+        super(GroupLayerBuilder, self).__init__()
+        self._members = members
+        self._build_member = build_member or (lambda lyr: lyr.BuildLayer())
+        self._cache = cache
+        self._layer_opts = layer_opts
+
+    def GetMembers(self):
+        return self._members
+
+    def GetCacheKeyRaw(self):
+        if len(self._members) == 1:
+            return self._members[0].GetCacheKeyRaw()
+        return 'layer group %s' % ' '.join(
+            lyr.GetCacheKey() for lyr in self._members)
+
+    def GetCacheKey(self):
+        if len(self._members) == 1:
+            return self._members[0].GetCacheKey()
+        return hashlib.sha256(self.GetCacheKeyRaw()).hexdigest()
+
+    def GetLayerName(self):
+        if len(self._members) == 1:
+            return self._members[0].GetLayerName()
+        return 'layer group of %d (%s to %s)' % (
+            len(self._members), self._members[0].GetLayerName(),
+            self._members[-1].GetLayerName())
+
+    def BuildLayer(self):
+        if len(self._members) == 1:
+            member = self._members[0]
+            self._build_member(member)
+            self._cache_hit = member.CacheHit()
+            self.SetImage(member.GetImage())
+            return
+
+        cached_img = None
+        if self._cache:
+            with ftl_util.Timing('checking_cached_layer_group'):
+                cached_img = self._cache.Get(self.GetCacheKey())
+        self._cache_hit = cached_img is not None
+        if cached_img:
+            self.SetImage(cached_img)
+            return
+
+        with ftl_util.Timing('building_layer_group_members'):
+            with ftl_util.ThreadPoolExecutor(
+                    max_workers=concurrency.network().capacity) as executor:
+                list(executor.map(self._build_member, self._members))
+        with ftl_util.Timing('merging_layer_group'):
+            tar_path = tempfile.mktemp(suffix='.tar')
+            with concurrency.memory().Slot():
+                with open(tar_path, 'wb') as f:
+                    f.write(
+                        _merge([lyr.GetImage() for lyr in self._members]))
+            blob, u_blob = ftl_util.compress_layer(tar_path, self._layer_opts)
+            overrides = ftl_util.generate_overrides(False)
+            self.SetImage(
+                tar_to_dockerimage.FromFSImage([blob], [u_blob], overrides))
+        if self._cache:
+            with ftl_util.Timing('uploading_layer_group'):
+                self._cache.Set(self.GetCacheKey(), self.GetImage())
+
+
+def _merge(imgs):
+    """Returns one tarball holding the layers of the images, a path in a
+    later layer replacing the same path in an earlier one."""
+    entries = collections.OrderedDict()
+    for img in imgs:
+        if not img:
+            continue
+        # fs_layers lists the top layer first
+        for digest in reversed(img.fs_layers()):
+            tar = tarfile.open(
+                fileobj=cStringIO.StringIO(_uncompressed_blob(img, digest)),
+                mode='r:')
+            for member in tar.getmembers():
+                if member.name in _ESTARGZ_NAMES:
+                    continue
+                data = None
+                if member.isreg():
+                    data = tar.extractfile(member).read()
+                entries[member.name] = (member, data)
+    buf = cStringIO.StringIO()
+    with tarfile.open(fileobj=buf, mode='w:',
+                      format=tarfile.GNU_FORMAT) as out:
+        for member, data in entries.values():
+            out.addfile(member,
+                        cStringIO.StringIO(data) if data is not None else None)
+    return buf.getvalue()
+
+
+def _uncompressed_blob(img, digest):
+    """Returns a layer of the image uncompressed. A member found in the cache
+    is a registry image, which always gunzips, whatever the layer is."""
+    blob = img.blob(digest)
+    if ftl_util.is_zstd(blob):
+        return ftl_util.zstd_decompress(blob)
+    # eStargz layers are gzip members one after the other
+    return gzip.GzipFile(fileobj=cStringIO.StringIO(blob)).read()
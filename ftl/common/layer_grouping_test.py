@@ -0,0 +1,233 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Unit tests for layer_grouping.py"""
+
+import cStringIO
+import gzip
+import os
+import tarfile
+import tempfile
+import unittest
+
+import constants
+import ftl_util
+import layer_grouping
+import single_layer_image
+import tar_to_dockerimage
+
+
+def _tar(files):
+    buf = cStringIO.StringIO()
+    with tarfile.open(fileobj=buf, mode='w:') as tar:
+        for name, data in files:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, cStringIO.StringIO(data))
+    return buf.getvalue()
+
+
+class _FakeLayer(single_layer_image.CacheableLayerBuilder):
+    def __init__(self, name, files=()):
+        super(_FakeLayer, self).__init__()
+        self._name = name
+        self._files = files
+        self.built = 0
+
+    def GetCacheKeyRaw(self):
+        return self._name
+
+    def GetLayerName(self):
+        return self._name
+
+    def BuildLayer(self):
+        self.built += 1
+        self._cache_hit = False
+        u_blob = _tar(self._files)
+        self._img = tar_to_dockerimage.FromFSImage(
+            [ftl_util.gzip_layer(u_blob)], [u_blob])
+
+
+class _FakeHistory(object):
+    def __init__(self, entries):
+        self._entries = entries
+
+    def Get(self, name):
+        return self._entries.get(name)
+
+
+class _FakeCache(object):
+    def __init__(self):
+        self.entries = {}
+
+    def Get(self, key):
+        return self.entries.get(key)
+
+    def Set(self, key, value):
+        self.entries[key] = value
+
+
+class _RegistryImage(object):
+    """_RegistryImage holds a layer compressed with zstd, which it gunzips
+    as a registry image does."""
+
+    def __init__(self, img):
+        digest = img.fs_layers()[0]
+        tar_path = tempfile.mktemp(suffix='.tar')
+        with open(tar_path, 'wb') as f:
+            f.write(img.uncompressed_blob(digest))
+        self._blob = ftl_util.zstd_layer(
+            tar_path, ftl_util.LayerOptions(compression=constants.ZSTD))
+        os.remove(tar_path)
+
+    def fs_layers(self):
+        return ['sha256:layer']
+
+    def blob(self, digest):
+        return self._blob
+
+    def uncompressed_blob(self, digest):
+        return gzip.GzipFile(fileobj=cStringIO.StringIO(self._blob)).read()
+
+
+def _names(groups):
+    return [[lyr.GetLayerName() for lyr in group] for group in groups]
+
+
+class GroupTest(unittest.TestCase):
+    def setUp(self):
+        self.layers = [_FakeLayer(name) for name in 'abcdef']
+
+    def test_under_the_cap_keeps_every_layer(self):
+        groups = layer_grouping.Group(self.layers, 6,
+                                      constants.CHURN_GROUPING,
+                                      _FakeHistory({}))
+        self.assertEqual(_names(groups), [[n] for n in 'abcdef'])
+        groups = layer_grouping.Group(self.layers, 0,
+                                      constants.CHURN_GROUPING,
+                                      _FakeHistory({}))
+        self.assertEqual(len(groups), 6)
+
+    def test_size_grouping_evens_out_sizes(self):
+        history = _FakeHistory({
+            'a': {'size': 100},
+            'b': {'size': 10},
+            'c': {'size': 10},
+            'd': {'size': 10},
+            'e': {'size': 10},
+        })
+        groups = layer_grouping.Group(self.layers, 3,
+                                      constants.SIZE_GROUPING, history)
+        # f was never built and counts as an average layer
+        self.assertEqual(_names(groups), [['a'], ['b', 'c', 'd', 'e'], ['f']])
+
+    def test_churn_grouping_keeps_changing_layers_together(self):
+        history = _FakeHistory({
+            'b': {'size': 1, 'changes': 5},
+            'e': {'size': 1, 'changes': 5},
+        })
+        groups = layer_grouping.Group(self.layers, 3,
+                                      constants.CHURN_GROUPING, history)
+        self.assertEqual(_names(groups), [['a', 'c'], ['b', 'e'],
+                                          ['d', 'f']])
+
+    def test_key_grouping_depends_on_keys_alone(self):
+        history = _FakeHistory({'b': {'size': 100, 'changes': 5}})
+        groups = layer_grouping.Group(self.layers, 3, constants.KEY_GROUPING,
+                                      history)
+        self.assertEqual(len(groups), 3)
+        self.assertEqual(sum(_names(groups), []), list('abcdef'))
+        self.assertEqual(
+            _names(groups),
+            _names(
+                layer_grouping.Group(self.layers, 3, constants.KEY_GROUPING,
+                                     _FakeHistory({}))))
+
+        # a changed layer moves at most one split
+        changed = self.layers[:3] + [_FakeLayer('x')] + self.layers[4:]
+        splits = [len(sum(_names(groups)[:i], [])) for i in range(1, 3)]
+        changed_splits = [
+            len(sum(_names(g)[:i], []))
+            for g in [
+                layer_grouping.Group(changed, 3, constants.KEY_GROUPING,
+                                     history)
+            ] for i in range(1, 3)
+        ]
+        self.assertLessEqual(len(set(splits) - set(changed_splits)), 1)
+
+
+class GroupLayerBuilderTest(unittest.TestCase):
+    def test_merges_and_caches_members(self):
+        members = [
+            _FakeLayer('a', [('lib/a.py', 'a'), ('bin/tool', 'old')]),
+            _FakeLayer('b', [('lib/b.py', 'b'), ('bin/tool', 'new')]),
+        ]
+        cache = _FakeCache()
+        group = layer_grouping.GroupLayerBuilder(members, cache=cache)
+        group.BuildLayer()
+        self.assertFalse(group.CacheHit())
+
+        img = group.GetImage()
+        self.assertEqual(len(img.fs_layers()), 1)
+        tar = tarfile.open(
+            fileobj=cStringIO.StringIO(
+                img.uncompressed_blob(img.fs_layers()[0])),
+            mode='r:')
+        self.assertEqual(tar.getnames(), ['lib/a.py', 'bin/tool', 'lib/b.py'])
+        self.assertEqual(tar.extractfile('bin/tool').read(), 'new')
+        self.assertEqual(cache.entries.keys(), [group.GetCacheKey()])
+
+        again = layer_grouping.GroupLayerBuilder(members, cache=cache)
+        again.BuildLayer()
+        self.assertTrue(again.CacheHit())
+        self.assertEqual([lyr.built for lyr in members], [1, 1])
+
+    def test_merges_cached_zstd_members(self):
+        members = [
+            _FakeLayer('a', [('lib/a.py', 'a')]),
+            _FakeLayer('b', [('lib/b.py', 'b')]),
+        ]
+        for lyr in members:
+            lyr.BuildLayer()
+        # members found in the cache are registry images, which gunzip
+        # whatever their layers are
+        cached = [_RegistryImage(lyr.GetImage()) for lyr in members]
+        for lyr, img in zip(members, cached):
+            lyr.SetImage(img)
+        group = layer_grouping.GroupLayerBuilder(
+            members,
+            build_member=lambda lyr: None,
+            layer_opts=ftl_util.LayerOptions(compression=constants.ZSTD))
+        group.BuildLayer()
+
+        img = group.GetImage()
+        blob = img.blob(img.fs_layers()[0])
+        self.assertTrue(ftl_util.is_zstd(blob))
+        tar = tarfile.open(
+            fileobj=cStringIO.StringIO(ftl_util.zstd_decompress(blob)),
+            mode='r:')
+        self.assertEqual(tar.getnames(), ['lib/a.py', 'lib/b.py'])
+
+    def test_group_of_one_is_its_member(self):
+        member = _FakeLayer('a', [('a.py', 'a')])
+        cache = _FakeCache()
+        group = layer_grouping.GroupLayerBuilder([member], cache=cache)
+        self.assertEqual(group.GetCacheKey(), member.GetCacheKey())
+        self.assertEqual(group.GetLayerName(), 'a')
+        group.BuildLayer()
+        self.assertIs(group.GetImage(), member.GetImage())
+        self.assertEqual(cache.entries, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
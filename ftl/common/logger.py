@@ -17,6 +17,8 @@ import logging
 
 from ftl.common import constants
 
+FORMAT = '%(levelname)-8s %(message)s'
+
 LEVEL_MAP = {
     "NOTSET": logging.NOTSET,
     "DEBUG": logging.DEBUG,
@@ -29,7 +31,7 @@ LEVEL_MAP = {
 
 def setup_logging(args):
     logging.getLogger().setLevel(LEVEL_MAP[args.verbosity])
-    logging.basicConfig(format='%(levelname)-8s %(message)s', datefmt='')
+    logging.basicConfig(format=FORMAT, datefmt='')
 
 
 def preamble(runtime, args):
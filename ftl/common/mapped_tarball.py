@@ -0,0 +1,272 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""This package provides a DockerImage reading `docker save` tarballs through
+a memory map."""
+
+import hashlib
+import json
+import mmap
+import tarfile
+import tempfile
+import threading
+import zlib
+
+from containerregistry.client.v2_2 import docker_digest
+from containerregistry.client.v2_2 import docker_http
+from containerregistry.client.v2_2 import docker_image
+
+from ftl.common import concurrency
+from ftl.common import ftl_error
+from ftl.common import ftl_util
+from ftl.common import image_descriptor
+
+_GZIP_MAGIC = '\x1f\x8b'
+
+
+def _sha256(data):
+    return 'sha256:' + hashlib.sha256(data).hexdigest()
+
+
+class _Layer(object):
+    """_Layer is a layer of the tarball, gzipped once if it is stored
+    uncompressed."""
+
+    def __init__(self, raw, diff_id, layer_opts):
+        if raw[:len(_GZIP_MAGIC)] == _GZIP_MAGIC:
+            self.blob = raw
+            self._u_blob = None
+            self._diff_id_checked = False
+        else:
+            if _sha256(raw) != diff_id:
+                raise ftl_error.InternalError(
+                    'layer %s of the base image tarball does not match its '
+                    'diff_id' % diff_id)
+            with concurrency.memory().Slot():
+                self.blob = _map(ftl_util.gzip_layer(raw, layer_opts))
+            self._u_blob = raw
+            self._diff_id_checked = True
+        self.diff_id = diff_id
+        self.digest = _sha256(self.blob)
+        self._lock = threading.Lock()
+
+    def uncompressed(self):
+        if self._u_blob is not None:
+            return self._u_blob
+        u_blob = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(self.blob)
+        with self._lock:
+            if not self._diff_id_checked:
+                if _sha256(u_blob) != self.diff_id:
+                    raise ftl_error.InternalError(
+                        'layer %s of the base image tarball does not match '
+                        'its diff_id' % self.diff_id)
+                self._diff_id_checked = True
+        return u_blob
+
+
+def _map(data):
+    """Moves data into an anonymous temporary file, returning a view of it
+    that the kernel can page out."""
+    f = tempfile.TemporaryFile()
+    f.write(data)
+    f.flush()
+    view = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    f.close()
+    return buffer(view)
+
+
+class FromMappedTarball(docker_image.DockerImage):
+    """FromMappedTarball serves the image in a `docker save` tarball.
+
+    The tarball is memory mapped and its members are indexed once when the
+    image is opened. Blobs are read-only buffers over the map, so they are
+    neither copied nor read again from the file however often they are
+    asked for. Layers the tarball holds uncompressed are gzipped once, into
+    anonymous temporary files that are mapped as well. Every digest is
+    computed, and every diff_id checked, once.
+    """
+
+    def __init__(self, tarball, name=None, layer_opts=None):
+        self._tarball = tarball
+        self._name = name
+        self._layer_opts = layer_opts
+        self._file = None
+        self._map = None
+        self._members = None
+        self._config_file = None
+        self._layer_names = None
+        self._lock = threading.Lock()
+        self._layers = None
+        self._digest_to_layer = None
+        self._manifest = None
+
+    def _member(self, name):
+        try:
+            offset, size = self._members[name]
+        except KeyError:
+            raise ftl_error.InternalError(
+                '%s not found in base image tarball %s' % (name,
+                                                           self._tarball))
+        return buffer(self._map, offset, size)
+
+    def _image_entry(self):
+        entries = json.loads(str(self._member('manifest.json')))
+        if self._name is not None:
+            for entry in entries:
+                if str(self._name) in (entry.get('RepoTags') or []):
+                    return entry
+        if len(entries) != 1:
+            raise ftl_error.InternalError(
+                'base image tarball %s holds %d images, expected one' %
+                (self._tarball, len(entries)))
+        return entries[0]
+
+    def _index(self):
+        members = {}
+        with tarfile.open(fileobj=self._file, mode='r:') as tar:
+            for member in tar:
+                if member.isreg():
+                    members[member.name] = (member.offset_data, member.size)
+        return members
+
+    def _load_layers(self):
+        """Returns the layers, base first, preparing them on first use."""
+        with self._lock:
+            if self._layers is None:
+                diff_ids = json.loads(self.config_file()).get(
+                    'rootfs', {}).get('diff_ids', [])
+                if len(diff_ids) != len(self._layer_names):
+                    raise ftl_error.InternalError(
+                        'base image tarball %s has %d layers but %d '
+                        'diff_ids' % (self._tarball, len(self._layer_names),
+                                      len(diff_ids)))
+                # layers stored uncompressed are gzipped in memory
+                threads = concurrency.memory().capacity
+                with ftl_util.Timing('indexing_base_image_tarball_layers'):
+                    with ftl_util.ThreadPoolExecutor(
+                            max_workers=threads) as executor:
+                        self._layers = list(
+                            executor.map(
+                                lambda name, diff_id: _Layer(
+                                    self._member(name), diff_id,
+                                    self._layer_opts), self._layer_names,
+                                diff_ids))
+                self._digest_to_layer = dict(
+                    (lyr.digest, lyr) for lyr in self._layers)
+            return self._layers
+
+    def _layer(self, digest):
+        self._load_layers()
+        try:
+            return self._digest_to_layer[digest]
+        except KeyError:
+            raise ValueError('Unknown blob "%s"' % digest)
+
+    def fs_layers(self):
+        """The ordered collection of filesystem layers that
+        comprise this image."""
+        return [lyr.digest for lyr in reversed(self._load_layers())]
+
+    def diff_ids(self):
+        """The ordered list of uncompressed layer hashes
+        (matches fs_layers)."""
+        return [lyr.diff_id for lyr in reversed(self._load_layers())]
+
+    def config_blob(self):
+        return docker_digest.SHA256(self.config_file())
+
+    def blob_set(self):
+        """The unique set of blobs that compose to create the filesystem."""
+        return set(self.fs_layers() + [self.config_blob()])
+
+    def digest(self):
+        """The digest of the manifest."""
+        return docker_digest.SHA256(self.manifest())
+
+    def media_type(self):
+        """The media type of the manifest."""
+        return docker_http.MANIFEST_SCHEMA2_MIME
+
+    def manifest(self):
+        """The JSON manifest of the image, derived from the tarball."""
+        if self._manifest is None:
+            content = self.config_file()
+            self._manifest = json.dumps(
+                {
+                    'schemaVersion':
+                    2,
+                    'mediaType':
+                    docker_http.MANIFEST_SCHEMA2_MIME,
+                    'config': {
+                        'mediaType': docker_http.CONFIG_JSON_MIME,
+                        'size': len(content),
+                        'digest': docker_digest.SHA256(content)
+                    },
+                    'layers': [{
+                        'mediaType': docker_http.LAYER_MIME,
+                        'size': len(lyr.blob),
+                        'digest': lyr.digest
+                    } for lyr in self._load_layers()]
+                },
+                sort_keys=True)
+        return self._manifest
+
+    def config_file(self):
+        """The raw blob string of the config file."""
+        return self._config_file
+
+    def blob_size(self, digest):
+        """The byte size of the raw blob."""
+        if digest == self.config_blob():
+            return len(self.config_file())
+        return len(self._layer(digest).blob)
+
+    def blob(self, digest):
+        """The raw blob of the layer, as a read-only buffer.
+
+        Args:
+          digest: the 'algo:digest' of the layer being addressed.
+        """
+        if digest == self.config_blob():
+            return self.config_file()
+        return self._layer(digest).blob
+
+    def uncompressed_blob(self, digest):
+        """Same as blob() but uncompressed."""
+        return self._layer(digest).uncompressed()
+
+    def uncompressed_layer(self, diff_id):
+        """Same as uncompressed_blob() but addressed by diff_id."""
+        return self.uncompressed_blob(
+            image_descriptor.describe(self).digest(diff_id))
+
+    def __enter__(self):
+        """Maps and indexes the tarball."""
+        with ftl_util.Timing('indexing_base_image_tarball'):
+            self._file = open(self._tarball, 'rb')
+            self._map = mmap.mmap(
+                self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._members = self._index()
+            entry = self._image_entry()
+            self._config_file = str(self._member(entry['Config']))
+            self._layer_names = entry['Layers']
+        return self
+
+    def __exit__(self, unused_type, unused_value, unused_traceback):
+        """Unmaps the tarball."""
+        self._map.close()
+        self._file.close()
+
+    def __str__(self):
+        """A human-readable representation of the image."""
+        return '<mapped tarball %s>' % self._tarball
@@ -0,0 +1,125 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Unit tests for mapped_tarball.py"""
+
+import cStringIO
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+import mapped_tarball
+
+
+def _sha256(data):
+    return 'sha256:' + hashlib.sha256(data).hexdigest()
+
+
+def _layer(name, contents):
+    buf = cStringIO.StringIO()
+    with tarfile.open(fileobj=buf, mode='w:') as tar:
+        info = tarfile.TarInfo(name)
+        info.size = len(contents)
+        tar.addfile(info, cStringIO.StringIO(contents))
+    return buf.getvalue()
+
+
+def _gzip(data):
+    buf = cStringIO.StringIO()
+    with gzip.GzipFile(fileobj=buf, mode='w') as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+class MappedTarballTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.tarball = os.path.join(self.tmp_dir, 'base.tar')
+        self.base = _layer('etc/os-release', 'base')
+        self.top = _layer('usr/bin/tool', 'tool' * 1000)
+        self.top_gz = _gzip(self.top)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _write(self, diff_ids=None):
+        config = json.dumps({
+            'rootfs': {
+                'type': 'layers',
+                'diff_ids': diff_ids or [_sha256(self.base),
+                                         _sha256(self.top)],
+            }
+        })
+        files = [
+            ('manifest.json',
+             json.dumps([{
+                 'Config': 'config.json',
+                 'RepoTags': ['gcr.io/test/base:latest'],
+                 'Layers': ['base/layer.tar', 'top.tar.gz'],
+             }])),
+            ('config.json', config),
+            ('base/layer.tar', self.base),
+            ('top.tar.gz', self.top_gz),
+        ]
+        with tarfile.open(self.tarball, mode='w') as tar:
+            for name, data in files:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, cStringIO.StringIO(data))
+        return config
+
+    def test_serves_the_image(self):
+        config = self._write()
+        with mapped_tarball.FromMappedTarball(self.tarball) as img:
+            self.assertEqual(img.config_file(), config)
+            self.assertEqual(img.config_blob(), _sha256(config))
+            self.assertEqual(img.diff_ids(),
+                             [_sha256(self.top), _sha256(self.base)])
+
+            top, base = img.fs_layers()
+            # a gzip layer is served as stored, without a copy
+            self.assertEqual(top, _sha256(self.top_gz))
+            self.assertIsInstance(img.blob(top), buffer)
+            self.assertEqual(str(img.blob(top)), self.top_gz)
+            self.assertEqual(img.uncompressed_blob(top), self.top)
+            # an uncompressed layer is gzipped once
+            self.assertIs(img.blob(base), img.blob(base))
+            self.assertEqual(_sha256(img.blob(base)), base)
+            self.assertEqual(img.blob_size(base), len(img.blob(base)))
+            self.assertEqual(str(img.uncompressed_blob(base)), self.base)
+
+            manifest = json.loads(img.manifest())
+            self.assertEqual([lyr['digest'] for lyr in manifest['layers']],
+                             [base, top])
+            self.assertEqual(manifest['config']['digest'], _sha256(config))
+
+    def test_checks_diff_ids(self):
+        self._write(diff_ids=[_sha256('not the base'), _sha256(self.top)])
+        with mapped_tarball.FromMappedTarball(self.tarball) as img:
+            with self.assertRaisesRegexp(Exception, 'does not match'):
+                img.manifest()
+
+        self._write(diff_ids=[_sha256(self.base), _sha256('not the top')])
+        with mapped_tarball.FromMappedTarball(self.tarball) as img:
+            top = img.fs_layers()[0]
+            with self.assertRaisesRegexp(Exception, 'does not match'):
+                img.uncompressed_blob(top)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""This package writes images into OCI image-layout directories."""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+from containerregistry.client.v2_2 import docker_http
+
+from ftl.common import concurrency
+from ftl.common import constants
+from ftl.common import ftl_error
+from ftl.common import ftl_util
+from ftl.common import tar_to_dockerimage
+
+LAYOUT_FILE = 'oci-layout'
+INDEX_FILE = 'index.json'
+REF_NAME_ANNOTATION = 'org.opencontainers.image.ref.name'
+
+_LAYOUT_VERSION = '1.0.0'
+
+
+def Write(layout_dir, image, ref_name, threads=None):
+    """Writes an image into an OCI image-layout directory.
+
+    Blobs already in the directory, from earlier builds, are not fetched
+    again, the others are written concurrently, holding a slot of the
+    memory budget each as they are fetched whole. Every file is written to a
+    temporary file and renamed into place, and index.json is written last,
+    so an interrupted write leaves the directory pointing at the images
+    written before.
+
+    Args:
+      layout_dir: the image-layout directory, created if needed.
+      image: the docker_image.DockerImage to write.
+      ref_name: the name the image gets in index.json, replacing an older
+        image of that name.
+      threads: the number of blobs written at once, the network budget by
+        default.
+
+    Returns:
+      the digest of the manifest written.
+    """
+    threads = threads or concurrency.network().capacity
+    image = tar_to_dockerimage.OCIImage(
+        image, tar_to_dockerimage.oci_layer_descriptors(image))
+    blobs_dir = os.path.join(layout_dir, 'blobs', 'sha256')
+    if not os.path.isdir(blobs_dir):
+        os.makedirs(blobs_dir)
+    layout_path = os.path.join(layout_dir, LAYOUT_FILE)
+    if not os.path.isfile(layout_path):
+        _write_file(layout_path,
+                    json.dumps({'imageLayoutVersion': _LAYOUT_VERSION}))
+
+    manifest = image.manifest()
+    blobs = [(image.config_blob(), image.config_file)]
+    for layer in json.loads(manifest)['layers']:
+        if layer['mediaType'] == constants.OCI_NONDISTRIBUTABLE_LAYER_MIME:
+            # foreign layers are fetched from their urls, not stored
+            continue
+        digest = layer['digest']
+        blobs.append((digest, lambda digest=digest: image.blob(digest)))
+
+    def write_blob(blob):
+        digest, fetch = blob
+        return _write_blob(blobs_dir, digest, fetch)
+
+    with ftl_util.Timing('writing_oci_layout_blobs'):
+        with ftl_util.ThreadPoolExecutor(max_workers=threads) as executor:
+            written = sum(executor.map(write_blob, blobs))
+    logging.info('Wrote %d blobs to %s, %d were already there', written,
+                 layout_dir, len(blobs) - written)
+
+    digest = image.digest()
+    _write_blob(blobs_dir, digest, lambda: manifest)
+    _write_index(layout_dir, {
+        'mediaType': docker_http.OCI_MANIFEST_MIME,
+        'digest': digest,
+        'size': len(manifest),
+        'annotations': {
+            REF_NAME_ANNOTATION: ref_name
+        },
+    })
+    return digest
+
+
+def _blob_path(blobs_dir, digest):
+    return os.path.join(blobs_dir, digest.split(':', 1)[1])
+
+
+def _write_blob(blobs_dir, digest, fetch):
+    """Writes a blob unless the directory holds it. Returns whether it was
+    written."""
+    path = _blob_path(blobs_dir, digest)
+    if os.path.isfile(path):
+        return False
+    with concurrency.memory().Slot():
+        content = fetch()
+        if 'sha256:' + hashlib.sha256(content).hexdigest() != digest:
+            raise ftl_error.InternalError(
+                'blob %s does not match its digest' % digest)
+        _write_file(path, content)
+    return True
+
+
+def _write_index(layout_dir, descriptor):
+    index_path = os.path.join(layout_dir, INDEX_FILE)
+    index = {'schemaVersion': 2, 'manifests': []}
+    if os.path.isfile(index_path):
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+    ref_name = descriptor['annotations'][REF_NAME_ANNOTATION]
+    index['manifests'] = [
+        m for m in index.get('manifests', [])
+        if m.get('annotations', {}).get(REF_NAME_ANNOTATION) != ref_name
+    ] + [descriptor]
+    _write_file(index_path, json.dumps(index, sort_keys=True))
+
+
+def _write_file(path, content):
+    """Writes a file durably, through a rename so it is never seen partly
+    written."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        # mkstemp only lets the owner read the file
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
@@ -0,0 +1,132 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Unit tests for oci_layout.py"""
+
+import hashlib
+import json
+import mock
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import concurrency
+import ftl_util
+import oci_layout
+import tar_to_dockerimage
+
+
+class _CountingImage(tar_to_dockerimage.OCIImage):
+    def __init__(self, image):
+        super(_CountingImage, self).__init__(image, {})
+        self.fetched = []
+
+    def blob(self, digest):
+        self.fetched.append(digest)
+        return super(_CountingImage, self).blob(digest)
+
+
+class _ConcurrencyImage(tar_to_dockerimage.OCIImage):
+    def __init__(self, image):
+        super(_ConcurrencyImage, self).__init__(image, {})
+        self._lock = threading.Lock()
+        self._fetching = 0
+        self.most_fetching = 0
+
+    def blob(self, digest):
+        with self._lock:
+            self._fetching += 1
+            self.most_fetching = max(self.most_fetching, self._fetching)
+        time.sleep(0.05)
+        with self._lock:
+            self._fetching -= 1
+        return super(_ConcurrencyImage, self).blob(digest)
+
+
+def _image(*contents):
+    u_blobs = [c * 1024 for c in contents]
+    return tar_to_dockerimage.FromFSImage(
+        [ftl_util.gzip_layer(u_blob) for u_blob in u_blobs], u_blobs)
+
+
+class OCILayoutTest(unittest.TestCase):
+    def setUp(self):
+        self.layout_dir = os.path.join(tempfile.mkdtemp(), 'layout')
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.layout_dir))
+
+    def _read(self, *path):
+        with open(os.path.join(self.layout_dir, *path), 'rb') as f:
+            return f.read()
+
+    def _blob(self, digest):
+        return self._read('blobs', 'sha256', digest.split(':')[1])
+
+    def _index(self):
+        return json.loads(self._read(oci_layout.INDEX_FILE))
+
+    def test_write(self):
+        img = _image('a')
+        digest = oci_layout.Write(self.layout_dir, img, 'gcr.io/test/a:1')
+
+        self.assertEqual(
+            json.loads(self._read(oci_layout.LAYOUT_FILE)),
+            {'imageLayoutVersion': '1.0.0'})
+        index = self._index()
+        self.assertEqual(index['schemaVersion'], 2)
+        self.assertEqual([m['digest'] for m in index['manifests']], [digest])
+        self.assertEqual(
+            index['manifests'][0]['annotations'],
+            {oci_layout.REF_NAME_ANNOTATION: 'gcr.io/test/a:1'})
+
+        manifest = json.loads(self._blob(digest))
+        self.assertEqual(
+            'sha256:' + hashlib.sha256(self._blob(digest)).hexdigest(),
+            digest)
+        self.assertEqual(
+            self._blob(manifest['config']['digest']), img.config_file())
+        for layer in manifest['layers']:
+            self.assertEqual(self._blob(layer['digest']),
+                             img.blob(layer['digest']))
+
+    def test_reuses_blobs_and_replaces_refs(self):
+        first = _image('a')
+        oci_layout.Write(self.layout_dir, first, 'gcr.io/test/a:1')
+
+        again = _CountingImage(first)
+        oci_layout.Write(self.layout_dir, again, 'gcr.io/test/a:2')
+        self.assertEqual(again.fetched, [])
+
+        other = _image('b')
+        digest = oci_layout.Write(self.layout_dir, other, 'gcr.io/test/a:1')
+        refs = dict((m['annotations'][oci_layout.REF_NAME_ANNOTATION],
+                     m['digest']) for m in self._index()['manifests'])
+        self.assertEqual(sorted(refs), ['gcr.io/test/a:1', 'gcr.io/test/a:2'])
+        self.assertEqual(refs['gcr.io/test/a:1'], digest)
+
+    def test_fetches_within_memory_budget(self):
+        img = _ConcurrencyImage(_image('a', 'b', 'c', 'd'))
+        memory = concurrency.Budget('memory', 1)
+        with mock.patch.object(oci_layout.concurrency, 'memory',
+                               return_value=memory):
+            oci_layout.Write(self.layout_dir, img, 'gcr.io/test/a:1',
+                             threads=4)
+        self.assertEqual(img.most_fetching, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
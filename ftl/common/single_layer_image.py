@@ -49,6 +49,26 @@ class CacheableLayerBuilder(BaseLayerBuilder):
 
     __metaclass__ = abc.ABCMeta  # For enforcing that methods are overriden.
 
+    def __init__(self):
+        super(CacheableLayerBuilder, self).__init__()
+        self._cache_hit = None
+
+    def CacheHit(self):
+        """
+        Returns:
+          whether BuildLayer found the layer in the cache, None if it has
+          not run yet
+        """
+        return self._cache_hit
+
+    def GetLayerName(self):
+        """
+        Returns:
+          a human readable name for the layer that stays the same across
+          builds, used to report on and track the history of the layer
+        """
+        return self.__class__.__name__
+
     @abc.abstractmethod
     def GetCacheKeyRaw(self):
         """
@@ -0,0 +1,115 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Startup tests for the ftl entry points"""
+
+import json
+import os
+import subprocess
+import sys
+import time
+import unittest
+
+_RUNTIMES = ['python', 'node', 'php']
+
+# modules only needed once a build runs
+_HEAVY_MODULES = [
+    'concurrent.futures',
+    'containerregistry.client.v2_2.append',
+    'containerregistry.client.v2_2.docker_image',
+    'containerregistry.client.v2_2.docker_session',
+    'containerregistry.client.v2_2.save',
+    'httplib2',
+]
+
+# wall time budget in seconds for `main.py --version`, interpreter startup
+# included; generous as timing depends on the host, set the variable for a
+# tighter one
+_VERSION_BUDGET_ENV = 'FTL_STARTUP_BUDGET_SECONDS'
+_VERSION_BUDGET_SECONDS = 10.0
+
+_LOADED_MODULES = """
+import json
+import sys
+import ftl.{runtime}.main as main
+try:
+    main.main({cli_args!r})
+except SystemExit:
+    pass
+print(json.dumps(sorted(m for m, v in sys.modules.items() if v)))
+"""
+
+
+def _env():
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(p for p in sys.path if p)
+    return env
+
+
+class StartupTest(unittest.TestCase):
+    def _loaded_modules(self, runtime, cli_args):
+        out = subprocess.check_output(
+            [
+                sys.executable, '-c',
+                _LOADED_MODULES.format(runtime=runtime, cli_args=cli_args)
+            ],
+            env=_env(),
+            stderr=subprocess.STDOUT)
+        return json.loads(out.splitlines()[-1])
+
+    def _assert_light(self, runtime, cli_args):
+        loaded = self._loaded_modules(runtime, cli_args)
+        heavy = [m for m in _HEAVY_MODULES if m in loaded]
+        heavy += [m for m in loaded if m.startswith('ftl.%s.' % runtime)
+                  and m != 'ftl.%s.main' % runtime]
+        self.assertEqual(heavy, [], '%s %s loaded %s' % (runtime, cli_args,
+                                                         heavy))
+
+    def test_import_is_light(self):
+        for runtime in _RUNTIMES:
+            self._assert_light(runtime, ['--version'])
+
+    def test_argument_errors_are_light(self):
+        for runtime in _RUNTIMES:
+            self._assert_light(runtime, [])
+            self._assert_light(runtime, ['--base', 'gcr.io/base'])
+
+    def test_version_budget(self):
+        import ftl
+        budget = float(
+            os.environ.get(_VERSION_BUDGET_ENV) or _VERSION_BUDGET_SECONDS)
+        for runtime in _RUNTIMES:
+            main = os.path.join(
+                os.path.dirname(ftl.__file__), runtime, 'main.py')
+            start = time.time()
+            subprocess.check_output(
+                [sys.executable, main, '--version'],
+                env=_env(),
+                stderr=subprocess.STDOUT)
+            elapsed = time.time() - start
+            if elapsed < budget:
+                continue
+            # the functions startup spent the most time in, imports included
+            profile = subprocess.check_output(
+                [
+                    sys.executable, '-m', 'cProfile', '-s', 'cumulative',
+                    main, '--version'
+                ],
+                env=_env(),
+                stderr=subprocess.STDOUT)
+            self.fail('%s --version took %.2fs:\n%s' % (
+                runtime, elapsed, '\n'.join(profile.splitlines()[:40])))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -20,6 +20,60 @@ from containerregistry.client.v2_2 import docker_image
 from containerregistry.client.v2_2 import docker_http
 from containerregistry.transform.v2_2 import metadata as v2_2_metadata
 
+from ftl.common import constants
+from ftl.common import estargz
+from ftl.common import ftl_util
+from ftl.common import image_descriptor
+
+_OCI_LAYER_MIMES = {
+    docker_http.LAYER_MIME: constants.OCI_LAYER_GZIP_MIME,
+    constants.DOCKER_FOREIGN_LAYER_MIME:
+    constants.OCI_NONDISTRIBUTABLE_LAYER_MIME,
+}
+
+
+def oci_layer_descriptors(image):
+    """Returns, by digest, the descriptor fields of the layers of an image
+    that only an OCI manifest can carry: the zstd media type and
+    annotations."""
+    descriptors = {}
+    for layer in image_descriptor.describe(image).layers:
+        descriptor = {}
+        if layer['mediaType'] == constants.OCI_LAYER_ZSTD_MIME:
+            descriptor['mediaType'] = layer['mediaType']
+        if layer.get('annotations'):
+            descriptor['annotations'] = layer['annotations']
+        if descriptor:
+            descriptors[layer['digest']] = descriptor
+    return descriptors
+
+
+def _oci_manifest(manifest, descriptors):
+    """Rewrites a docker manifest to an OCI one, updating the layers with
+    the given descriptor fields."""
+    manifest = json.loads(manifest)
+    manifest['mediaType'] = docker_http.OCI_MANIFEST_MIME
+    manifest['config']['mediaType'] = constants.OCI_CONFIG_MIME
+    for layer in manifest['layers']:
+        layer['mediaType'] = _OCI_LAYER_MIMES.get(layer['mediaType'],
+                                                  layer['mediaType'])
+        layer.update(descriptors.get(layer['digest'], {}))
+    return json.dumps(manifest, sort_keys=True)
+
+
+def _blob_descriptor(blob, u_blob):
+    if ftl_util.is_zstd(blob):
+        return {'mediaType': constants.OCI_LAYER_ZSTD_MIME}
+    toc_digest = estargz.toc_digest(blob)
+    if toc_digest:
+        return {
+            'annotations': {
+                estargz.TOC_DIGEST_ANNOTATION: toc_digest,
+                estargz.UNCOMPRESSED_SIZE_ANNOTATION: str(len(u_blob)),
+            }
+        }
+    return {}
+
 
 class FromFSImage(docker_image.DockerImage):
     """Interface for implementations that interact with Docker images."""
@@ -56,18 +110,15 @@ class FromFSImage(docker_image.DockerImage):
     def fs_layers(self):
         """The ordered collection of filesystem layers that
         comprise this image."""
-        manifest = json.loads(self.manifest())
-        return [x['digest'] for x in reversed(manifest['layers'])]
+        return list(image_descriptor.describe(self).fs_layers)
 
     def diff_ids(self):
         """The ordered list of uncompressed layer hashes
         (matches fs_layers)."""
-        cfg = json.loads(self.config_file())
-        return list(reversed(cfg.get('rootfs', {}).get('diff_ids', [])))
+        return list(image_descriptor.describe(self).diff_ids)
 
     def config_blob(self):
-        manifest = json.loads(self.manifest())
-        return manifest['config']['digest']
+        return image_descriptor.describe(self).config_blob
 
     def blob_set(self):
         """The unique set of blobs that compose to create the filesystem."""
@@ -79,9 +130,7 @@ class FromFSImage(docker_image.DockerImage):
 
     def media_type(self):
         """The media type of the manifest."""
-        manifest = json.loads(self.manifest())
-
-        return manifest.get('mediaType', docker_http.OCI_MANIFEST_MIME)
+        return image_descriptor.describe(self).media_type
 
     def manifest(self):
         """The JSON manifest referenced by the tag/digest.
@@ -109,6 +158,14 @@ class FromFSImage(docker_image.DockerImage):
                     } for digest in self._digest_to_blob]
                 },
                 sort_keys=True)
+            descriptors = {}
+            for digest, blob in self._digest_to_blob.items():
+                descriptor = _blob_descriptor(blob,
+                                              self._digest_to_u_blob[digest])
+                if descriptor:
+                    descriptors[digest] = descriptor
+            if descriptors:
+                self._manifest = _oci_manifest(self._manifest, descriptors)
         return self._manifest
 
     def config_file(self):
@@ -160,11 +217,7 @@ class FromFSImage(docker_image.DockerImage):
         return self._digest_to_u_blob[digest]
 
     def _diff_id_to_digest(self, diff_id):
-        for (this_digest, this_diff_id) in zip(self.fs_layers(),
-                                               self.diff_ids()):
-            if this_diff_id == diff_id:
-                return this_digest
-        raise ValueError('Unmatched "diff_id": "%s"' % diff_id)
+        return image_descriptor.describe(self).digest(diff_id)
 
     def layer(self, diff_id):
         """Like `blob()`, but accepts the `diff_id` instead.
@@ -192,3 +245,62 @@ class FromFSImage(docker_image.DockerImage):
     def __str__(self):
         """A human-readable representation of the image."""
         return str(type(self))
+
+
+class OCIImage(docker_image.DockerImage):
+    """OCIImage presents an image under an OCI manifest, updating its layer
+    descriptors with the fields of oci_layer_descriptors. Everything but the
+    manifest comes from the wrapped image."""
+
+    def __init__(self, image, descriptors):
+        self._image = image
+        self._descriptors = descriptors
+        self._manifest = None
+
+    def fs_layers(self):
+        return list(image_descriptor.describe(self).fs_layers)
+
+    def diff_ids(self):
+        return list(image_descriptor.describe(self).diff_ids)
+
+    def config_blob(self):
+        return image_descriptor.describe(self).config_blob
+
+    def blob_set(self):
+        return set(self.fs_layers() + [self.config_blob()])
+
+    def digest(self):
+        return docker_digest.SHA256(self.manifest())
+
+    def media_type(self):
+        return docker_http.OCI_MANIFEST_MIME
+
+    def manifest(self):
+        if self._manifest is None:
+            self._manifest = _oci_manifest(self._image.manifest(),
+                                           self._descriptors)
+        return self._manifest
+
+    def config_file(self):
+        return self._image.config_file()
+
+    def blob_size(self, digest):
+        return self._image.blob_size(digest)
+
+    def blob(self, digest):
+        return self._image.blob(digest)
+
+    def uncompressed_blob(self, digest):
+        media_type = self._descriptors.get(digest, {}).get('mediaType')
+        if media_type == constants.OCI_LAYER_ZSTD_MIME:
+            return ftl_util.zstd_decompress(self.blob(digest))
+        return self._image.uncompressed_blob(digest)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, unused_type, unused_value, unused_traceback):
+        pass
+
+    def __str__(self):
+        return str(type(self))
@@ -13,14 +13,22 @@
 # limitations under the License.
 """Unit tests for ftl_util"""
 
+import os
+import sys
 import unittest
 import constants
 import StringIO
 import logging
 import mock
+import tarfile
+import tempfile
+import time
+import gzip
+import json
 
 import ftl_util
 import logger
+import tar_to_dockerimage
 
 
 class UtilTest(unittest.TestCase):
@@ -83,6 +91,208 @@ class UtilTest(unittest.TestCase):
 
         self.assertEqual(log_pieces, None)
 
+    def test_zip_dir_to_layer_sha_reproducible(self):
+        layers = []
+        for mtime in [1000000000, 1500000000]:
+            app_dir = tempfile.mkdtemp()
+            for name in ['b.txt', 'a.txt']:
+                path = os.path.join(app_dir, name)
+                with open(path, 'w') as f:
+                    f.write(name)
+                os.utime(path, (mtime, mtime))
+            with mock.patch.dict(os.environ,
+                                 {constants.SOURCE_DATE_EPOCH: '1'}):
+                layers.append(ftl_util.zip_dir_to_layer_sha(app_dir, 'srv'))
+        self.assertEqual(layers[0], layers[1])
+
+        # files older than the epoch keep their mtime
+        with mock.patch.dict(os.environ,
+                             {constants.SOURCE_DATE_EPOCH: '1200000000'}):
+            _, u_blob = ftl_util.zip_dir_to_layer_sha(app_dir, 'srv')
+        with tarfile.open(fileobj=StringIO.StringIO(u_blob)) as tf:
+            self.assertEqual(tf.getmember('srv/./a.txt').mtime, 1200000000)
+        os.utime(os.path.join(app_dir, 'a.txt'), (1000000000, 1000000000))
+        with mock.patch.dict(os.environ,
+                             {constants.SOURCE_DATE_EPOCH: '1200000000'}):
+            _, u_blob = ftl_util.zip_dir_to_layer_sha(app_dir, 'srv')
+        with tarfile.open(fileobj=StringIO.StringIO(u_blob)) as tf:
+            self.assertEqual(tf.getmember('srv/./a.txt').mtime, 1000000000)
+
+    def test_zip_dir_to_layer_sha_links_duplicates(self):
+        app_dir = tempfile.mkdtemp()
+        files = {
+            'a/LICENSE': 'license',
+            'b/LICENSE': 'license',
+            'c/LICENSE': 'license',
+            'c/index.js': 'other',
+            'd/index.js': 'index',
+        }
+        for name, contents in files.items():
+            path = os.path.join(app_dir, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(contents)
+        os.chmod(os.path.join(app_dir, 'b/LICENSE'), 0o755)
+
+        layer_opts = ftl_util.LayerOptions(
+            dedupe_files=True, prioritized_files=['srv/c/LICENSE'])
+        _, u_blob = ftl_util.zip_dir_to_layer_sha(app_dir, 'srv',
+                                                  layer_opts=layer_opts)
+        with tarfile.open(fileobj=StringIO.StringIO(u_blob)) as tf:
+            members = dict((m.name, m) for m in tf.getmembers())
+            # a different mode and a prioritized file keep their copies
+            self.assertEqual(
+                [name for name, m in members.items() if m.islnk()], [])
+            for name, contents in files.items():
+                self.assertEqual(
+                    tf.extractfile('srv/./' + name).read(), contents)
+
+        with open(os.path.join(app_dir, 'd/LICENSE'), 'w') as f:
+            f.write('license')
+        _, u_blob = ftl_util.zip_dir_to_layer_sha(app_dir, 'srv',
+                                                  layer_opts=layer_opts)
+        with tarfile.open(fileobj=StringIO.StringIO(u_blob)) as tf:
+            link = tf.getmember('srv/./d/LICENSE')
+            self.assertTrue(link.islnk())
+            self.assertEqual(link.linkname, 'srv/./a/LICENSE')
+            self.assertEqual(tf.extractfile(link).read(), 'license')
+
+    def test_gzip_layer(self):
+        data = ''.join(chr(i % 7) * (i % 13) for i in range(20000))
+        blobs = [
+            ftl_util.gzip_layer(
+                data,
+                ftl_util.LayerOptions(compression_threads=threads),
+                block_size=1000) for threads in [1, 4]
+        ]
+        # the output does not depend on the number of threads
+        self.assertEqual(blobs[0], blobs[1])
+        self.assertEqual(
+            gzip.GzipFile(fileobj=StringIO.StringIO(blobs[0])).read(), data)
+        self.assertEqual(
+            gzip.GzipFile(
+                fileobj=StringIO.StringIO(ftl_util.gzip_layer(''))).read(),
+            '')
+
+    def test_oci_image(self):
+        zstd_blob = constants.ZSTD_MAGIC + 'layer'
+        self.assertTrue(ftl_util.is_zstd(zstd_blob))
+        self.assertFalse(ftl_util.is_zstd(ftl_util.gzip_layer('layer')))
+
+        docker_layer = 'application/vnd.docker.image.rootfs.diff.tar.gzip'
+        img = mock.Mock()
+        img.manifest.return_value = json.dumps({
+            'schemaVersion': 2,
+            'mediaType':
+            'application/vnd.docker.distribution.manifest.v2+json',
+            'config': {
+                'mediaType':
+                'application/vnd.docker.container.image.v1+json',
+                'digest': 'sha256:config',
+                'size': 2,
+            },
+            'layers': [{
+                'mediaType': docker_layer,
+                'digest': 'sha256:base',
+                'size': 4,
+            }, {
+                'mediaType': docker_layer,
+                'digest': 'sha256:deps',
+                'size': 4,
+            }],
+        })
+        img.config_file.return_value = '{}'
+        descriptors = {
+            'sha256:deps': {
+                'mediaType': constants.OCI_LAYER_ZSTD_MIME,
+                'annotations': {
+                    'key': 'value'
+                },
+            }
+        }
+        oci = tar_to_dockerimage.OCIImage(img, descriptors)
+        self.assertEqual(
+            tar_to_dockerimage.oci_layer_descriptors(oci), descriptors)
+        manifest = json.loads(oci.manifest())
+        self.assertEqual(manifest['mediaType'], oci.media_type())
+        self.assertEqual(manifest['config']['mediaType'],
+                         constants.OCI_CONFIG_MIME)
+        self.assertEqual([lyr['mediaType'] for lyr in manifest['layers']], [
+            constants.OCI_LAYER_GZIP_MIME, constants.OCI_LAYER_ZSTD_MIME
+        ])
+        self.assertEqual(oci.fs_layers(), ['sha256:deps', 'sha256:base'])
+
+    def test_dir_hash(self):
+        app_dir = tempfile.mkdtemp()
+        path = os.path.join(app_dir, 'app.py')
+        with open(path, 'w') as f:
+            f.write('app')
+        with open(path + 'c', 'w') as f:
+            f.write('bytecode')
+        before = ftl_util.dir_hash(app_dir)
+
+        os.utime(path, (1000000000, 1000000000))
+        os.remove(path + 'c')
+        self.assertEqual(ftl_util.dir_hash(app_dir), before)
+        os.mkdir(os.path.join(app_dir, '__pycache__'))
+        with open(os.path.join(app_dir, '__pycache__', 'app.cpython-37.pyc'),
+                  'w') as f:
+            f.write('bytecode')
+        self.assertEqual(ftl_util.dir_hash(app_dir), before)
+
+        with open(path, 'w') as f:
+            f.write('changed')
+        self.assertNotEqual(ftl_util.dir_hash(app_dir), before)
+
+    def test_run_command_keeps_output_tail(self):
+        script = ('import sys\n'
+                  'data = sys.stdin.read()\n'
+                  'for i in range(1000):\n'
+                  '    print(i)\n'
+                  'sys.stderr.write(data)\n'
+                  'sys.exit(len(sys.argv) - 1)\n')
+        ftl_util.pop_command_metrics()
+        out = ftl_util.run_command(
+            'count', [sys.executable, '-c', script],
+            cmd_input='input\n',
+            tail_lines=3)
+        self.assertEqual(
+            out, 'stdout: [997 earlier lines omitted]\n997\n998\n999\n, '
+            'stderr: input\n')
+        with self.assertRaisesRegexp(
+                Exception, '(?s)stdout output:\n\\[997 earlier lines omitted'
+                '\\]\n997\n998\n999\n.*stderr output:\ninput\n.*'
+                '`count` returned code: 1'):
+            ftl_util.run_command(
+                'count', [sys.executable, '-c', script, 'fail'],
+                cmd_input='input\n',
+                tail_lines=3)
+        metrics = ftl_util.pop_command_metrics()
+        self.assertEqual(metrics.keys(), ['count'])
+        self.assertEqual(metrics['count']['runs'], 2)
+        self.assertGreater(metrics['count']['wall_seconds'], 0)
+        self.assertEqual(ftl_util.pop_command_metrics(), {})
+
+    def test_executor_fails_fast(self):
+        started = []
+
+        def work(i):
+            if i == 0:
+                ftl_util.run_command('sleep', ['sleep', '60'])
+            elif i == 1:
+                time.sleep(0.5)
+                raise ValueError('first error')
+            started.append(i)
+
+        start = time.time()
+        with self.assertRaisesRegexp(ValueError, 'first error'):
+            with ftl_util.ThreadPoolExecutor(max_workers=2) as executor:
+                for result in executor.map(work, range(4)):
+                    pass
+        self.assertLess(time.time() - start, 30)
+        self.assertEqual(started, [])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -13,15 +13,18 @@
 # limitations under the License.
 """This package defines the interface for orchestrating image builds."""
 
-import os
 import logging
+import os
+import shutil
 
 from ftl.common import builder
 from ftl.common import constants
+from ftl.common import context
 from ftl.common import ftl_util
 from ftl.common import ftl_error
 from ftl.common import layer_builder as base_builder
 from ftl.node import layer_builder as node_builder
+from ftl.node import node_util
 
 
 class Node(builder.RuntimeBase):
@@ -30,8 +33,18 @@ class Node(builder.RuntimeBase):
             constants.PACKAGE_LOCK, constants.YARN_LOCK,
             constants.PACKAGE_JSON, constants.NPMRC
         ])
-        self._gen_package_lock_if_required(self._ctx)
+        # generated descriptors are kept over the app's, not written to it
+        self._ctx = context.Overlay(self._ctx)
+        if not args.plan:
+            # a plan must not run npm, without a lockfile its keys are
+            # unknown, see _generates_lock
+            self._gen_package_lock_if_required(self._ctx)
         self._should_use_yarn = self._should_use_yarn(self._ctx)
+        self._package_store = None
+        if args.package_store_dir:
+            self._package_store = node_util.PackageStore(
+                args.package_store_dir,
+                args.package_store_max_mb * 1024 * 1024)
 
     def _gen_package_lock_if_required(self, ctx):
         if not ftl_util.has_pkg_descriptor(self._descriptor_files, self._ctx):
@@ -43,11 +56,25 @@ class Node(builder.RuntimeBase):
             logging.info('Found neither yarn.lock or package-lock.json,'
                          'generating package-lock.json from package.json')
             gen_package_lock_cmd = ['npm', 'install', '--package-lock-only']
-            ftl_util.run_command(
-                'gen_package_lock',
-                gen_package_lock_cmd,
-                cmd_cwd=self._args.directory,
-                err_type=ftl_error.FTLErrors.USER())
+            lock_dir = node_util.copy_app_dir(self._args.directory)
+            try:
+                ftl_util.run_command(
+                    'gen_package_lock',
+                    gen_package_lock_cmd,
+                    cmd_cwd=lock_dir,
+                    err_type=ftl_error.FTLErrors.USER())
+                with open(os.path.join(lock_dir, constants.PACKAGE_LOCK),
+                          'rb') as f:
+                    ctx.AddFile(constants.PACKAGE_LOCK, f.read())
+            finally:
+                shutil.rmtree(lock_dir, ignore_errors=True)
+
+    def _generates_lock(self):
+        # unless a plan, the generated package-lock.json is in the context
+        return (ftl_util.has_pkg_descriptor(self._descriptor_files, self._ctx)
+                and self._ctx.Contains(constants.PACKAGE_JSON)
+                and not self._ctx.Contains(constants.YARN_LOCK)
+                and not self._ctx.Contains(constants.PACKAGE_LOCK))
 
     def _should_use_yarn(self, ctx):
         if ctx.Contains(constants.YARN_LOCK):
@@ -59,42 +86,79 @@ class Node(builder.RuntimeBase):
             return True
         return False
 
-    def Build(self):
-        lyr_imgs = []
-        lyr_imgs.append(self._base_image)
-        # delete any existing files in node_modules folder
-        if self._args.directory:
-            modules_dir = os.path.join(self._args.directory, "node_modules")
-            rm_cmd = ['rm', '-rf', modules_dir]
-            ftl_util.run_command('rm_node_modules', rm_cmd)
-            os.makedirs(os.path.join(modules_dir))
-
-        if ftl_util.has_pkg_descriptor(self._descriptor_files, self._ctx):
-            layer_builder = node_builder.LayerBuilder(
+    def _layer_builders(self):
+        if not ftl_util.has_pkg_descriptor(self._descriptor_files, self._ctx):
+            return []
+        return [
+            node_builder.LayerBuilder(
                 ctx=self._ctx,
                 descriptor_files=self._descriptor_files,
                 directory=self._args.directory,
                 destination_path=self._args.destination_path,
                 should_use_yarn=self._should_use_yarn,
                 cache_key_version=self._args.cache_key_version,
-                cache=self._cache)
-            layer_builder.BuildLayer()
-            lyr_imgs.append(layer_builder.GetImage())
-
-        app = base_builder.AppLayerBuilder(
-            directory=self._args.directory,
-            destination_path=self._args.destination_path,
-            entrypoint=self._args.entrypoint,
-            exposed_ports=self._args.exposed_ports)
-        app.BuildLayer()
-        lyr_imgs.append(app.GetImage())
+                cache=self._cache,
+                layer_opts=self._layer_opts,
+                package_store=self._package_store)
+        ]
+
+    def Build(self):
+        lyr_imgs = []
+        lyr_imgs.append(self._base_image)
+        dep_builders = self._layer_builders()
+
+        memo_key = self._build_memo_key(dep_builders)
+        if self._restore_build_memo(memo_key):
+            return
+
+        def build_deps():
+            for layer_builder in dep_builders:
+                self._build_layer(layer_builder)
+
+        # npm and yarn install node_modules, which has a layer of its own,
+        # away from the app directory while the app layer is built
+        apps = []
+
+        def build_app():
+            # unless the gcp-build script built the app in a copy of the
+            # app directory, which then goes in the app layer
+            directory = self._args.directory
+            for layer_builder in dep_builders:
+                directory = layer_builder.AppDirectory() or directory
+            app = base_builder.AppLayerBuilder(
+                directory=directory,
+                destination_path=self._args.destination_path,
+                entrypoint=self._args.entrypoint,
+                exposed_ports=self._args.exposed_ports,
+                layer_opts=self._layer_opts,
+                exclude=['node_modules'])
+            app.BuildLayer()
+            apps.append(app)
+
+        app_deps = ['dependencies'] if any(
+            b.RunsGcpBuild() for b in dep_builders) else []
+        steps = [('dependencies', build_deps, []),
+                 ('app', build_app, app_deps)]
         if self._args.additional_directory:
             additional_directory = base_builder.AppLayerBuilder(
                 directory=self._args.additional_directory,
                 destination_path=self._args.additional_directory,
                 entrypoint=self._args.entrypoint,
-                exposed_ports=self._args.exposed_ports)
-            additional_directory.BuildLayer()
+                exposed_ports=self._args.exposed_ports,
+                layer_opts=self._layer_opts)
+            steps.append(('additional directory',
+                          additional_directory.BuildLayer, []))
+        try:
+            self._build_steps(steps)
+        finally:
+            for layer_builder in dep_builders:
+                layer_builder.Cleanup()
+
+        lyr_imgs.extend(b.GetImage() for b in dep_builders)
+        lyr_imgs.append(apps[0].GetImage())
+        if self._args.additional_directory:
             lyr_imgs.append(additional_directory.GetImage())
         ftl_image = ftl_util.AppendLayersIntoImage(lyr_imgs)
         self.StoreImage(ftl_image)
+        self._store_build_memo(memo_key, ftl_image)
+        self._layer_history().Save()
@@ -13,14 +13,17 @@
 # limitations under the License.
 
 import json
+import os
 import unittest
 import tempfile
 import mock
 
 from ftl.common import context
+from ftl.common import ftl_util
 
 from ftl.node import builder
 from ftl.node import layer_builder
+from ftl.node import node_util
 
 _PACKAGE_JSON = json.loads("""
 {
@@ -63,6 +66,7 @@ class NodeTest(unittest.TestCase):
         args.base = 'gcr.io/google-appengine/python:latest'
         args.entrypoint = None
         args.tar_base_image_path = None
+        args.package_store_dir = None
         self.builder = builder.Node(self.ctx, args)
         self.layer_builder = layer_builder.LayerBuilder(
             ctx=self.builder._ctx,
@@ -84,6 +88,110 @@ class NodeTest(unittest.TestCase):
         self.assertIsInstance(self.layer_builder.GetImage().GetFirstBlob(),
                               str)
 
+    def test_install_leaves_app_directory(self):
+        app_dir = os.path.join(self._tmpdir, 'app')
+        os.makedirs(os.path.join(app_dir, 'node_modules', 'stale'))
+        package_json = dict(_PACKAGE_JSON)
+        for name, contents in [('app.js', _APP),
+                               ('package.json', _PACKAGE_JSON_TEXT)]:
+            with open(os.path.join(app_dir, name), 'w') as f:
+                f.write(contents)
+
+        def work_dir():
+            lyr = layer_builder.LayerBuilder(
+                ctx=context.Workspace(app_dir),
+                descriptor_files=self.builder._descriptor_files,
+                directory=app_dir)
+            work_dir = lyr._gen_work_dir()
+            self.assertNotEqual(work_dir, app_dir)
+            return sorted(os.listdir(work_dir))
+
+        # install scripts and local dependencies find the app files
+        self.assertEqual(work_dir(), ['app.js', 'package.json'])
+        package_json['scripts'] = {'gcp-build': 'tsc'}
+        with open(os.path.join(app_dir, 'package.json'), 'w') as f:
+            f.write(json.dumps(package_json))
+        self.assertEqual(work_dir(), ['app.js', 'package.json'])
+        self.assertEqual(
+            sorted(os.listdir(app_dir)),
+            ['app.js', 'node_modules', 'package.json'])
+
+    def test_package_lock_generated_outside_app_directory(self):
+        app_dir = os.path.join(self._tmpdir, 'lock')
+        os.makedirs(app_dir)
+        with open(os.path.join(app_dir, 'package.json'), 'w') as f:
+            f.write(_PACKAGE_JSON_TEXT)
+        run_command = ftl_util.run_command
+
+        def npm(cmd_name, cmd_args, cmd_cwd=None, **kwargs):
+            if cmd_name != 'gen_package_lock':
+                return run_command(cmd_name, cmd_args, cmd_cwd, **kwargs)
+            with open(os.path.join(cmd_cwd, 'package-lock.json'), 'w') as f:
+                f.write('{}')
+
+        self.builder._args.directory = app_dir
+        ctx = context.Overlay(context.Workspace(app_dir))
+        self.builder._ctx = ctx
+        with mock.patch('ftl.common.ftl_util.run_command', side_effect=npm):
+            self.builder._gen_package_lock_if_required(ctx)
+        self.assertEqual(ctx.GetFile('package-lock.json'), '{}')
+        self.assertEqual(os.listdir(app_dir), ['package.json'])
+
+    def test_plan_without_lockfile_is_unknown(self):
+        ctx = context.Memory()
+        ctx.AddFile('package.json', _PACKAGE_JSON_TEXT)
+        self.builder._ctx = context.Overlay(ctx)
+        self.builder._cache = mock.Mock()
+        self.builder._build_cache = mock.Mock()
+        self.builder._history = mock.Mock()
+        self.builder._history.Get.return_value = {'seconds': 30}
+
+        plan = self.builder.GetPlan()
+        self.builder._cache.Get.assert_not_called()
+        self.assertIsNone(plan['build_cache_hit'])
+        self.assertEqual([lyr['hit'] for lyr in plan['layers']], [None])
+        self.assertEqual(
+            (plan['hits'], plan['misses'], plan['unknown']), (0, 0, 1))
+        self.assertEqual(plan['estimated_seconds'], 30)
+
+        # with the lockfile the build would generate, the keys are known
+        self.builder._ctx.AddFile('package-lock.json', '{}')
+        self.builder._args.cache_key_version = 'v1'
+        self.builder._args.destination_path = '/app'
+        self.builder._build_memo_key = mock.Mock(return_value='memo')
+        self.builder._cache.Get.return_value = 'layer'
+        plan = self.builder.GetPlan()
+        self.assertEqual([lyr['hit'] for lyr in plan['layers']], [True])
+        self.assertEqual(plan['unknown'], 0)
+
+    def test_package_store_evicts_least_recently_used(self):
+        store_dir = os.path.join(self._tmpdir, 'store')
+        store = node_util.PackageStore(store_dir, 10)
+        self.assertEqual(store.InstallArgs('npm'), [
+            '--cache', os.path.join(store_dir, 'npm'), '--prefer-offline'
+        ])
+
+        def add(path, last_use):
+            path = os.path.join(store_dir, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write('tarball')
+            os.utime(path, (last_use, last_use))
+            return path
+
+        old = add('npm/_cacache/content-v2/sha512/aa/old', 1000)
+        new = add('npm/_cacache/content-v2/sha512/bb/new', 3000)
+        index = add('npm/_cacache/index-v5/cc/index', 1000)
+        yarn = add('yarn/v6/npm-express-3.0.0-dd/package.json', 2000)
+        with store.Use():
+            pass
+        # only the most recent tarball fits
+        self.assertFalse(os.path.exists(old))
+        self.assertFalse(os.path.exists(os.path.dirname(yarn)))
+        self.assertTrue(os.path.exists(new))
+        self.assertTrue(os.path.exists(index))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -16,12 +16,15 @@
 import logging
 import os
 import json
+import shutil
+import tempfile
 
 from ftl.common import constants
 from ftl.common import ftl_util
 from ftl.common import ftl_error
 from ftl.common import single_layer_image
 from ftl.common import tar_to_dockerimage
+from ftl.node import node_util
 
 
 class LayerBuilder(single_layer_image.CacheableLayerBuilder):
@@ -33,7 +36,9 @@ class LayerBuilder(single_layer_image.CacheableLayerBuilder):
                  destination_path=constants.DEFAULT_DESTINATION_PATH,
                  should_use_yarn=None,
                  cache_key_version=None,
-                 cache=None):
+                 cache=None,
+                 layer_opts=None,
+                 package_store=None):
         super(LayerBuilder, self).__init__()
         self._ctx = ctx
         self._descriptor_files = descriptor_files
@@ -43,6 +48,9 @@ class LayerBuilder(single_layer_image.CacheableLayerBuilder):
         self._should_use_yarn = should_use_yarn
         self._cache_key_version = cache_key_version
         self._cache = cache
+        self._layer_opts = layer_opts
+        self._package_store = package_store
+        self._work_dir = None
 
     def GetCacheKeyRaw(self):
         all_descriptor_contents = ftl_util.all_descriptor_contents(
@@ -50,6 +58,10 @@ class LayerBuilder(single_layer_image.CacheableLayerBuilder):
         cache_key = '%s %s' % (all_descriptor_contents, self._destination_path)
         return "%s %s" % (cache_key, self._cache_key_version)
 
+    def GetLayerName(self):
+        return 'node %s' % (constants.YARN_LOCK if self._should_use_yarn else
+                            constants.PACKAGE_JSON)
+
     def BuildLayer(self):
         """Override."""
         cached_img = None
@@ -59,6 +71,7 @@ class LayerBuilder(single_layer_image.CacheableLayerBuilder):
                 cached_img = self._cache.Get(key)
                 self._log_cache_result(False if cached_img is None else True,
                  key)
+        self._cache_hit = cached_img is not None
         if cached_img:
             self.SetImage(cached_img)
         else:
@@ -70,61 +83,90 @@ class LayerBuilder(single_layer_image.CacheableLayerBuilder):
                     self._cache.Set(self.GetCacheKey(), self.GetImage())
 
     def _build_layer(self):
+        self._work_dir = self._gen_work_dir()
         if self._should_use_yarn:
-            blob, u_blob = self._gen_yarn_install_tar(self._directory)
+            blob, u_blob = self._gen_yarn_install_tar(self._work_dir)
         else:
-            blob, u_blob = self._gen_npm_install_tar(self._directory)
+            blob, u_blob = self._gen_npm_install_tar(self._work_dir)
         self._img = tar_to_dockerimage.FromFSImage([blob], [u_blob],
                                                    ftl_util.generate_overrides(
                                                        False))
 
-    def _cleanup_build_layer(self):
+    def _gen_work_dir(self):
+        """Returns a copy of the app directory to install the packages in,
+        which leaves the app directory as it is. Local dependencies and
+        install scripts find the app files as they would in it."""
         if self._directory:
-            modules_dir = os.path.join(self._directory, "node_modules")
-            rm_cmd = ['rm', '-rf', modules_dir]
-            ftl_util.run_command('rm_node_modules', rm_cmd)
+            work_dir = node_util.copy_app_dir(self._directory)
+        else:
+            work_dir = tempfile.mkdtemp()
+        # with the package descriptors of the context, such as a generated
+        # package-lock.json
+        for name in self._descriptor_files:
+            if self._ctx.Contains(name):
+                with open(os.path.join(work_dir, name), 'wb') as f:
+                    f.write(self._ctx.GetFile(name))
+        return work_dir
 
-    def _gen_yarn_install_tar(self, app_dir):
-        is_gcp_build = False
+    def _cleanup_build_layer(self):
+        # the app layer is built from the copy the gcp-build script ran in
+        if not self.RunsGcpBuild():
+            self.Cleanup()
+
+    def AppDirectory(self):
+        """Returns the copy of the app directory the gcp-build script built
+        the app in, or None when it did not run."""
+        if self.RunsGcpBuild():
+            return self._work_dir
+        return None
+
+    def Cleanup(self):
+        """Removes the directory the packages were installed in."""
+        if self._work_dir:
+            shutil.rmtree(self._work_dir, ignore_errors=True)
+            self._work_dir = None
+
+    def RunsGcpBuild(self):
+        """Whether building the layer runs the gcp-build script of
+        package.json, which writes to the app directory."""
         if self._ctx and self._ctx.Contains(constants.PACKAGE_JSON):
-            is_gcp_build = self._is_gcp_build(
+            return self._is_gcp_build(
                 json.loads(self._ctx.GetFile(constants.PACKAGE_JSON)))
+        return False
 
-        if is_gcp_build:
+    def _gen_yarn_install_tar(self, app_dir):
+        if self.RunsGcpBuild():
             self._gcp_build(app_dir, 'yarn', 'run')
-        else:
-            yarn_install_cmd = ['yarn', 'install', '--production']
-            ftl_util.run_command(
-                'yarn_install',
-                yarn_install_cmd,
-                cmd_cwd=app_dir,
-                err_type=ftl_error.FTLErrors.USER())
+        # yarn cannot prune, but after the development install of gcp-build
+        # the production install only removes the devDependencies
+        yarn_install_cmd = ['yarn', 'install', '--production']
+        self._install('yarn_install', yarn_install_cmd, app_dir)
 
         module_destination = os.path.join(self._destination_path,
                                           'node_modules')
-        modules_dir = os.path.join(self._directory, "node_modules")
-        return ftl_util.zip_dir_to_layer_sha(modules_dir, module_destination)
+        modules_dir = os.path.join(app_dir, "node_modules")
+        return ftl_util.zip_dir_to_layer_sha(
+            modules_dir, module_destination, layer_opts=self._layer_opts)
 
     def _gen_npm_install_tar(self, app_dir):
-        is_gcp_build = False
-        if self._ctx and self._ctx.Contains(constants.PACKAGE_JSON):
-            is_gcp_build = self._is_gcp_build(
-                json.loads(self._ctx.GetFile(constants.PACKAGE_JSON)))
-
-        if is_gcp_build:
+        if self.RunsGcpBuild():
             self._gcp_build(app_dir, 'npm', 'run-script')
-            self._cleanup_build_layer()
-        npm_install_cmd = ['npm', 'install', '--production']
-        ftl_util.run_command(
-            'npm_install',
-            npm_install_cmd,
-            cmd_cwd=app_dir,
-            err_type=ftl_error.FTLErrors.USER())
+            # keep the development install, less its devDependencies
+            npm_prune_cmd = ['npm', 'prune', '--production']
+            ftl_util.run_command(
+                'npm_prune',
+                npm_prune_cmd,
+                cmd_cwd=app_dir,
+                err_type=ftl_error.FTLErrors.USER())
+        else:
+            npm_install_cmd = ['npm', 'install', '--production']
+            self._install('npm_install', npm_install_cmd, app_dir)
 
         module_destination = os.path.join(self._destination_path,
                                           'node_modules')
-        modules_dir = os.path.join(self._directory, "node_modules")
-        return ftl_util.zip_dir_to_layer_sha(modules_dir, module_destination)
+        modules_dir = os.path.join(app_dir, "node_modules")
+        return ftl_util.zip_dir_to_layer_sha(
+            modules_dir, module_destination, layer_opts=self._layer_opts)
 
     def _is_gcp_build(self, package_json):
         scripts = package_json.get('scripts', {})
@@ -133,15 +175,10 @@ class LayerBuilder(single_layer_image.CacheableLayerBuilder):
         return False
 
     def _gcp_build(self, app_dir, install_bin, run_cmd):
-        env = os.environ.copy()
+        env = ftl_util.build_env().copy()
         env["NODE_ENV"] = "development"
         install_cmd = [install_bin, 'install']
-        ftl_util.run_command(
-            '%s_install' % install_bin,
-            install_cmd,
-            app_dir,
-            env,
-            err_type=ftl_error.FTLErrors.USER())
+        self._install('%s_install' % install_bin, install_cmd, app_dir, env)
 
         npm_run_script_cmd = [install_bin, run_cmd, 'gcp-build']
         ftl_util.run_command(
@@ -151,6 +188,23 @@ class LayerBuilder(single_layer_image.CacheableLayerBuilder):
             env,
             err_type=ftl_error.FTLErrors.USER())
 
+    def _install(self, cmd_name, install_cmd, app_dir, env=None):
+        """Runs an npm or yarn install, from the package store if any."""
+        store = self._package_store
+
+        def install():
+            cmd = install_cmd
+            if store:
+                cmd = install_cmd + store.InstallArgs(install_cmd[0])
+            ftl_util.run_command(
+                cmd_name, cmd, app_dir, env,
+                err_type=ftl_error.FTLErrors.USER())
+
+        if not store:
+            return install()
+        with store.Use():
+            install()
+
     def _log_cache_result(self, hit, key):
         if self._pkg_descriptor:
             if hit:
@@ -16,17 +16,15 @@
 import sys
 import argparse
 
-from containerregistry.tools import patched
-
 from ftl.common import args
 from ftl.common import logger
 from ftl.common import context
 from ftl.common import ftl_util
 from ftl.common import ftl_error
 
-from ftl.node import builder as node_builder
-
 version = args.version_parser()
+daemon = args.daemon_parser()
+batch = args.batch_parser()
 parser = args.base_parser()
 node_parser = argparse.ArgumentParser(
     add_help=False,
@@ -38,13 +36,42 @@ args.extra_args(node_parser, args.node_flgs)
 def main(cli_args):
     try:
         version.parse_known_args(cli_args)
+        daemon_args, _ = daemon.parse_known_args(cli_args)
+        if daemon_args.daemon_socket:
+            from ftl.common import daemon as ftl_daemon
+            from ftl.node import builder as node_builder
+
+            ftl_daemon.Daemon("node", node_parser, node_builder.Node).Serve(
+                daemon_args.daemon_socket)
+            return
+        batch_args, shared_args = batch.parse_known_args(cli_args)
+        if batch_args.batch_path:
+            from ftl.common import batch as ftl_batch
+            from ftl.node import builder as node_builder
+
+            node_batch = ftl_batch.Batch("node", node_parser,
+                                         node_builder.Node)
+            apps = node_batch.ReadApps(batch_args.batch_path, shared_args)
+            # the apps share the flags that decide how errors are handled
+            builder_args = apps[0]
+            logger.setup_logging(builder_args)
+            with ftl_util.Timing("full batch build"):
+                node_batch.Build(apps)
+            return
         builder_args = node_parser.parse_args(cli_args)
         logger.setup_logging(builder_args)
         logger.preamble("node", builder_args)
+        # the builders pull in containerregistry, only load them once the
+        # arguments are known to ask for a build
+        from ftl.node import builder as node_builder
+
         with ftl_util.Timing("full build"):
             with ftl_util.Timing("builder initialization"):
                 node_ftl = node_builder.Node(
                     context.Workspace(builder_args.directory), builder_args)
+            if builder_args.plan:
+                node_ftl.Plan()
+                return
             with ftl_util.Timing("build process for FTL image"):
                 node_ftl.Build()
     except ftl_error.UserError as e:
@@ -56,5 +83,9 @@ def main(cli_args):
 
 
 if __name__ == '__main__':
+    # answer --version before loading containerregistry
+    version.parse_known_args(sys.argv[1:])
+    from containerregistry.tools import patched
+
     with patched.Httplib2():
         main(sys.argv[1:])
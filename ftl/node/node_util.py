@@ -0,0 +1,151 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""This package defines helpful utilities for the Node builder."""
+
+import contextlib
+import errno
+import fcntl
+import logging
+import os
+import shutil
+
+from ftl.common import ftl_util
+
+_LOCK_FILE = '.lock'
+
+
+def copy_app_dir(directory):
+    """Returns a temporary copy of the app directory, but for node_modules,
+    for npm and yarn to run in without changing the app directory."""
+    return ftl_util.copy_app_dir(directory, exclude=['node_modules'])
+
+
+class PackageStore(object):
+    """PackageStore is a directory of the builder host that npm and yarn
+    keep the package tarballs they download in, shared by every build.
+
+    npm stores the tarballs content addressed by their integrity hash and
+    yarn by their name, version and hash. Both check a tarball against the
+    integrity hash of the lockfile before using it and fetch it again when
+    it does not match, so only new packages are downloaded.
+
+    Once the store outgrows max_bytes, its least recently used tarballs are
+    evicted by the last build to finish using it.
+    """
+
+    def __init__(self, path, max_bytes):
+        self._path = path
+        self._max_bytes = max_bytes
+
+    def InstallArgs(self, install_bin):
+        """Returns the arguments making an npm or yarn install use the
+        store."""
+        if install_bin == 'yarn':
+            return ['--cache-folder', self._yarn_dir(), '--prefer-offline']
+        return ['--cache', self._npm_dir(), '--prefer-offline']
+
+    @contextlib.contextmanager
+    def Use(self):
+        """Holds the store for an install, evicting from it afterwards."""
+        if not os.path.isdir(self._path):
+            try:
+                os.makedirs(self._path)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        with open(os.path.join(self._path, _LOCK_FILE), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+            self._evict(lock)
+
+    def _npm_dir(self):
+        return os.path.join(self._path, 'npm')
+
+    def _yarn_dir(self):
+        return os.path.join(self._path, 'yarn')
+
+    def _entries(self):
+        """Returns the tarballs in the store as (last use, size, path)."""
+        entries = []
+        # npm's tarballs; an index entry whose tarball is gone is a miss
+        content_dir = os.path.join(self._npm_dir(), '_cacache', 'content-v2')
+        for root, _, files in os.walk(content_dir):
+            for name in files:
+                entries.append(_entry(os.path.join(root, name)))
+        # yarn unpacks each package in a directory of its own, under a
+        # directory per version of its cache layout
+        yarn_dir = self._yarn_dir()
+        if os.path.isdir(yarn_dir):
+            for layout in os.listdir(yarn_dir):
+                layout_dir = os.path.join(yarn_dir, layout)
+                if not layout.startswith('v') or not os.path.isdir(
+                        layout_dir):
+                    continue
+                for name in os.listdir(layout_dir):
+                    if not name.startswith('.'):
+                        entries.append(
+                            _entry(os.path.join(layout_dir, name)))
+        return entries
+
+    def _evict(self, lock):
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            # another build is installing, the last one to finish evicts
+            return
+        try:
+            with ftl_util.Timing('evicting_node_package_store'):
+                entries = self._entries()
+                size = sum(entry[1] for entry in entries)
+                evicted = 0
+                for _, entry_size, path in sorted(entries):
+                    if size <= self._max_bytes:
+                        break
+                    if os.path.isdir(path):
+                        shutil.rmtree(path, ignore_errors=True)
+                    else:
+                        os.remove(path)
+                    size -= entry_size
+                    evicted += 1
+                if evicted:
+                    logging.info(
+                        'Evicted %d packages from the package store %s, '
+                        'leaving %d bytes', evicted, self._path, size)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _entry(path):
+    """Returns (last use, size, path) for a file or directory of the store.
+
+    Reads only update access times every so often on relatime mounts,
+    which is fine grained enough to tell recently used packages apart.
+    """
+    if not os.path.isdir(path):
+        st = os.stat(path)
+        return max(st.st_atime, st.st_mtime), st.st_size, path
+    # by the files in it, unpacking a package touches its directory
+    last_use = 0
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            file_st = os.lstat(os.path.join(root, name))
+            size += file_st.st_size
+            last_use = max(last_use, file_st.st_atime, file_st.st_mtime)
+    return last_use, size, path
@@ -13,8 +13,6 @@
 # limitations under the License.
 """This package defines the interface for orchestrating image builds."""
 
-import os
-
 from ftl.common import builder
 from ftl.common import constants
 from ftl.common import ftl_util
@@ -37,42 +35,67 @@ class PHP(builder.RuntimeBase):
             cmd_cwd=self._args.directory,
             err_type=ftl_error.FTLErrors.USER())
 
-    def Build(self):
-        lyr_imgs = []
-        lyr_imgs.append(self._base_image)
-        # delete any existing files in vendor folder
-        if self._args.directory:
-            vendor_dir = os.path.join(self._args.directory, 'vendor')
-            rm_cmd = ['rm', '-rf', vendor_dir]
-            ftl_util.run_command('rm_vendor_dir', rm_cmd)
-            os.makedirs(os.path.join(vendor_dir))
+    def _generates_lock(self):
+        return (ftl_util.has_pkg_descriptor(self._descriptor_files, self._ctx)
+                and not self._ctx.Contains(constants.COMPOSER_LOCK))
 
-        if ftl_util.has_pkg_descriptor(self._descriptor_files, self._ctx):
-            self._gen_composer_lock()
-            layer_builder = php_builder.PhaseOneLayerBuilder(
+    def _layer_builders(self):
+        if not ftl_util.has_pkg_descriptor(self._descriptor_files, self._ctx):
+            return []
+        return [
+            php_builder.PhaseOneLayerBuilder(
                 ctx=self._ctx,
                 descriptor_files=self._descriptor_files,
                 directory=self._args.directory,
                 destination_path=self._args.destination_path,
                 cache_key_version=self._args.cache_key_version,
-                cache=self._cache)
-            layer_builder.BuildLayer()
-            lyr_imgs.append(layer_builder.GetImage())
+                cache=self._cache,
+                layer_opts=self._layer_opts)
+        ]
+
+    def Build(self):
+        lyr_imgs = []
+        lyr_imgs.append(self._base_image)
 
+        if ftl_util.has_pkg_descriptor(self._descriptor_files, self._ctx):
+            self._gen_composer_lock()
+        dep_builders = self._layer_builders()
+
+        memo_key = self._build_memo_key(dep_builders)
+        if self._restore_build_memo(memo_key):
+            return
+
+        def build_deps():
+            for layer_builder in dep_builders:
+                self._build_layer(layer_builder)
+
+        # composer installs vendor, which has a layer of its own, in a copy
+        # of the app directory while the app layer is built
         app = base_builder.AppLayerBuilder(
             directory=self._args.directory,
             destination_path=self._args.destination_path,
             entrypoint=self._args.entrypoint,
-            exposed_ports=self._args.exposed_ports)
-        app.BuildLayer()
-        lyr_imgs.append(app.GetImage())
+            exposed_ports=self._args.exposed_ports,
+            layer_opts=self._layer_opts,
+            exclude=['vendor'])
+        steps = [('dependencies', build_deps, []),
+                 ('app', app.BuildLayer, [])]
         if self._args.additional_directory:
             additional_directory = base_builder.AppLayerBuilder(
                 directory=self._args.additional_directory,
                 destination_path=self._args.additional_directory,
                 entrypoint=self._args.entrypoint,
-                exposed_ports=self._args.exposed_ports)
-            additional_directory.BuildLayer()
+                exposed_ports=self._args.exposed_ports,
+                layer_opts=self._layer_opts)
+            steps.append(('additional directory',
+                          additional_directory.BuildLayer, []))
+        self._build_steps(steps)
+
+        lyr_imgs.extend(b.GetImage() for b in dep_builders)
+        lyr_imgs.append(app.GetImage())
+        if self._args.additional_directory:
             lyr_imgs.append(additional_directory.GetImage())
         ftl_image = ftl_util.AppendLayersIntoImage(lyr_imgs)
         self.StoreImage(ftl_image)
+        self._store_build_memo(memo_key, ftl_image)
+        self._layer_history().Save()
@@ -13,11 +13,15 @@
 # limitations under the License.
 
 import json
+import os
+import StringIO
+import tarfile
 import unittest
 import tempfile
 import mock
 
 from ftl.common import context
+from ftl.common import ftl_util
 from ftl.php import builder
 from ftl.php import layer_builder
 
@@ -91,6 +95,48 @@ class PHPTest(unittest.TestCase):
         lyr = self.layer_builder.GetImage().GetFirstBlob()
         self.assertIsInstance(lyr, str)
 
+    def test_composer_install_outside_app_directory(self):
+        app_dir = os.path.join(self._tmpdir, 'app')
+        os.makedirs(os.path.join(app_dir, 'vendor'))
+        with open(os.path.join(app_dir, 'vendor', 'stale.php'), 'w') as f:
+            f.write('stale')
+        with open(os.path.join(app_dir, 'composer.json'), 'w') as f:
+            f.write(json.dumps(_COMPOSER_JSON))
+        ctx = context.Workspace(app_dir)
+        php_builder = layer_builder.PhaseOneLayerBuilder(
+            ctx, ['composer.lock', 'composer.json'], '/app',
+            directory=app_dir)
+
+        run_command = ftl_util.run_command
+
+        def composer_install(name, args, cmd_cwd=None, **kwargs):
+            if name != 'composer_install':
+                return run_command(name, args, cmd_cwd=cmd_cwd, **kwargs)
+            # as composer and a post-install script would
+            self.assertNotEqual(cmd_cwd, app_dir)
+            self.assertTrue(
+                os.path.isfile(os.path.join(cmd_cwd, 'composer.json')))
+            os.makedirs(os.path.join(cmd_cwd, 'vendor'))
+            with open(os.path.join(cmd_cwd, 'vendor', 'autoload.php'),
+                      'w') as f:
+                f.write('autoload')
+            with open(os.path.join(cmd_cwd, 'cache.php'), 'w') as f:
+                f.write('cache')
+
+        with mock.patch('ftl.common.ftl_util.run_command',
+                        side_effect=composer_install):
+            php_builder.BuildLayer()
+        self.assertEqual(
+            sorted(os.listdir(app_dir)), ['composer.json', 'vendor'])
+        self.assertEqual(
+            os.listdir(os.path.join(app_dir, 'vendor')), ['stale.php'])
+        u_blob = php_builder.GetImage().uncompressed_blob(
+            php_builder.GetImage().fs_layers()[0])
+        with tarfile.open(fileobj=StringIO.StringIO(u_blob)) as tf:
+            self.assertEqual(
+                [m.name for m in tf.getmembers() if m.isfile()],
+                ['/app/vendor/./autoload.php'])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -15,6 +15,8 @@
 
 import logging
 import os
+import shutil
+import tempfile
 
 from ftl.common import constants
 from ftl.common import ftl_util
@@ -32,7 +34,8 @@ class PhaseOneLayerBuilder(single_layer_image.CacheableLayerBuilder):
                  destination_path=constants.DEFAULT_DESTINATION_PATH,
                  cache_key_version=None,
                  directory=None,
-                 cache=None):
+                 cache=None,
+                 layer_opts=None):
         super(PhaseOneLayerBuilder, self).__init__()
         self._ctx = ctx
         self._descriptor_files = descriptor_files
@@ -40,6 +43,8 @@ class PhaseOneLayerBuilder(single_layer_image.CacheableLayerBuilder):
         self._cache_key_version = cache_key_version
         self._directory = directory
         self._cache = cache
+        self._layer_opts = layer_opts
+        self._work_dir = None
 
     def GetCacheKeyRaw(self):
         cache_key = "%s %s" % (
@@ -47,6 +52,9 @@ class PhaseOneLayerBuilder(single_layer_image.CacheableLayerBuilder):
             self._destination_path)
         return "%s %s" % (cache_key, self._cache_key_version)
 
+    def GetLayerName(self):
+        return 'php %s' % constants.COMPOSER_JSON
+
     def BuildLayer(self):
         """Override."""
         cached_img = None
@@ -56,28 +64,46 @@ class PhaseOneLayerBuilder(single_layer_image.CacheableLayerBuilder):
                 cached_img = self._cache.Get(key)
                 self._log_cache_result(False if cached_img is None else True,
                 key)
+        self._cache_hit = cached_img is not None
         if cached_img:
             self.SetImage(cached_img)
         else:
             with ftl_util.Timing('building_composer_json_layer'):
-                self._build_layer()
-                self._cleanup_build_layer()
+                try:
+                    self._build_layer()
+                finally:
+                    self._cleanup_build_layer()
             if self._cache:
                 with ftl_util.Timing('uploading_composer_json_layer'):
                     self._cache.Set(key, self.GetImage())
 
     def _build_layer(self):
-        blob, u_blob = self._gen_composer_install_tar(self._directory,
+        self._work_dir = self._gen_work_dir()
+        blob, u_blob = self._gen_composer_install_tar(self._work_dir,
                                                       self._destination_path)
         self._img = tar_to_dockerimage.FromFSImage([blob], [u_blob],
                                                    ftl_util.generate_overrides(
                                                        False))
 
-    def _cleanup_build_layer(self):
+    def _gen_work_dir(self):
+        """Returns a copy of the app directory, but for vendor, to install
+        the packages in. composer and its scripts write to it while the app
+        layer is built from the app directory."""
         if self._directory:
-            vendor_dir = os.path.join(self._directory, 'vendor')
-            rm_cmd = ['rm', '-rf', vendor_dir]
-            ftl_util.run_command('rm_vendor_dir', rm_cmd)
+            work_dir = ftl_util.copy_app_dir(
+                self._directory, exclude=['vendor'])
+        else:
+            work_dir = tempfile.mkdtemp()
+        for name in self._descriptor_files:
+            if self._ctx.Contains(name):
+                with open(os.path.join(work_dir, name), 'wb') as f:
+                    f.write(self._ctx.GetFile(name))
+        return work_dir
+
+    def _cleanup_build_layer(self):
+        if self._work_dir:
+            shutil.rmtree(self._work_dir, ignore_errors=True)
+            self._work_dir = None
 
     def _gen_composer_install_tar(self, app_dir, destination_path):
         composer_install_cmd = [
@@ -91,9 +117,10 @@ class PhaseOneLayerBuilder(single_layer_image.CacheableLayerBuilder):
             cmd_env=php_util.gen_composer_env(),
             err_type=ftl_error.FTLErrors.USER())
 
-        vendor_dir = os.path.join(self._directory, 'vendor')
+        vendor_dir = os.path.join(app_dir, 'vendor')
         vendor_destination = os.path.join(destination_path, 'vendor')
-        return ftl_util.zip_dir_to_layer_sha(vendor_dir, vendor_destination)
+        return ftl_util.zip_dir_to_layer_sha(
+            vendor_dir, vendor_destination, layer_opts=self._layer_opts)
 
     def _log_cache_result(self, hit, key):
         if hit:
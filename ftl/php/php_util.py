@@ -12,10 +12,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 """This package defines helpful utilities for FTL ."""
-import os
+from ftl.common import ftl_util
 
 
 def gen_composer_env():
-    composer_env = os.environ.copy()
+    composer_env = ftl_util.build_env().copy()
     composer_env['COMPOSER_ALLOW_SUPERUSER'] = '1'
     return composer_env
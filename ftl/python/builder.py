@@ -13,13 +13,18 @@
 # limitations under the License.
 """This package defines the interface for orchestrating image builds."""
 
+import hashlib
 import json
+import shutil
+import logging
 import concurrent.futures
 
 from ftl.common import builder
+from ftl.common import concurrency
 from ftl.common import constants
 from ftl.common import ftl_util
 from ftl.common import layer_builder as base_builder
+from ftl.common import layer_grouping
 
 from ftl.python import layer_builder as package_builder
 from ftl.python import python_util
@@ -45,8 +50,26 @@ class Python(builder.RuntimeBase):
         self._venv_cmd = args.venv_cmd
         if self._venv_cmd:
             self._venv_cmd = args.venv_cmd.split(" ")
+        self._virtualenv_template_dir = args.virtualenv_template_dir
+        self._compile_bytecode = args.compile_bytecode
 
         self._is_phase2 = ctx.Contains(constants.PIPFILE_LOCK)
+        self._pinned_pkgs = None
+        self._pkg_hashes = {}
+        if not self._is_phase2 and ctx.Contains(constants.REQUIREMENTS_TXT):
+            # a fully pinned requirements.txt is treated like a lockfile
+            pinned = python_util.pinned_requirements(ctx)
+            if pinned is not None:
+                self._pinned_pkgs = [(name, version)
+                                     for name, version, _ in pinned]
+                self._pkg_hashes = dict(
+                    (name, hashes) for name, _, hashes in pinned)
+            self._is_phase2 = self._pinned_pkgs is not None
+
+    def _parse_pkgs(self):
+        if self._pinned_pkgs:
+            return self._pinned_pkgs
+        return self._parse_pipfile_pkgs()
 
     def _parse_pipfile_pkgs(self):
 
@@ -59,93 +82,182 @@ class Python(builder.RuntimeBase):
             pkgs.append((pkg, version))
         return pkgs
 
-    def Build(self):
-        lyr_imgs = []
-        lyr_imgs.append(self._base_image)
-
+    def _layer_builders(self):
         interpreter_builder = package_builder.InterpreterLayerBuilder(
             virtualenv_dir=self._virtualenv_dir,
             python_cmd=self._python_cmd,
             virtualenv_cmd=self._virtualenv_cmd,
             venv_cmd=self._venv_cmd,
             cache_key_version=self._args.cache_key_version,
-            cache=self._cache)
-        interpreter_builder.BuildLayer()
-        lyr_imgs.append(interpreter_builder.GetImage())
+            cache=self._cache,
+            layer_opts=self._layer_opts,
+            virtualenv_template_dir=self._virtualenv_template_dir)
+        if not ftl_util.has_pkg_descriptor(self._descriptor_files, self._ctx):
+            return [interpreter_builder]
 
-        if ftl_util.has_pkg_descriptor(self._descriptor_files, self._ctx):
-            # build interpreter layer
+        if self._is_phase2:
+            # do a phase 2 build of the package layers w/ Pipfile.lock
+            # or a fully pinned requirements.txt
+            # iterate over package/version pairs
+            return [interpreter_builder] + [
+                self._pkg_builder(pkg, interpreter_builder)
+                for pkg in self._parse_pkgs()
+            ]
+        # do a phase 1 build of the package layers w/ requirements.txt
+        return [
+            interpreter_builder,
+            package_builder.RequirementsLayerBuilder(
+                ctx=self._ctx,
+                descriptor_files=self._descriptor_files,
+                directory=self._args.directory,
+                pkg_dir=None,
+                wheel_dir=self._wheel_dir,
+                virtualenv_dir=self._virtualenv_dir,
+                python_cmd=self._python_cmd,
+                pip_cmd=self._pip_cmd,
+                virtualenv_cmd=self._virtualenv_cmd,
+                venv_cmd=self._venv_cmd,
+                dep_img_lyr=interpreter_builder,
+                cache_key_version=self._args.cache_key_version,
+                cache=self._cache,
+                layer_opts=self._layer_opts,
+                virtualenv_template_dir=self._virtualenv_template_dir,
+                compile_bytecode=self._compile_bytecode)
+        ]
 
-            if self._is_phase2:
-                # do a phase 2 build of the package layers w/ Pipfile.lock
-                # iterate over package/version Pipfile.lock
+    def Build(self):
+        lyr_imgs = []
+        lyr_imgs.append(self._base_image)
+
+        layer_builders = self._layer_builders()
+        interpreter_builder = layer_builders[0]
+        dep_builders = layer_builders[1:]
+
+        memo_key = self._build_memo_key(layer_builders)
+        if self._restore_build_memo(memo_key):
+            return
+
+        dep_imgs = []
+
+        def build_deps():
+            self._build_layer(interpreter_builder)
+            dep_imgs.append(interpreter_builder.GetImage())
+
+            if self._is_phase2 and dep_builders:
                 python_util.setup_virtualenv(self._virtualenv_dir,
                                              self._virtualenv_cmd,
                                              self._python_cmd,
-                                             self._venv_cmd)
-                pkgs = self._parse_pipfile_pkgs()
+                                             self._venv_cmd,
+                                             self._virtualenv_template_dir)
+                group_builders = self._group_builders(dep_builders)
                 with ftl_util.Timing('uploading_all_package_layers'):
-                    with concurrent.futures.ThreadPoolExecutor(
-                            max_workers=constants.THREADS) as executor:
-                        future_to_params = {executor.submit(
-                                self._build_pkg, pkg,
-                                interpreter_builder, lyr_imgs): pkg
-                                for pkg in pkgs
+                    with ftl_util.ThreadPoolExecutor(
+                            max_workers=concurrency.network().capacity
+                    ) as executor:
+                        future_to_params = {
+                            executor.submit(group_builder.BuildLayer):
+                            group_builder
+                            for group_builder in group_builders
                         }
                         for future in concurrent.futures.as_completed(
                                 future_to_params):
                             future.result()
+                # keep the layer order stable regardless of completion order
+                dep_imgs.extend(b.GetImage() for b in group_builders)
             else:
-                # do a phase 1 build of the package layers w/ requirements.txt
-                req_txt_builder = package_builder.RequirementsLayerBuilder(
-                    ctx=self._ctx,
-                    descriptor_files=self._descriptor_files,
-                    directory=self._args.directory,
-                    pkg_dir=None,
-                    wheel_dir=self._wheel_dir,
-                    virtualenv_dir=self._virtualenv_dir,
-                    python_cmd=self._python_cmd,
-                    pip_cmd=self._pip_cmd,
-                    virtualenv_cmd=self._virtualenv_cmd,
-                    venv_cmd=self._venv_cmd,
-                    dep_img_lyr=interpreter_builder,
-                    cache_key_version=self._args.cache_key_version,
-                    cache=self._cache)
-                req_txt_builder.BuildLayer()
-                if req_txt_builder.GetImage():
-                    lyr_imgs.append(req_txt_builder.GetImage())
+                for req_txt_builder in dep_builders:
+                    self._build_layer(req_txt_builder)
+                    if req_txt_builder.GetImage():
+                        dep_imgs.append(req_txt_builder.GetImage())
 
-        app = base_builder.AppLayerBuilder(
-            directory=self._args.directory,
-            destination_path=self._args.destination_path,
-            entrypoint=self._args.entrypoint,
-            exposed_ports=self._args.exposed_ports)
-        app.BuildLayer()
-        lyr_imgs.append(app.GetImage())
+        # pip installs into the virtualenv, out of the app directory, so
+        # the app layer is built alongside
+        apps = []
+
+        def build_app():
+            if not self._compile_bytecode:
+                return apps.append(self._app_builder(self._args.directory))
+            # the app is compiled in a copy, leaving the app directory as is
+            app_dir = python_util.copy_sources(self._args.directory)
+            try:
+                python_util.compile_bytecode(
+                    self._python_cmd, app_dir,
+                    '/' + self._args.destination_path.strip('/'))
+                apps.append(self._app_builder(app_dir))
+            finally:
+                shutil.rmtree(app_dir, ignore_errors=True)
+
+        steps = [('dependencies', build_deps, []),
+                 ('app', build_app, [])]
         if self._args.additional_directory:
             additional_directory = base_builder.AppLayerBuilder(
                 directory=self._args.additional_directory,
                 destination_path=self._args.additional_directory,
                 entrypoint=self._args.entrypoint,
-                exposed_ports=self._args.exposed_ports)
-            additional_directory.BuildLayer()
+                exposed_ports=self._args.exposed_ports,
+                layer_opts=self._layer_opts)
+            steps.append(('additional directory',
+                          additional_directory.BuildLayer, []))
+        self._build_steps(steps)
+
+        lyr_imgs.extend(dep_imgs)
+        lyr_imgs.append(apps[0].GetImage())
+        if self._args.additional_directory:
             lyr_imgs.append(additional_directory.GetImage())
         ftl_image = ftl_util.AppendLayersIntoImage(lyr_imgs)
         self.StoreImage(ftl_image)
+        self._store_build_memo(memo_key, ftl_image)
+        self._layer_history().Save()
 
-    def _build_pkg(self, pkg, interpreter_builder, lyr_imgs):
-        pipfile_builder = package_builder.PipfileLayerBuilder(
+    def _app_builder(self, directory):
+        app = base_builder.AppLayerBuilder(
+            directory=directory,
+            destination_path=self._args.destination_path,
+            entrypoint=self._args.entrypoint,
+            exposed_ports=self._args.exposed_ports,
+            layer_opts=self._layer_opts,
+            keep_bytecode=self._compile_bytecode)
+        app.BuildLayer()
+        return app
+
+    def _build_memo_key(self, layer_builders):
+        key = super(Python, self)._build_memo_key(layer_builders)
+        if not self._compile_bytecode:
+            return key
+        # the app layer differs in its pycs, which dir_hash skips
+        return hashlib.sha256(key + ' compile_bytecode').hexdigest()
+
+    def _group_builders(self, pkg_builders):
+        """Merges the package layers into at most --max-layers groups."""
+        groups = layer_grouping.Group(pkg_builders, self._args.max_layers,
+                                      self._args.layer_grouping,
+                                      self._layer_history())
+        if len(groups) < len(pkg_builders):
+            logging.info('Merging %d package layers into %d layers',
+                         len(pkg_builders), len(groups))
+        return [
+            layer_grouping.GroupLayerBuilder(
+                members,
+                build_member=self._build_layer,
+                cache=self._cache,
+                layer_opts=self._layer_opts) for members in groups
+        ]
+
+    def _pkg_builder(self, pkg, interpreter_builder):
+        return package_builder.PipfileLayerBuilder(
             ctx=self._ctx,
             descriptor_files=self._descriptor_files,
             directory=self._args.directory,
             pkg_descriptor=pkg,
+            pkg_hashes=self._pkg_hashes.get(pkg[0]),
             pkg_dir=None,
             wheel_dir=ftl_util.gen_tmp_dir(constants.WHEEL_DIR),
             virtualenv_dir=self._virtualenv_dir,
+            python_cmd=self._python_cmd,
             pip_cmd=self._pip_cmd,
             virtualenv_cmd=self._virtualenv_cmd,
             dep_img_lyr=interpreter_builder,
             cache_key_version=self._args.cache_key_version,
-            cache=self._cache)
-        pipfile_builder.BuildLayer()
-        lyr_imgs.append(pipfile_builder.GetImage())
+            cache=self._cache,
+            layer_opts=self._layer_opts,
+            compile_bytecode=self._compile_bytecode)
@@ -12,6 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import time
 import unittest
 import datetime
 import mock
@@ -20,13 +22,28 @@ import json
 from ftl.common import context
 from ftl.common import constants
 from ftl.common import ftl_util
+from ftl.common import tar_to_dockerimage
 from ftl.python import builder
 from ftl.python import layer_builder
+from ftl.python import python_util
 
 _REQUIREMENTS_TXT = """
 Flask==0.12.0
 """
 
+_PINNED_REQUIREMENTS_TXT = """
+# generated by pip-compile
+-r base.txt
+click==6.7 \\
+    --hash=sha256:29f99fc6125fbc931b758dc053b3114e55c77a6e4c6c3a2674a2dc986016381d
+"""
+
+_BASE_TXT = """
+Flask==0.12.0 \\
+    --hash=sha256:7f03bb2c255452444f7265eddb51601806e5447b6f8a2d50bbc77a654a14c118
+    # via app
+"""
+
 _APP = """
 import os
 from flask import Flask
@@ -78,6 +95,226 @@ class PythonTest(unittest.TestCase):
         now = datetime.datetime.now()
         self.assertTrue(last_created > now - datetime.timedelta(days=2))
 
+    def _write_whl(self, name, contents):
+        whl = os.path.join(ftl_util.gen_tmp_dir('wheel'), name)
+        with open(whl, 'w') as f:
+            f.write(contents)
+        return whl
+
+    def test_package_layer_cache_key_per_wheel(self):
+        dep = mock.Mock()
+        dep.GetCacheKeyRaw.return_value = 'interpreter'
+
+        def key(whl):
+            return layer_builder.PackageLayerBuilder(
+                whl=whl, dep_img_lyr=dep,
+                cache_key_version='v1').GetCacheKey()
+
+        flask = 'Flask-0.12.0-py2.py3-none-any.whl'
+        click = 'click-6.7-py2.py3-none-any.whl'
+        self.assertEqual(
+            key(self._write_whl(flask, 'flask')),
+            key(self._write_whl(flask, 'flask')))
+        self.assertNotEqual(
+            key(self._write_whl(flask, 'flask')),
+            key(self._write_whl(click, 'flask')))
+        self.assertNotEqual(
+            key(self._write_whl(flask, 'flask')),
+            key(self._write_whl(flask, 'changed')))
+
+    def test_package_layer_cache_key_compiled(self):
+        dep = mock.Mock()
+        dep.GetCacheKeyRaw.return_value = 'interpreter'
+        whl = self._write_whl('click-6.7-py2.py3-none-any.whl', 'click')
+
+        def key(compile_bytecode):
+            return layer_builder.PackageLayerBuilder(
+                whl=whl, dep_img_lyr=dep, cache_key_version='v1',
+                compile_bytecode=compile_bytecode).GetCacheKey()
+
+        self.assertNotEqual(key(False), key(True))
+
+    def test_compile_bytecode(self):
+        src_dir = ftl_util.gen_tmp_dir('compile')
+        with open(os.path.join(src_dir, 'app.py'), 'w') as f:
+            f.write(_APP)
+        app_dir = python_util.copy_sources(src_dir)
+        python_util.compile_bytecode(['python3'], app_dir, '/srv')
+        # the sources are left as they are
+        self.assertEqual(os.listdir(src_dir), ['app.py'])
+
+        pycs = os.listdir(os.path.join(app_dir, '__pycache__'))
+        self.assertEqual(len(pycs), 1)
+        with open(os.path.join(app_dir, '__pycache__', pycs[0]), 'rb') as f:
+            f.read(4)
+            # PEP 552 flags: hash based and checked
+            self.assertEqual(f.read(4), b'\x03\x00\x00\x00')
+
+    def test_pinned_requirements(self):
+        ctx = context.Memory()
+        ctx.AddFile('requirements.txt', _PINNED_REQUIREMENTS_TXT)
+        ctx.AddFile('base.txt', _BASE_TXT)
+        self.assertEqual(python_util.pinned_requirements(ctx), [
+            ('flask', '==0.12.0', (
+                'sha256:7f03bb2c255452444f7265eddb51601806e5447b6f8a2d50bbc77a654a14c118',  # noqa: E501
+            )),
+            ('click', '==6.7', (
+                'sha256:29f99fc6125fbc931b758dc053b3114e55c77a6e4c6c3a2674a2dc986016381d',  # noqa: E501
+            )),
+        ])
+
+        ctx.AddFile('requirements.txt', 'Foo_Bar==1.0\nfoo-bar == 1.0\n')
+        self.assertEqual(
+            python_util.pinned_requirements(ctx), [('foo-bar', '==1.0', ())])
+
+        for requirements_txt in [
+                # pip would not check the unhashed download
+                _PINNED_REQUIREMENTS_TXT + _REQUIREMENTS_TXT,
+                'Flask[dotenv]==0.12.0\n',
+                'Foo_Bar==1.0\nfoo-bar==1.1\n',
+                'requests>=2.0\n',
+        ]:
+            ctx.AddFile('requirements.txt', requirements_txt)
+            self.assertIsNone(python_util.pinned_requirements(ctx))
+
+    def test_pipfile_layer_checks_hashes(self):
+        dep = mock.Mock()
+        dep.GetCacheKeyRaw.return_value = 'interpreter'
+
+        def pkg_builder(pkg_hashes):
+            return layer_builder.PipfileLayerBuilder(
+                pkg_descriptor=('click', '==6.7'),
+                pkg_hashes=pkg_hashes,
+                dep_img_lyr=dep,
+                cache_key_version='v1')
+
+        self.assertNotEqual(
+            pkg_builder(('sha256:a', )).GetCacheKey(),
+            pkg_builder(('sha256:b', )).GetCacheKey())
+        self.assertEqual(pkg_builder(None)._requirement(), 'click ==6.7')
+
+        pkg_builder = pkg_builder(('sha256:a', 'sha256:b'))
+        with mock.patch('ftl.common.ftl_util.run_command') as run_command:
+            pkg_builder._pip_download_wheels(pkg_builder._requirement())
+        args, kwargs = run_command.call_args
+        self.assertIn('--require-hashes', args[1])
+        self.assertEqual(kwargs['cmd_input'],
+                         'click ==6.7 --hash=sha256:a --hash=sha256:b')
+
+    def test_requirements_layer_reproducible(self):
+        ctx = context.Memory()
+        ctx.AddFile('requirements.txt', _REQUIREMENTS_TXT)
+
+        def build(names):
+            wheel_dir = ftl_util.gen_tmp_dir('wheel')
+            req_builder = layer_builder.RequirementsLayerBuilder(
+                ctx=ctx,
+                descriptor_files=self.builder._descriptor_files,
+                wheel_dir=wheel_dir)
+
+            def pip_wheel(pkg_txt):
+                for name in names:
+                    with open(os.path.join(wheel_dir, name), 'w') as f:
+                        f.write(name)
+
+            def build_pkg(pkg_builder):
+                # the first wheel finishes last
+                name = os.path.basename(pkg_builder._whl)
+                time.sleep(0.1 if name == names[0] else 0)
+                pkg_builder._img = tar_to_dockerimage.FromFSImage(
+                    [ftl_util.gzip_layer(name)], [name],
+                    ftl_util.generate_overrides(False))
+
+            req_builder._pip_download_wheels = pip_wheel
+            # the digest of the stitched image follows from its layers
+            appended = []
+            with mock.patch('ftl.python.python_util.setup_virtualenv'), \
+                    mock.patch.object(layer_builder.PackageLayerBuilder,
+                                      'BuildLayer', build_pkg), \
+                    mock.patch('ftl.common.ftl_util.AppendLayersIntoImage',
+                               side_effect=appended.extend), \
+                    mock.patch.dict(os.environ,
+                                    {constants.SOURCE_DATE_EPOCH: '1'}):
+                req_builder.BuildLayer()
+            return [img.digest() for img in appended]
+
+        whls = ['Flask-0.12.0-py2.py3-none-any.whl',
+                'click-6.7-py2.py3-none-any.whl',
+                'itsdangerous-0.24-py2-none-any.whl']
+        self.assertEqual(build(whls), build(list(reversed(whls))))
+
+    def test_requirements_built_outside_app_directory(self):
+        app_dir = ftl_util.gen_tmp_dir('app')
+        with open(os.path.join(app_dir, 'requirements.txt'), 'w') as f:
+            f.write('-e .\n')
+        req_builder = layer_builder.RequirementsLayerBuilder(
+            directory=app_dir)
+        cwds = {}
+
+        def pip(name, args, cmd_cwd=None, **kwargs):
+            cwds[name] = cmd_cwd
+            if name == 'pip_download_wheels':
+                # as building the local package would
+                self.assertTrue(os.path.isfile(
+                    os.path.join(cmd_cwd, 'requirements.txt')))
+                os.mkdir(os.path.join(cmd_cwd, 'build'))
+
+        with mock.patch('ftl.common.ftl_util.run_command', side_effect=pip):
+            req_builder._pip_download_wheels('-e .\n')
+        self.assertNotEqual(cwds['pip_download_wheels'], app_dir)
+        self.assertFalse(os.path.exists(cwds['pip_download_wheels']))
+        self.assertEqual(os.listdir(app_dir), ['requirements.txt'])
+
+    def test_requirements_cache_key_ignores_formatting(self):
+        dep = mock.Mock()
+        dep.GetCacheKeyRaw.return_value = 'interpreter'
+
+        def key(requirements_txt):
+            ctx = context.Memory()
+            ctx.AddFile('requirements.txt', requirements_txt)
+            return layer_builder.RequirementsLayerBuilder(
+                ctx=ctx,
+                descriptor_files=self.builder._descriptor_files,
+                dep_img_lyr=dep,
+                cache_key_version='v1').GetCacheKey()
+
+        self.assertEqual(
+            key('Flask==0.12.0\nclick>=6.0,<7\n'),
+            key('# web\nclick <7, >=6.0\n\n  flask == 0.12.0  # app\n'))
+        self.assertNotEqual(
+            key('Flask==0.12.0\n'), key('Flask==0.12.1\n'))
+
+    def test_virtualenv_cloned_from_template(self):
+        template_dir = ftl_util.gen_tmp_dir('templates')
+        tmp_dir = ftl_util.gen_tmp_dir('envs')
+
+        def clone(name):
+            virtualenv_dir = os.path.join(tmp_dir, name)
+            venv_cmd = ['python3', '-m', 'venv', '--without-pip',
+                        virtualenv_dir]
+            return virtualenv_dir, python_util.setup_virtualenv(
+                virtualenv_dir, ['virtualenv'], ['python3'], venv_cmd,
+                template_dir)
+
+        first_dir, first = clone('first')
+        second_dir, second = clone('second')
+        self.assertIsNotNone(first)
+        # both come from the one template
+        self.assertEqual(len(os.listdir(template_dir)), 1)
+        for virtualenv_dir in [first_dir, second_dir]:
+            with open(os.path.join(virtualenv_dir, 'bin', 'activate')) as f:
+                activate = f.read()
+            self.assertIn(virtualenv_dir, activate)
+            self.assertNotIn(template_dir, activate)
+
+        self.assertIsNone(second.Layer(second_dir, None))
+        second.SaveLayer(second_dir, None, 'blob', 'tar')
+        self.assertEqual(second.Layer(second_dir, None), ('blob', 'tar'))
+        self.assertIsNone(
+            second.Layer(second_dir,
+                         ftl_util.LayerOptions(dedupe_files=True)))
+        self.assertIsNone(second.Layer(first_dir, None))
+
 
 if __name__ == '__main__':
     unittest.main()
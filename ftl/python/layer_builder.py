@@ -15,10 +15,12 @@
 
 import logging
 import os
-import tempfile
+import shutil
 import subprocess
+import threading
 import concurrent.futures
 
+from ftl.common import concurrency
 from ftl.common import constants
 from ftl.common import ftl_util
 from ftl.common import ftl_error
@@ -27,28 +29,74 @@ from ftl.common import tar_to_dockerimage
 
 from ftl.python import python_util
 
+# package layers with bytecode are keyed apart from those without
+_COMPILED_KEY_SUFFIX = ' compiled'
+
+# `python --version` output by python command, it does not change between
+# builds run by the same process.
+_python_versions_lock = threading.Lock()
+_python_versions = {}
+
+
+def _compile_pkg_dir(python_cmd, pkg_dir, virtualenv_dir):
+    """Compiles a package installed under pkg_dir for virtualenv_dir."""
+    python_util.compile_bytecode(
+        python_cmd, os.path.join(pkg_dir, virtualenv_dir.lstrip('/')),
+        virtualenv_dir)
+
 
 class PackageLayerBuilder(single_layer_image.CacheableLayerBuilder):
     def __init__(self,
                  ctx=None,
                  descriptor_files=None,
-                 pkg_dir=None,
+                 whl=None,
+                 pip_cmd=[constants.PIP_DEFAULT_CMD],
+                 virtualenv_dir=constants.VIRTUALENV_DIR,
                  dep_img_lyr=None,
                  cache_key_version=None,
-                 cache=None):
+                 cache=None,
+                 layer_opts=None,
+                 python_cmd=[constants.PYTHON_DEFAULT_CMD],
+                 compile_bytecode=False):
         super(PackageLayerBuilder, self).__init__()
         self._ctx = ctx
-        self._pkg_dir = pkg_dir
+        self._whl = whl
+        self._pip_cmd = pip_cmd
+        self._virtualenv_dir = virtualenv_dir
         self._descriptor_files = descriptor_files
         self._dep_img_lyr = dep_img_lyr
         self._cache_key_version = cache_key_version
         self._cache = cache
+        self._layer_opts = layer_opts
+        self._python_cmd = python_cmd
+        self._compile_bytecode = compile_bytecode
+        self._whl_sha256 = None
 
     def GetCacheKeyRaw(self):
-        cache_key = ""
+        if self._whl_sha256 is None:
+            self._whl_sha256 = python_util.whl_sha256(self._whl)
+        cache_key = "%s %s %s" % (os.path.basename(self._whl),
+                                  self._whl_sha256,
+                                  self._dep_img_lyr.GetCacheKeyRaw())
+        if self._compile_bytecode:
+            cache_key += _COMPILED_KEY_SUFFIX
         return "%s %s" % (cache_key, self._cache_key_version)
 
+    def GetLayerName(self):
+        return 'python package %s' % python_util.whl_pkg_descriptor(
+            self._whl)[0]
+
     def BuildLayer(self):
+        cached_img = None
+        if self._cache:
+            with ftl_util.Timing('checking_cached_python_pkg_layer'):
+                key = self.GetCacheKey()
+                cached_img = self._cache.Get(key)
+                self._log_cache_result(False if cached_img is None else True)
+        self._cache_hit = cached_img is not None
+        if cached_img:
+            self.SetImage(cached_img)
+            return
         with ftl_util.Timing('building_python_pkg_layer'):
             self._build_layer()
         if self._cache:
@@ -56,19 +104,30 @@ class PackageLayerBuilder(single_layer_image.CacheableLayerBuilder):
                 self._cache.Set(self.GetCacheKey(), self.GetImage())
 
     def _build_layer(self):
-        blob, u_blob = ftl_util.zip_dir_to_layer_sha(self._pkg_dir, "")
+        pkg_dir = python_util.whl_to_fslayer(self._whl, self._pip_cmd,
+                                             self._virtualenv_dir)
+        if self._compile_bytecode:
+            _compile_pkg_dir(self._python_cmd, pkg_dir, self._virtualenv_dir)
+        blob, u_blob = ftl_util.zip_dir_to_layer_sha(
+            pkg_dir,
+            "",
+            layer_opts=self._layer_opts,
+            keep_bytecode=self._compile_bytecode)
         overrides = ftl_util.generate_overrides(False)
         self._img = tar_to_dockerimage.FromFSImage([blob], [u_blob], overrides)
 
     def _log_cache_result(self, hit):
         if hit:
-            cache_str = constants.PHASE_1_CACHE_HIT
+            cache_str = constants.PHASE_2_CACHE_HIT
         else:
-            cache_str = constants.PHASE_1_CACHE_MISS
+            cache_str = constants.PHASE_2_CACHE_MISS
+        name, version = python_util.whl_pkg_descriptor(self._whl)
         logging.info(
             cache_str.format(
                 key_version=constants.CACHE_KEY_VERSION,
                 language='PYTHON (package)',
+                package_name=name,
+                package_version=version,
                 key=self.GetCacheKey()))
 
 
@@ -86,7 +145,10 @@ class RequirementsLayerBuilder(single_layer_image.CacheableLayerBuilder):
                  pip_cmd=[constants.PIP_DEFAULT_CMD],
                  virtualenv_cmd=[constants.VIRTUALENV_DEFAULT_CMD],
                  venv_cmd=[constants.VENV_DEFAULT_CMD],
-                 cache=None):
+                 cache=None,
+                 layer_opts=None,
+                 virtualenv_template_dir=None,
+                 compile_bytecode=False):
         super(RequirementsLayerBuilder, self).__init__()
         self._ctx = ctx
         self._pkg_dir = pkg_dir
@@ -96,19 +158,34 @@ class RequirementsLayerBuilder(single_layer_image.CacheableLayerBuilder):
         self._pip_cmd = pip_cmd
         self._virtualenv_cmd = virtualenv_cmd
         self._venv_cmd = venv_cmd
+        self._virtualenv_template_dir = virtualenv_template_dir
+        self._compile_bytecode = compile_bytecode
         self._descriptor_files = descriptor_files
         self._directory = directory
         self._dep_img_lyr = dep_img_lyr
         self._cache_key_version = cache_key_version
         self._cache = cache
+        self._layer_opts = layer_opts
 
     def GetCacheKeyRaw(self):
-        descriptor_contents = ftl_util.descriptor_parser(
-            self._descriptor_files, self._ctx)
+        descriptor = next(
+            (f for f in self._descriptor_files if self._ctx.Contains(f)),
+            None)
+        if descriptor == constants.REQUIREMENTS_TXT:
+            descriptor_contents = python_util.canonical_requirements(
+                self._ctx, descriptor)
+        else:
+            descriptor_contents = ftl_util.descriptor_parser(
+                self._descriptor_files, self._ctx)
         cache_key = '%s %s' % (descriptor_contents,
                                self._dep_img_lyr.GetCacheKeyRaw())
+        if self._compile_bytecode:
+            cache_key += _COMPILED_KEY_SUFFIX
         return "%s %s" % (cache_key, self._cache_key_version)
 
+    def GetLayerName(self):
+        return 'python %s' % constants.REQUIREMENTS_TXT
+
     def BuildLayer(self):
         cached_img = None
         if self._cache:
@@ -116,32 +193,35 @@ class RequirementsLayerBuilder(single_layer_image.CacheableLayerBuilder):
                 key = self.GetCacheKey()
                 cached_img = self._cache.Get(key)
                 self._log_cache_result(False if cached_img is None else True)
+        self._cache_hit = cached_img is not None
         if cached_img:
             self.SetImage(cached_img)
         else:
             python_util.setup_virtualenv(self._virtualenv_dir,
                                          self._virtualenv_cmd,
                                          self._python_cmd,
-                                         self._venv_cmd)
+                                         self._venv_cmd,
+                                         self._virtualenv_template_dir)
 
             pkg_descriptor = ftl_util.descriptor_parser(
                 self._descriptor_files, self._ctx)
             self._pip_download_wheels(pkg_descriptor)
             whls = self._resolve_whls()
-            pkg_dirs = [self._whl_to_fslayer(whl) for whl in whls]
 
-            req_txt_imgs = []
+            pkg_builders = [self._pkg_builder(whl) for whl in whls]
             with ftl_util.Timing('uploading_all_package_layers'):
-                with concurrent.futures.ThreadPoolExecutor(
-                        max_workers=constants.THREADS) as executor:
+                with ftl_util.ThreadPoolExecutor(
+                        max_workers=concurrency.network().capacity
+                ) as executor:
                     future_to_params = {
-                        executor.submit(self._build_pkg, whl_pkg_dir,
-                                        req_txt_imgs): whl_pkg_dir
-                        for whl_pkg_dir in pkg_dirs
+                        executor.submit(pkg_builder.BuildLayer): pkg_builder
+                        for pkg_builder in pkg_builders
                     }
                     for future in concurrent.futures.as_completed(
                             future_to_params):
                         future.result()
+            # keep the layer order stable regardless of completion order
+            req_txt_imgs = [b.GetImage() for b in pkg_builders]
 
             req_txt_image = ftl_util.AppendLayersIntoImage(req_txt_imgs)
 
@@ -152,35 +232,30 @@ class RequirementsLayerBuilder(single_layer_image.CacheableLayerBuilder):
                     with ftl_util.Timing('uploading_requirements.txt_pkg_lyr'):
                         self._cache.Set(self.GetCacheKey(), self.GetImage())
 
-    def _build_pkg(self, whl_pkg_dir, req_txt_imgs):
-        layer_builder = PackageLayerBuilder(
+    def _pkg_builder(self, whl):
+        return PackageLayerBuilder(
             ctx=self._ctx,
             descriptor_files=self._descriptor_files,
-            pkg_dir=whl_pkg_dir,
+            whl=whl,
+            pip_cmd=self._pip_cmd,
+            virtualenv_dir=self._virtualenv_dir,
             dep_img_lyr=self._dep_img_lyr,
             cache_key_version=self._cache_key_version,
-            cache=self._cache)
-        layer_builder.BuildLayer()
-        req_txt_imgs.append(layer_builder.GetImage())
+            cache=self._cache,
+            layer_opts=self._layer_opts,
+            python_cmd=self._python_cmd,
+            compile_bytecode=self._compile_bytecode)
 
     def _resolve_whls(self):
         with ftl_util.Timing('resolving_whl_paths'):
             return [
                 os.path.join(self._wheel_dir, f)
-                for f in os.listdir(self._wheel_dir)
+                for f in sorted(os.listdir(self._wheel_dir))
             ]
 
     def _whl_to_fslayer(self, whl):
-        tmp_dir = tempfile.mkdtemp()
-        pkg_dir = os.path.join(tmp_dir, self._virtualenv_dir.lstrip('/'))
-        os.makedirs(pkg_dir)
-
-        pip_cmd_args = list(self._pip_cmd)
-        pip_cmd_args.extend(['install', '--no-deps', '--prefix', pkg_dir, whl])
-        pip_cmd_args.extend(constants.PIP_OPTIONS)
-        ftl_util.run_command('pip_install_from_wheels', pip_cmd_args, None,
-                             self._gen_pip_env())
-        return tmp_dir
+        return python_util.whl_to_fslayer(whl, self._pip_cmd,
+                                          self._virtualenv_dir)
 
     def _pip_download_wheels(self, pkg_txt):
         ftl_util.run_command(
@@ -191,27 +266,29 @@ class RequirementsLayerBuilder(single_layer_image.CacheableLayerBuilder):
             cmd_input=pkg_txt,
             err_type=ftl_error.FTLErrors.USER())
 
+        # local requirements such as `-e .` are built in a copy of the app
+        # directory, the app layer being built from it meanwhile
+        work_dir = None
+        if self._directory:
+            work_dir = python_util.copy_sources(self._directory)
         pip_cmd_args = list(self._pip_cmd)
         pip_cmd_args.extend(
             ['wheel', '-w', self._wheel_dir, '-r', 'requirements.txt'])
         pip_cmd_args.extend(constants.PIP_OPTIONS)
-        ftl_util.run_command(
-            'pip_download_wheels',
-            pip_cmd_args,
-            cmd_cwd=self._directory,
-            cmd_env=self._gen_pip_env(),
-            cmd_input=pkg_txt,
-            err_type=ftl_error.FTLErrors.USER())
+        try:
+            ftl_util.run_command(
+                'pip_download_wheels',
+                pip_cmd_args,
+                cmd_cwd=work_dir,
+                cmd_env=self._gen_pip_env(),
+                cmd_input=pkg_txt,
+                err_type=ftl_error.FTLErrors.USER())
+        finally:
+            if work_dir:
+                shutil.rmtree(os.path.dirname(work_dir), ignore_errors=True)
 
     def _gen_pip_env(self):
-        pip_env = os.environ.copy()
-        # bazel adds its own PYTHONPATH to the env
-        # which must be removed for the pip calls to work properly
-        pip_env.pop('PYTHONPATH', None)
-        pip_env['VIRTUAL_ENV'] = self._virtualenv_dir
-        pip_env['PATH'] = self._virtualenv_dir + '/bin' + ':' + os.environ[
-            'PATH']
-        return pip_env
+        return python_util.gen_pip_env(self._virtualenv_dir)
 
     def _log_cache_result(self, hit):
         if hit:
@@ -231,6 +308,7 @@ class PipfileLayerBuilder(RequirementsLayerBuilder):
                  descriptor_files=None,
                  directory=None,
                  pkg_descriptor=None,
+                 pkg_hashes=None,
                  pkg_dir=None,
                  dep_img_lyr=None,
                  cache_key_version=None,
@@ -239,7 +317,9 @@ class PipfileLayerBuilder(RequirementsLayerBuilder):
                  python_cmd=[constants.PYTHON_DEFAULT_CMD],
                  pip_cmd=[constants.PIP_DEFAULT_CMD],
                  virtualenv_cmd=[constants.VIRTUALENV_DEFAULT_CMD],
-                 cache=None):
+                 cache=None,
+                 layer_opts=None,
+                 compile_bytecode=False):
         super(PipfileLayerBuilder, self).__init__()
         self._ctx = ctx
         self._pkg_dir = pkg_dir
@@ -253,14 +333,24 @@ class PipfileLayerBuilder(RequirementsLayerBuilder):
         self._dep_img_lyr = dep_img_lyr
         self._cache_key_version = cache_key_version
         self._cache = cache
+        self._layer_opts = layer_opts
+        self._compile_bytecode = compile_bytecode
         self._pkg_descriptor = pkg_descriptor
+        self._pkg_hashes = pkg_hashes
 
     def GetCacheKeyRaw(self):
         cache_key = "%s %s %s" % (self._pkg_descriptor[0],
                                   self._pkg_descriptor[1],
                                   self._dep_img_lyr.GetCacheKeyRaw())
+        if self._pkg_hashes:
+            cache_key += ' ' + ' '.join(self._pkg_hashes)
+        if self._compile_bytecode:
+            cache_key += _COMPILED_KEY_SUFFIX
         return "%s %s" % (cache_key, self._cache_key_version)
 
+    def GetLayerName(self):
+        return 'python package %s' % self._pkg_descriptor[0]
+
     def _log_cache_result(self, hit):
         if hit:
             cache_str = constants.PHASE_2_CACHE_HIT
@@ -281,15 +371,23 @@ class PipfileLayerBuilder(RequirementsLayerBuilder):
                 key = self.GetCacheKey()
                 cached_img = self._cache.Get(key)
                 self._log_cache_result(False if cached_img is None else True)
+        self._cache_hit = cached_img is not None
         if cached_img:
             self.SetImage(cached_img)
         else:
-            self._pip_download_wheels(' '.join(self._pkg_descriptor))
+            self._pip_download_wheels(self._requirement())
             whls = self._resolve_whls()
             if len(whls) != 1:
                 raise Exception("expected one whl for one installed pkg")
             pkg_dir = self._whl_to_fslayer(whls[0])
-            blob, u_blob = ftl_util.zip_dir_to_layer_sha(pkg_dir, "")
+            if self._compile_bytecode:
+                _compile_pkg_dir(self._python_cmd, pkg_dir,
+                                 self._virtualenv_dir)
+            blob, u_blob = ftl_util.zip_dir_to_layer_sha(
+                pkg_dir,
+                "",
+                layer_opts=self._layer_opts,
+                keep_bytecode=self._compile_bytecode)
             overrides = ftl_util.generate_overrides(False)
             self._img = tar_to_dockerimage.FromFSImage([blob], [u_blob],
                                                        overrides)
@@ -297,11 +395,20 @@ class PipfileLayerBuilder(RequirementsLayerBuilder):
                 with ftl_util.Timing('uploading_pipfile_pkg_layer'):
                     self._cache.Set(self.GetCacheKey(), self.GetImage())
 
+    def _requirement(self):
+        pkg_txt = ' '.join(self._pkg_descriptor)
+        for pkg_hash in self._pkg_hashes or []:
+            pkg_txt += ' --hash=' + pkg_hash
+        return pkg_txt
+
     def _pip_download_wheels(self, pkg_txt):
         pip_cmd_args = list(self._pip_cmd)
         pip_cmd_args.extend(
             ['wheel', '-w', self._wheel_dir, '-r', '/dev/stdin'])
         pip_cmd_args.extend(['--no-deps'])
+        if self._pkg_hashes:
+            # the download is checked as pip would check the whole file
+            pip_cmd_args.extend(['--require-hashes'])
         pip_cmd_args.extend(constants.PIP_OPTIONS)
         ftl_util.run_command(
             'pip_download_wheels',
@@ -319,7 +426,9 @@ class InterpreterLayerBuilder(single_layer_image.CacheableLayerBuilder):
                  virtualenv_cmd=[constants.VIRTUALENV_DEFAULT_CMD],
                  venv_cmd=[constants.VENV_DEFAULT_CMD],
                  cache_key_version=None,
-                 cache=None):
+                 cache=None,
+                 layer_opts=None,
+                 virtualenv_template_dir=None):
         super(InterpreterLayerBuilder, self).__init__()
         self._virtualenv_dir = virtualenv_dir
         self._python_cmd = python_cmd
@@ -327,13 +436,30 @@ class InterpreterLayerBuilder(single_layer_image.CacheableLayerBuilder):
         self._venv_cmd = venv_cmd
         self._cache_key_version = cache_key_version
         self._cache = cache
+        self._layer_opts = layer_opts
+        self._virtualenv_template_dir = virtualenv_template_dir
+        self._python_version_output = None
 
     def GetCacheKeyRaw(self):
-        cache_key = '%s %s %s' % (self._python_version(), self._virtualenv_cmd,
+        if self._python_version_output is None:
+            # every package layer key includes this one, only ask once
+            self._python_version_output = self._python_version()
+        cache_key = '%s %s %s' % (self._python_version_output,
+                                  self._virtualenv_cmd,
                                   self._virtualenv_dir)
         return "%s %s" % (cache_key, self._cache_key_version)
 
+    def GetLayerName(self):
+        return 'python interpreter'
+
     def _python_version(self):
+        cmd = tuple(self._python_cmd)
+        with _python_versions_lock:
+            if cmd not in _python_versions:
+                _python_versions[cmd] = self._run_python_version()
+            return _python_versions[cmd]
+
+    def _run_python_version(self):
         with ftl_util.Timing('check python version'):
             python_version_cmd = list(self._python_cmd)
             python_version_cmd.append('--version')
@@ -360,6 +486,7 @@ class InterpreterLayerBuilder(single_layer_image.CacheableLayerBuilder):
                 key = self.GetCacheKey()
                 cached_img = self._cache.Get(key)
                 self._log_cache_result(False if cached_img is None else True)
+        self._cache_hit = cached_img is not None
         if cached_img:
             self.SetImage(cached_img)
         else:
@@ -370,13 +497,24 @@ class InterpreterLayerBuilder(single_layer_image.CacheableLayerBuilder):
                     self._cache.Set(self.GetCacheKey(), self.GetImage())
 
     def _build_layer(self):
-        python_util.setup_virtualenv(self._virtualenv_dir,
-                                     self._virtualenv_cmd,
-                                     self._python_cmd,
-                                     self._venv_cmd)
-
-        blob, u_blob = ftl_util.zip_dir_to_layer_sha(self._virtualenv_dir,
-                                                     self._virtualenv_dir)
+        template = python_util.setup_virtualenv(
+            self._virtualenv_dir, self._virtualenv_cmd, self._python_cmd,
+            self._venv_cmd, self._virtualenv_template_dir)
+
+        layer = None
+        if template:
+            layer = template.Layer(self._virtualenv_dir, self._layer_opts)
+        if layer:
+            logging.info('Reusing the layer of the virtualenv template')
+            blob, u_blob = layer
+        else:
+            blob, u_blob = ftl_util.zip_dir_to_layer_sha(
+                self._virtualenv_dir,
+                self._virtualenv_dir,
+                layer_opts=self._layer_opts)
+            if template:
+                template.SaveLayer(self._virtualenv_dir, self._layer_opts,
+                                   blob, u_blob)
 
         overrides = ftl_util.generate_overrides(True, self._virtualenv_dir)
         self._img = tar_to_dockerimage.FromFSImage([blob], [u_blob], overrides)
@@ -12,15 +12,60 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 """This package defines helpful utilities for FTL ."""
+import distutils.spawn
+import hashlib
+import json
+import logging
 import os
+import re
+import shutil
+import stat
+import subprocess
+import tempfile
+import threading
 
+from ftl.common import concurrency
+from ftl.common import constants
+from ftl.common import ftl_error
 from ftl.common import ftl_util
 
+_INCLUDE_RE = re.compile(r'^(-r|--requirement)(\s+|=)(.+)$')
+_CONSTRAINT_RE = re.compile(r'^(-c|--constraint)(\s+|=)(.+)$')
+_REQUIREMENT_RE = re.compile(
+    r'^([A-Za-z0-9][A-Za-z0-9._-]*)\s*(\[[^\]]*\])?\s*([^;]*?)\s*(;.*)?$')
+_HASH_RE = re.compile(r'\s--hash(?:\s+|=)(\S+)')
+_PINNED_RE = re.compile(
+    r'^([A-Za-z0-9][A-Za-z0-9._-]*)(\[[^\]]*\])?\s*==\s*([^\s;,*=]+)$')
 
-def setup_virtualenv(virtualenv_dir, virtualenv_cmd, python_cmd, venv_cmd):
+
+def setup_virtualenv(virtualenv_dir,
+                     virtualenv_cmd,
+                     python_cmd,
+                     venv_cmd,
+                     template_dir=None):
+    """Creates the virtualenv unless it exists.
+
+    With a template_dir, the virtualenv is cloned from a template kept
+    there for the interpreter and virtualenv tool, the template being
+    created on first use.
+
+    Returns:
+      the VirtualenvTemplate the virtualenv was cloned from, or None.
+    """
     if os.path.isdir(virtualenv_dir):
-        return
+        return None
+    if template_dir:
+        template = VirtualenvTemplate.Get(template_dir, virtualenv_dir,
+                                          virtualenv_cmd, python_cmd,
+                                          venv_cmd)
+        if template:
+            template.Clone(virtualenv_dir)
+            return template
+    _create_virtualenv(virtualenv_dir, virtualenv_cmd, python_cmd, venv_cmd)
+    return None
 
+
+def _create_virtualenv(virtualenv_dir, virtualenv_cmd, python_cmd, venv_cmd):
     if venv_cmd:
         ftl_util.run_command(
             'create_venv',
@@ -40,3 +85,407 @@ def setup_virtualenv(virtualenv_dir, virtualenv_cmd, python_cmd, venv_cmd):
         'create_virtualenv',
         virtualenv_cmd_args,
         cmd_cwd="/")
+
+
+# a template directory holds the virtualenv, the path it was created at and
+# the layers tarred from its copies
+_TEMPLATE_ENV_DIR = 'env'
+_TEMPLATE_ORIGIN_FILE = 'origin'
+_TEMPLATE_LAYERS_DIR = 'layers'
+
+_templates_lock = threading.Lock()
+# the keys of templates by virtualenv and python commands
+_template_keys = {}
+
+
+class VirtualenvTemplate(object):
+    """VirtualenvTemplate is a virtualenv kept aside to be copied instead of
+    created, along with the layers tarred from its copies.
+
+    Templates are keyed by the hash of the interpreter binary, the version
+    of the virtualenv tool and the commands used, so a new interpreter or
+    tool gets a new template. A template is created under a temporary path
+    and renamed into place, so concurrent builds never see it half made.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        with open(os.path.join(path, _TEMPLATE_ORIGIN_FILE), 'r') as f:
+            self._origin = f.read()
+
+    @staticmethod
+    def Get(template_dir, virtualenv_dir, virtualenv_cmd, python_cmd,
+            venv_cmd):
+        """Returns the template for the commands, creating it if needed,
+        or None when the commands cannot create one elsewhere than at
+        virtualenv_dir."""
+        if venv_cmd and virtualenv_dir not in venv_cmd:
+            # the command does not name the directory it creates
+            return None
+        if venv_cmd:
+            # key on the command, not on where it is told to create it
+            venv_cmd = ['{virtualenv_dir}' if arg == virtualenv_dir else arg
+                        for arg in venv_cmd]
+        key = _template_key(virtualenv_cmd, python_cmd, venv_cmd)
+        path = os.path.join(template_dir, key)
+        if not os.path.isdir(path):
+            with ftl_util.Timing('creating_virtualenv_template'):
+                _create_template(template_dir, path, virtualenv_cmd,
+                                 python_cmd, venv_cmd)
+        return VirtualenvTemplate(path)
+
+    def Clone(self, virtualenv_dir):
+        """Copies the template to virtualenv_dir, pointing the paths it
+        holds to its new location."""
+        with ftl_util.Timing('cloning_virtualenv_template'):
+            parent = os.path.dirname(virtualenv_dir.rstrip('/'))
+            if parent and not os.path.isdir(parent):
+                os.makedirs(parent)
+            ftl_util.run_command('clone_virtualenv', [
+                'cp', '-a', '--reflink=auto',
+                os.path.join(self._path, _TEMPLATE_ENV_DIR), virtualenv_dir
+            ])
+            _relocate(virtualenv_dir, self._origin, virtualenv_dir)
+
+    def _layer_path(self, virtualenv_dir, layer_opts):
+        layer_opts = layer_opts or ftl_util.LayerOptions()
+        key = hashlib.sha256(
+            json.dumps([
+                virtualenv_dir, layer_opts.compression,
+                layer_opts.compression_level,
+                list(layer_opts.prioritized_files),
+                layer_opts.dedupe_files,
+                ftl_util.source_date_epoch()
+            ])).hexdigest()
+        return os.path.join(self._path, _TEMPLATE_LAYERS_DIR, key)
+
+    def Layer(self, virtualenv_dir, layer_opts):
+        """Returns the (blob, u_blob) layer tarred from a copy of the
+        template at virtualenv_dir, or None if none was saved."""
+        path = self._layer_path(virtualenv_dir, layer_opts)
+        if not os.path.isfile(path + '.blob'):
+            return None
+        with open(path + '.blob', 'rb') as f:
+            blob = f.read()
+        with open(path + '.tar', 'rb') as f:
+            u_blob = f.read()
+        return blob, u_blob
+
+    def SaveLayer(self, virtualenv_dir, layer_opts, blob, u_blob):
+        """Keeps the layer tarred from a fresh copy of the template."""
+        path = self._layer_path(virtualenv_dir, layer_opts)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                # another build made it
+                pass
+        # the blob is written last as it marks the layer complete
+        _write_atomically(path + '.tar', u_blob)
+        _write_atomically(path + '.blob', blob)
+
+
+def _template_key(virtualenv_cmd, python_cmd, venv_cmd):
+    cmds = (tuple(virtualenv_cmd), tuple(python_cmd), tuple(venv_cmd or ()))
+    with _templates_lock:
+        if cmds not in _template_keys:
+            key = hashlib.sha256()
+            key.update(json.dumps(cmds))
+            if venv_cmd:
+                # venv ships with the interpreter it runs on
+                key.update(_binary_sha256(venv_cmd[0]))
+            else:
+                key.update(_binary_sha256(python_cmd[0]))
+                key.update(_tool_version(virtualenv_cmd))
+            _template_keys[cmds] = key.hexdigest()
+        return _template_keys[cmds]
+
+
+def _binary_sha256(cmd):
+    path = distutils.spawn.find_executable(cmd)
+    if not path:
+        raise ftl_error.InternalError('%s was not found on the path' % cmd)
+    sha = hashlib.sha256()
+    with open(os.path.realpath(path), 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _tool_version(cmd):
+    proc_pipe = subprocess.Popen(
+        list(cmd) + ['--version'],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE)
+    stdout, stderr = proc_pipe.communicate()
+    if proc_pipe.returncode:
+        raise ftl_error.InternalError(
+            'error: `%s --version` returned code: %d\n%s' %
+            (' '.join(cmd), proc_pipe.returncode, stderr))
+    return stdout + stderr
+
+
+def _create_template(template_dir, path, virtualenv_cmd, python_cmd,
+                     venv_cmd):
+    if not os.path.isdir(template_dir):
+        os.makedirs(template_dir)
+    staging = tempfile.mkdtemp(dir=template_dir, prefix='.tmp')
+    try:
+        env_dir = os.path.join(staging, _TEMPLATE_ENV_DIR)
+        if venv_cmd:
+            venv_cmd = [
+                env_dir if arg == '{virtualenv_dir}' else arg
+                for arg in venv_cmd
+            ]
+        _create_virtualenv(env_dir, virtualenv_cmd, python_cmd, venv_cmd)
+        with open(os.path.join(staging, _TEMPLATE_ORIGIN_FILE), 'w') as f:
+            f.write(env_dir)
+        try:
+            os.rename(staging, path)
+        except OSError:
+            # another build created the template first, use theirs
+            if not os.path.isdir(path):
+                raise
+    finally:
+        if os.path.isdir(staging):
+            shutil.rmtree(staging, ignore_errors=True)
+
+
+def _relocate(virtualenv_dir, origin, destination):
+    """Points the paths a virtualenv created at origin holds to
+    destination: symlinks, scripts and activation files."""
+    for root, dirs, files in os.walk(virtualenv_dir):
+        for name in dirs + files:
+            path = os.path.join(root, name)
+            if os.path.islink(path):
+                target = os.readlink(path)
+                if target == origin or target.startswith(origin + '/'):
+                    os.remove(path)
+                    os.symlink(destination + target[len(origin):], path)
+                continue
+            if name in dirs:
+                continue
+            # scripts hold the interpreter in their shebang, activation
+            # files and pyvenv.cfg hold the virtualenv directory
+            if os.path.basename(root) != 'bin' and name != 'pyvenv.cfg':
+                continue
+            with open(path, 'rb') as f:
+                content = f.read()
+            if '\0' in content or origin not in content:
+                continue
+            _write_atomically(
+                path, content.replace(origin, destination),
+                stat.S_IMODE(os.stat(path).st_mode))
+
+
+def _write_atomically(path, content, mode=0o644):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.chmod(tmp_path, mode)
+        os.rename(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def gen_pip_env(virtualenv_dir):
+    pip_env = ftl_util.build_env().copy()
+    # bazel adds its own PYTHONPATH to the env
+    # which must be removed for the pip calls to work properly
+    pip_env.pop('PYTHONPATH', None)
+    pip_env['VIRTUAL_ENV'] = virtualenv_dir
+    pip_env['PATH'] = virtualenv_dir + '/bin' + ':' + pip_env['PATH']
+    return pip_env
+
+
+def whl_to_fslayer(whl, pip_cmd, virtualenv_dir):
+    tmp_dir = tempfile.mkdtemp()
+    pkg_dir = os.path.join(tmp_dir, virtualenv_dir.lstrip('/'))
+    os.makedirs(pkg_dir)
+
+    pip_cmd_args = list(pip_cmd)
+    pip_cmd_args.extend(['install', '--no-deps', '--prefix', pkg_dir, whl])
+    pip_cmd_args.extend(constants.PIP_OPTIONS)
+    ftl_util.run_command('pip_install_from_wheels', pip_cmd_args, None,
+                         gen_pip_env(virtualenv_dir))
+    return tmp_dir
+
+
+# compiles a directory in parallel to pycs checked against the hash of their
+# source (PEP 552), which need python 3.7. The pycs pip wrote are timestamp
+# based and replaced. Files that do not compile, say modules for another
+# python version, are skipped as pip does.
+_COMPILE_BYTECODE_SCRIPT = """
+import sys
+if sys.version_info < (3, 7):
+    sys.exit('python %d.%d cannot write hash-based pycs, '
+             '--compile-bytecode needs python 3.7' % sys.version_info[:2])
+import compileall, py_compile
+compileall.compile_dir(
+    sys.argv[1], ddir=sys.argv[2], quiet=1, force=True,
+    workers=int(sys.argv[3]),
+    invalidation_mode=py_compile.PycInvalidationMode.CHECKED_HASH)
+"""
+
+
+def copy_sources(directory):
+    """Returns a temporary copy of directory without its bytecode, for it to
+    be compiled without changing directory."""
+    copy_dir = os.path.join(tempfile.mkdtemp(), 'app')
+    shutil.copytree(
+        directory,
+        copy_dir,
+        symlinks=True,
+        ignore=shutil.ignore_patterns('*.pyc', '__pycache__'))
+    return copy_dir
+
+
+def compile_bytecode(python_cmd, directory, destination):
+    """Compiles the python sources under directory to bytecode with the
+    interpreter, tracebacks naming them as under destination.
+
+    The pycs do not depend on mtimes, so they stay valid in layers built
+    with SOURCE_DATE_EPOCH and need not be rewritten at import, which the
+    filesystem of the container may not allow anyway.
+    """
+    cmd = list(python_cmd) + [
+        '-c', _COMPILE_BYTECODE_SCRIPT, directory, destination,
+        str(concurrency.cpu_limit())
+    ]
+    env = ftl_util.build_env().copy()
+    # as for pip, bazel's PYTHONPATH must not reach the interpreter
+    env.pop('PYTHONPATH', None)
+    ftl_util.run_command('compile_bytecode', cmd, cmd_env=env)
+
+
+def whl_sha256(whl):
+    sha = hashlib.sha256()
+    with open(whl, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def whl_pkg_descriptor(whl):
+    """Returns the (name, version) of a wheel from its filename, see
+    https://www.python.org/dev/peps/pep-0427/#file-name-convention"""
+    parts = os.path.basename(whl).split('-')
+    return parts[0], parts[1]
+
+
+def requirements_lines(ctx, path=constants.REQUIREMENTS_TXT, seen=None):
+    """Yields the requirement lines of a requirements file in the context.
+    Comments, blank lines and line continuations are resolved and -r
+    includes are expanded in place, relative to the including file."""
+    seen = seen if seen is not None else set()
+    if path in seen:
+        return
+    seen.add(path)
+    if not ctx.Contains(path):
+        raise ftl_error.UserError(
+            'requirements file %s could not be found' % path)
+    contents = ctx.GetFile(path).replace('\\\n', ' ')
+    for line in contents.splitlines():
+        line = re.sub(r'(^|\s)#.*$', '', line).strip()
+        if not line:
+            continue
+        match = _INCLUDE_RE.match(line)
+        if match:
+            include = _include_path(path, match.group(3))
+            for included in requirements_lines(ctx, include, seen):
+                yield included
+            continue
+        yield line
+
+
+def _include_path(path, include):
+    return os.path.normpath(
+        os.path.join(os.path.dirname(path), include.strip()))
+
+
+def canonicalize_name(name):
+    """Normalizes a project name as described in
+    https://www.python.org/dev/peps/pep-0503/#normalized-names"""
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def _canonical_requirement(line):
+    hashes = sorted(_HASH_RE.findall(' ' + line))
+    line = _HASH_RE.sub('', ' ' + line).strip()
+    match = _REQUIREMENT_RE.match(line)
+    if not match or '://' in line:
+        # options, editables and urls are kept verbatim
+        return ' '.join(line.split() + ['--hash=' + h for h in hashes])
+    name, extras, specs, markers = match.groups()
+    canonical = canonicalize_name(name)
+    if extras:
+        extras = sorted(set(
+            canonicalize_name(e.strip())
+            for e in extras.strip('[]').split(',') if e.strip()))
+        canonical += '[%s]' % ','.join(extras)
+    specs = sorted(''.join(spec.split()).lower()
+                   for spec in specs.split(',') if spec.strip())
+    canonical += ','.join(specs)
+    if markers:
+        canonical += ';' + ''.join(markers.lstrip(';').split())
+    for h in hashes:
+        canonical += ' --hash=' + h
+    return canonical
+
+
+def canonical_requirements(ctx, path=constants.REQUIREMENTS_TXT):
+    """Returns the semantic content of a requirements file: includes are
+    resolved, comments and whitespace are dropped, names are normalized
+    and entries are sorted. Used as the cache key so that cosmetic edits
+    do not trigger a dependency rebuild."""
+    entries = set()
+    for line in requirements_lines(ctx, path):
+        match = _CONSTRAINT_RE.match(line)
+        if match:
+            constraints = canonical_requirements(
+                ctx, _include_path(path, match.group(3)))
+            entries.update('-c ' + c for c in constraints.splitlines())
+            continue
+        entries.add(_canonical_requirement(line))
+    return '\n'.join(sorted(entries))
+
+
+def pinned_requirements(ctx, path=constants.REQUIREMENTS_TXT):
+    """Returns the (name, version, hashes) of every requirement if the
+    requirements file pins all of them exactly, as pip-compile output does,
+    otherwise None. Such a file is as good as a lockfile and can be built
+    one package at a time.
+
+    Names are normalized so that a package has the same layer whatever its
+    spelling. A file with extras, or with hashes for only some of its
+    requirements, is left to pip to install as a whole."""
+    pkgs = []
+    pins = {}
+    for line in requirements_lines(ctx, path):
+        hashes = tuple(sorted(_HASH_RE.findall(' ' + line)))
+        line = _HASH_RE.sub('', ' ' + line).strip()
+        match = _PINNED_RE.match(line)
+        if not match:
+            logging.info('%s is not fully pinned, found: %s', path, line)
+            return None
+        if match.group(2):
+            # extras pull in more packages, which pip has to resolve
+            logging.info('%s requires extras, found: %s', path, line)
+            return None
+        name = canonicalize_name(match.group(1))
+        version = '==' + match.group(3)
+        if name in pins:
+            if pins[name] != (version, hashes):
+                logging.info('%s pins %s twice', path, name)
+                return None
+            continue
+        pins[name] = (version, hashes)
+        pkgs.append((name, version, hashes))
+    if len(set(bool(hashes) for _, _, hashes in pkgs)) > 1:
+        # pip requires a hash for every package once one has one
+        logging.info('%s has hashes for some packages only', path)
+        return None
+    return pkgs or None